@@ -3,206 +3,5210 @@ import os
 import tempfile
 import shutil
 import subprocess
+import re
+import threading
+import collections
+import itertools
+import multiprocessing
+import concurrent.futures
+import time
+import random
+import email.utils
+import urllib.parse
+import sqlite3
+import hashlib
+import base64
+import binascii
+import struct
+import socket
+import json
+import http.server
+import errno
+import contextlib
 from pathlib import Path
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                            QHBoxLayout, QLabel, QLineEdit, QPushButton, 
-                           QProgressBar, QFileDialog, QMessageBox, QGroupBox, QTabWidget)
-from PyQt6.QtCore import QThread, pyqtSignal
+                           QProgressBar, QFileDialog, QMessageBox, QGroupBox, QTabWidget,
+                           QCheckBox, QTableView, QHeaderView, QAbstractItemView, QStyledItemDelegate,
+                           QStyleOptionProgressBar, QStyle)
+from PyQt6.QtCore import QThread, pyqtSignal, Qt, QAbstractTableModel, QModelIndex, QTimer, QUrl
+from PyQt6.QtGui import QPixmap, QDesktopServices
 import requests
 from requests.exceptions import RequestException
 from moviepy.editor import VideoFileClip, AudioFileClip
+from proglog import ProgressBarLogger
+
+class Cancelled(Exception):
+    pass
+
+class JobInputError(ValueError):
+    # URL หรือพารามิเตอร์ของงานใช้ไม่ได้ (ไม่มี aid ไม่มี stream ตัดช่วงไม่ได้) ทำซ้ำกี่ครั้งก็ไม่สำเร็จ
+    # ValueError อื่น (เช่น API ตอบ HTML แทน JSON) ถือเป็นข้อผิดพลาดชั่วคราว
+    pass
+
+class CancelToken:
+    # สัญญาณยกเลิกที่ส่งต่อไปทุกขั้นตอน (resolve, ดาวน์โหลด, รวมไฟล์)
+    # on_cancel ใช้ลงทะเบียนสิ่งที่ต้องปลุก/หยุดทันทีเมื่อยกเลิก เช่น socket หรือโปรเซส ffmpeg
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback failed: {str(e)}")
+
+    def on_cancel(self, callback):
+        # คืนฟังก์ชันสำหรับยกเลิกการลงทะเบียนเมื่อขั้นตอนนั้นจบแล้ว
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._unregister(callback)
+        callback()
+        return lambda: None
+
+    def _unregister(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled("ยกเลิกแล้ว")
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+def sleep_or_cancel(delay, cancel_token=None):
+    if cancel_token is None:
+        time.sleep(delay)
+    elif cancel_token.wait(delay):
+        raise Cancelled("ยกเลิกแล้ว")
+
+def abort_response(response):
+    # close() อย่างเดียวไม่ปลุก thread ที่ค้างอยู่ใน recv() ต้อง shutdown socket ด้วย
+    connection = getattr(response.raw, "connection", None) or getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+# (connect, read) วินาที read timeout ใช้จับ socket ที่ค้างโดยไม่มีข้อมูลเข้ามา
+API_TIMEOUT = (5, 15)
+DOWNLOAD_TIMEOUT = (5, 15)
+
+BILIBILI_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Accept': '*/*',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Referer': 'https://www.bilibili.tv/'
+}
+
+PLAYURL_API = "https://api.bilibili.tv/intl/gateway/web/playurl"
+
+_AID_IN_URL_RE = re.compile(r"/video/(\d+)")
+# ลิงก์ /video/<aid> หรือ "aid":"<aid>" ที่ฝังอยู่ใน HTML/JSON ของหน้า playlist
+_AID_IN_PAGE_RE = re.compile(r'/video/(\d+)|"aid"\s*:\s*"?(\d+)')
 
 def extract_aid_from_url(url):
     # ดึง aid จาก URL
+    match = _AID_IN_URL_RE.search(url or "")
+    if match:
+        return match.group(1)
+    # รับ aid ที่เป็นตัวเลขล้วนได้ด้วย
+    if url and url.strip().isdigit():
+        return url.strip()
+    return None
+
+def extract_aids_from_page(html):
+    # ดึง aid ทั้งหมดจากหน้า season/playlist โดยคงลำดับตามที่ปรากฏและตัดตัวซ้ำ
+    aids = []
+    seen = set()
+    for match in _AID_IN_PAGE_RE.finditer(html):
+        aid = match.group(1) or match.group(2)
+        if aid not in seen:
+            seen.add(aid)
+            aids.append(aid)
+    return aids
+
+class SourceAddressAdapter(requests.adapters.HTTPAdapter):
+    # ผูก connection ขาออกกับ IP ต้นทางที่กำหนด (เครื่องที่มีหลาย IP หรือหลาย interface)
+    def __init__(self, source_address, **kwargs):
+        self.source_address = (source_address, 0)
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = self.source_address
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs["source_address"] = self.source_address
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+def create_session(pool_size=10, proxy=None, source_address=None):
+    # session เดียวใช้ connection ซ้ำได้ ไม่ต้อง handshake ใหม่ทุกคำขอ
+    session = requests.Session()
+    session.headers.update(BILIBILI_HEADERS)
+    if source_address:
+        adapter = SourceAddressAdapter(source_address, pool_connections=pool_size, pool_maxsize=pool_size)
+    else:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    if proxy:
+        session.proxies = {"http": proxy, "https": proxy}
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# session กลางสำหรับดาวน์โหลดจาก CDN ทุกงานใช้ pool เดียวกัน connection ที่อุ่นไว้จึงถูกใช้ต่อได้
+cdn_session = create_session(16)
+
+# host ของ CDN ที่ใช้ล่าสุด เรียงจากที่ใช้ล่าสุดก่อน ใช้เดาว่างานถัดไปจะต่อไปที่ไหน
+_recent_cdn_hosts = collections.OrderedDict()
+_recent_cdn_hosts_lock = threading.Lock()
+MAX_RECENT_CDN_HOSTS = 4
+
+def remember_cdn_hosts(urls):
+    with _recent_cdn_hosts_lock:
+        for url in urls:
+            if not url:
+                continue
+            parts = urllib.parse.urlsplit(url)
+            origin = f"{parts.scheme}://{parts.netloc}/"
+            _recent_cdn_hosts.pop(origin, None)
+            _recent_cdn_hosts[origin] = True
+        while len(_recent_cdn_hosts) > MAX_RECENT_CDN_HOSTS:
+            _recent_cdn_hosts.popitem(last=False)
+
+def expected_cdn_hosts():
+    with _recent_cdn_hosts_lock:
+        return list(reversed(_recent_cdn_hosts))
+
+# การอุ่น connection ใช้ thread ชุดเล็กชุดเดียว ไม่สร้าง thread ใหม่ทุกครั้งที่เรียก
+WARM_UP_WORKERS = 4
+_warm_up_executor = concurrent.futures.ThreadPoolExecutor(max_workers=WARM_UP_WORKERS,
+                                                          thread_name_prefix="warm-up")
+# origin ที่กำลังอุ่นอยู่ ไม่ต้องส่งซ้ำ
+_warm_up_pending = set()
+_warm_up_lock = threading.Lock()
+
+def _preconnect_once(url, session):
+    try:
+        # HEAD ไม่มี body: DNS + TCP + TLS เสร็จแล้ว connection กลับเข้า pool ของ session ทันที
+        session.head(url, timeout=API_TIMEOUT, allow_redirects=False).close()
+    except RequestException as e:
+        # การอุ่นเครื่องเป็นแค่การเร่งความเร็ว ล้มเหลวก็ไม่กระทบงานจริง
+        print(f"Preconnect failed for {url}: {str(e)}")
+
+def preconnect(url, connections=1, session=None):
+    # ทำ DNS lookup, TCP handshake และ TLS handshake ไว้ล่วงหน้าด้วยคำขอ HEAD พร้อมกัน connections คำขอ
+    # connection เหล่านั้นค้างอยู่ใน pool ของ session คำขอจริงที่ตามมาจึงเสียเวลาแค่ 1 RTT ก่อนได้ไบต์แรก
+    # คืน future ของทุกคำขอ (ผู้เรียกไม่ต้องรอก็ได้)
+    session = session or cdn_session
+    with _warm_up_lock:
+        if url in _warm_up_pending:
+            return []
+        _warm_up_pending.add(url)
+    futures = [_warm_up_executor.submit(_preconnect_once, url, session) for _ in range(connections)]
+    remaining = [len(futures)]
+
+    def done(future):
+        with _warm_up_lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                _warm_up_pending.discard(url)
+
+    for future in futures:
+        future.add_done_callback(done)
+    return futures
+
+def warm_up_cdn(urls=None, connections=2):
+    # อุ่น connection แบบไม่รอผล ถ้าไม่ระบุ urls จะใช้ host ที่เพิ่งใช้ไป
+    origins = []
+    for url in (urls if urls is not None else expected_cdn_hosts()):
+        if not url:
+            continue
+        parts = urllib.parse.urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}/"
+        if origin not in origins:
+            origins.append(origin)
+    for origin in origins:
+        preconnect(origin, connections)
+    return origins
+
+# รหัสภาษาของ Bilibili -> ISO 639-2 ที่ใช้ในแท็ก language ของ MP4
+AUDIO_LANGUAGE_CODES = {
+    "th": "tha", "en": "eng", "zh": "chi", "zh-hans": "chi", "zh-hant": "chi", "ja": "jpn",
+    "ko": "kor", "id": "ind", "vi": "vie", "ms": "may", "es": "spa", "pt": "por", "ar": "ara",
+}
+
+class AudioTrack:
+    def __init__(self, url, quality, language=None):
+        self.url = url
+        self.quality = quality
+        # รหัสภาษาตามที่ API ส่งมา (None เมื่อไม่ระบุ)
+        self.language = language
+
+    @property
+    def iso_language(self):
+        if not self.language:
+            return "und"
+        key = self.language.lower()
+        return AUDIO_LANGUAGE_CODES.get(key) or AUDIO_LANGUAGE_CODES.get(key.split("-")[0], "und")
+
+    def __repr__(self):
+        return f"AudioTrack(quality={self.quality}, language={self.language!r})"
+
+class PlayurlResult:
+    def __init__(self, aid, video_url=None, audio_url=None, video_quality=None,
+                 audio_quality=None, error=None):
+        self.aid = aid
+        self.video_url = video_url
+        self.audio_url = audio_url
+        self.video_quality = video_quality
+        self.audio_quality = audio_quality
+        # ทุกภาษาที่มี แทร็กแรกคือแทร็กหลัก (ตรงกับ audio_url)
+        self.audio_tracks = []
+        # รูปแบบเก่า (durl): วิดีโอถูกแบ่งเป็นหลายไฟล์ FLV/MP4 ที่มีเสียงอยู่ในตัว ไม่มี audio_url แยก
+        # video_url คือส่วนแรก segment_durations เป็นวินาทีของแต่ละส่วน (None ถ้า API ไม่ระบุ)
+        self.video_segments = []
+        self.segment_durations = []
+        # ขนาดไฟล์ (ไบต์) ต่อ URL ตามที่ API แจ้ง ใช้ประมาณพื้นที่ที่ต้องจองก่อนเริ่มงาน
+        self.stream_sizes = {}
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def segmented(self):
+        return bool(self.video_segments)
+
+    def __repr__(self):
+        if self.error:
+            return f"PlayurlResult(aid={self.aid!r}, error={self.error!r})"
+        if self.segmented:
+            return f"PlayurlResult(aid={self.aid!r}, video_quality={self.video_quality}, segments={len(self.video_segments)})"
+        return f"PlayurlResult(aid={self.aid!r}, video_quality={self.video_quality}, audio_quality={self.audio_quality})"
+
+def pick_durl_segments(result, playurl_data):
+    # durl: [{"order": 1, "length": ms, "size": ..., "url": ..., "backup_url": [...]}, ...]
+    segments = sorted(playurl_data.get("durl") or [], key=lambda segment: segment.get("order") or 0)
+    urls = [segment.get("url") or next(iter(segment.get("backup_url") or []), None) for segment in segments]
+    if not segments or not all(url and url.strip() for url in urls):
+        return result
+    result.video_segments = urls
+    result.segment_durations = [segment["length"] / 1000 if segment.get("length") else None for segment in segments]
+    result.stream_sizes = {url: segment.get("size") for url, segment in zip(urls, segments)}
+    result.video_url = urls[0]
+    result.video_quality = playurl_data.get("quality")
+    return result
+
+# คุณภาพวิดีโอที่พยายามเลือกก่อน (1080P) ไฟล์ที่รวมไว้ที่คุณภาพนี้ใช้ซ้ำได้โดยไม่ต้องถาม API
+PREFERRED_VIDEO_QUALITY = 80
+
+def pick_playurl_streams(aid, playurl_data):
+    result = PlayurlResult(aid)
+
+    if not playurl_data.get("video") and playurl_data.get("durl"):
+        # คำตอบแบบเก่าของ bilibili.com ไม่มี video/audio_resource แยก
+        return pick_durl_segments(result, playurl_data)
+
+    # ดึง URL วิดีโอคุณภาพสูงสุด (1080P หรือ 720P)
+    videos = playurl_data.get("video", [])
+    # ลองหาวิดีโอคุณภาพ 1080P (quality=80) ก่อน ถ้าไม่มีหรือ URL ว่างเปล่า ให้ใช้ 720P (quality=64)
+    for quality in (PREFERRED_VIDEO_QUALITY, 64):
+        for video in videos:
+            video_resource = video.get("video_resource", {})
+            if video_resource.get("quality") == quality:
+                temp_url = video_resource.get("url")
+                if temp_url and temp_url.strip():  # ตรวจสอบว่า URL ไม่ว่างเปล่า
+                    result.video_url = temp_url
+                    result.video_quality = quality
+                    result.stream_sizes[temp_url] = video_resource.get("size")
+                    break
+        if result.video_url:
+            break
+
+    # ดึง URL เสียงคุณภาพสูงสุด (quality=30280)
+    for audio in playurl_data.get("audio_resource", []):
+        if audio.get("quality") == 30280:
+            result.audio_url = audio.get("url")
+            result.audio_quality = 30280
+            break
+
+    if result.audio_url:
+        result.audio_tracks = pick_audio_tracks(playurl_data.get("audio_resource", []), result.audio_url)
+        for audio in playurl_data.get("audio_resource", []):
+            if audio.get("url"):
+                result.stream_sizes[audio["url"]] = audio.get("size")
+
+    return result
+
+def _audio_language(audio):
+    return audio.get("language") or audio.get("lang") or audio.get("lang_key")
+
+def pick_audio_tracks(audio_resources, primary_url):
+    # แทร็กละหนึ่งภาษา เลือก 30280 ก่อน ไม่มีจึงใช้คุณภาพสูงสุดของภาษานั้น
+    # ถ้า API ไม่ได้ระบุภาษา รายการที่ซ้ำกันอาจเป็นแค่ mirror ของแทร็กเดียวกัน จึงใช้แค่แทร็กหลัก
+    primary = next(audio for audio in audio_resources if audio.get("url") == primary_url)
+    tracks = [AudioTrack(primary_url, primary.get("quality"), _audio_language(primary))]
+    if not tracks[0].language:
+        return tracks
+
+    best = {}
+    for audio in audio_resources:
+        language = _audio_language(audio)
+        url = audio.get("url")
+        if not language or not url or not url.strip() or language == tracks[0].language:
+            continue
+        current = best.get(language)
+        if current is None or (audio.get("quality") == 30280) > (current.get("quality") == 30280) or (
+                (audio.get("quality") == 30280) == (current.get("quality") == 30280)
+                and (audio.get("quality") or 0) > (current.get("quality") or 0)):
+            best[language] = audio
+    for language, audio in best.items():
+        tracks.append(AudioTrack(audio["url"], audio.get("quality"), language))
+    return tracks
+
+class PlayurlError(Exception):
+    def __init__(self, message, code=None, retry_after=None):
+        super().__init__(message)
+        self.code = code
+        self.retry_after = retry_after
+
+class PlayurlThrottled(PlayurlError):
+    pass
+
+class CircuitOpenError(PlayurlError):
+    pass
+
+# code ที่ gateway ตอบกลับเมื่อเรียกถี่เกินไป (-412 ถูกบล็อก, -509 ระบบหนัก, -799 เรียกบ่อยเกิน)
+PLAYURL_THROTTLE_CODES = {-412, -509, -799}
+PLAYURL_THROTTLE_STATUS = {429, 503}
+
+def parse_retry_after(value):
+    # Retry-After เป็นได้ทั้งจำนวนวินาทีและวันที่แบบ HTTP-date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    # exponential backoff แบบ full jitter ป้องกันทุก thread ยิงซ้ำพร้อมกัน
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+# ระหว่างรอผลคำขอทดลองของ half-open ตรวจซ้ำทุกเท่านี้วินาที
+CIRCUIT_TRIAL_POLL = 0.5
+
+class AdaptiveRateLimiter:
+    # จำกัดอัตราการเรียก API ฝั่ง client และเรียนรู้อัตราที่ gateway รับได้แบบ AIMD
+    # สำเร็จ: เพิ่มอัตราทีละน้อย (additive increase) ก่อนถูก throttle ครั้งแรกจะเพิ่มเร็วแบบ slow start
+    # ถูก throttle: ลดอัตราลงครึ่งหนึ่ง (multiplicative decrease) ไม่เกินครั้งละหนึ่งรอบ
+    # ล้มเหลวติดกันหลายครั้ง: เปิด circuit breaker หยุดเรียกชั่วคราว
+    def __init__(self, rate=4.0, min_rate=0.5, max_rate=50.0, increase=0.25, decrease=0.5,
+                 failure_threshold=5, cooldown=30.0, max_cooldown=300.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self._slow_start = True
+        self._generation = 0
+        self._next_time = 0.0
+        self._blocked_until = 0.0
+        self._failures = 0
+        self._state = "closed"  # closed, open, half_open
+        self._opened_until = 0.0
+        self._open_count = 0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            self._refresh_state(time.monotonic())
+            return self._state
+
+    def _refresh_state(self, now):
+        if self._state == "open" and now >= self._opened_until:
+            self._state = "half_open"
+            self._trial_in_flight = False
+
+    def acquire(self, cancel_token=None, max_wait=None):
+        # รอจนถึงคิวของตัวเอง คืนค่ารุ่นของอัตรา ณ ตอนส่งคำขอ (ใช้ส่งกลับใน on_throttle)
+        # ระหว่างที่ circuit เปิดหรือคำขอทดลองยังไม่กลับมา ก็รอ (ยกเลิกได้) แทนการล้มทั้ง batch
+        # CircuitOpenError เฉพาะเมื่อต้องรอนานเกิน max_wait วินาที
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refresh_state(now)
+                if self._state == "open":
+                    wait = self._opened_until - now
+                elif self._state == "half_open" and self._trial_in_flight:
+                    # คำขอทดลองยังไม่กลับมา ผลของมันจะปิดหรือเปิด circuit อีกครั้ง
+                    wait = CIRCUIT_TRIAL_POLL
+                else:
+                    wait = None
+                    start = max(now, self._next_time, self._blocked_until)
+                    self._next_time = start + 1.0 / self.rate
+                    generation = self._generation
+                if wait is not None and deadline is not None and now + wait > deadline:
+                    raise CircuitOpenError("playurl API ถูกพักการเรียกชั่วคราวเนื่องจากล้มเหลวติดต่อกัน",
+                                           retry_after=wait)
+            if wait is not None:
+                sleep_or_cancel(wait, cancel_token)
+                continue
+            delay = start - now
+            if delay > 0:
+                sleep_or_cancel(delay, cancel_token)
+            with self._lock:
+                # ถ้าอัตราถูกลดระหว่างรอ คิวที่จองไว้ใช้จังหวะเก่า ต้องจองใหม่
+                if generation != self._generation:
+                    continue
+                self._refresh_state(time.monotonic())
+                if self._state == "half_open":
+                    # ปล่อยคำขอทดลองเพียงคำขอเดียว คำขออื่นกลับไปรอผลของมัน
+                    if self._trial_in_flight:
+                        continue
+                    self._trial_in_flight = True
+                elif self._state == "open":
+                    continue
+                return generation
+
+    def on_success(self):
+        with self._lock:
+            step = 1.0 if self._slow_start else self.increase
+            self.rate = min(self.max_rate, self.rate + step)
+            self._failures = 0
+            if self._state != "closed":
+                self._state = "closed"
+                self._open_count = 0
+            self._trial_in_flight = False
+
+    def on_throttle(self, retry_after=None, generation=None):
+        with self._lock:
+            now = time.monotonic()
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            # คำขอที่จองคิวไว้ก่อนการลดอัตราครั้งล่าสุดสะท้อนอัตราเก่า
+            # ถ้านับซ้ำ อัตราจะถูกหารสองรัว ๆ จนต่ำสุดจากการ throttle เพียงครั้งเดียว
+            if generation is not None and generation != self._generation:
+                return
+            self._slow_start = False
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._generation += 1
+            self._next_time = max(self._next_time, now + 1.0 / self.rate)
+            self._record_failure(now)
+
+    def on_failure(self):
+        with self._lock:
+            self._record_failure(time.monotonic())
+
+    def _record_failure(self, now):
+        self._failures += 1
+        self._trial_in_flight = False
+        if self._state == "half_open" or self._failures >= self.failure_threshold:
+            # เปิดวงจร และยืดเวลาพักเป็นสองเท่าถ้ายังล้มเหลวหลังเปิดใหม่
+            cooldown = min(self.max_cooldown, self.cooldown * (2 ** self._open_count))
+            self._open_count += 1
+            self._state = "open"
+            self._opened_until = now + cooldown
+            self._failures = 0
+
+# ใช้ร่วมกันทั้งโปรแกรม ทั้งการดึงทีละ URL และการดึงหลาย aid พร้อมกัน
+playurl_limiter = AdaptiveRateLimiter()
+
+def fetch_playurl(aid, session=None, limiter=None, max_retries=4, require_video=True,
+                  cancel_token=None):
+    # เรียก playurl API สำหรับ aid เดียว ผ่าน limiter และลองใหม่เมื่อถูก throttle
+    if limiter is None:
+        limiter = playurl_limiter
+    params = {
+        "s_locale": "th_TH",
+        "platform": "web",
+        "aid": aid,
+        "qn": 80,
+        "type": 0,
+        "device": "wap",
+        "tf": 0,
+    }
+    attempt = 0
+    while True:
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        generation = limiter.acquire(cancel_token)
+        # ไม่ได้ส่ง session มาก็ใช้เส้นทางขาออกจาก pool เหมือนการดาวน์โหลด
+        route = egress_pool.pick() if session is None else None
+        try:
+            response = (route.session if route else session).get(PLAYURL_API, params=params, timeout=API_TIMEOUT)
+        except RequestException as e:
+            if route:
+                egress_pool.report(route, ok=False, error=e)
+            limiter.on_failure()
+            if attempt >= max_retries:
+                raise PlayurlError(f"เชื่อมต่อ playurl API ไม่สำเร็จ: {str(e)}")
+            sleep_or_cancel(backoff_delay(attempt), cancel_token)
+            attempt += 1
+            continue
+        if route:
+            # proxy ที่ตอบ 407/502 ถือว่าเส้นทางมีปัญหา ส่วน throttle เป็นเรื่องของ API
+            egress_pool.report(route, ok=response.status_code not in (407, 502, 504),
+                               error=f"HTTP {response.status_code}")
+
+        if response.status_code in PLAYURL_THROTTLE_STATUS:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            limiter.on_throttle(retry_after, generation)
+            if attempt >= max_retries:
+                raise PlayurlThrottled(f"playurl API จำกัดการเรียก (HTTP {response.status_code})",
+                                       retry_after=retry_after)
+            if retry_after is None:
+                sleep_or_cancel(backoff_delay(attempt), cancel_token)
+            attempt += 1
+            continue
+
+        if response.status_code >= 500:
+            limiter.on_failure()
+            if attempt >= max_retries:
+                raise PlayurlError(f"playurl API ผิดพลาด (HTTP {response.status_code})")
+            sleep_or_cancel(backoff_delay(attempt), cancel_token)
+            attempt += 1
+            continue
+
+        try:
+            response.raise_for_status()
+            data = response.json()
+            if not isinstance(data, dict):
+                raise ValueError("playurl API ตอบกลับไม่ใช่ JSON object")
+        except (requests.HTTPError, ValueError):
+            # ทุกทางหลัง acquire ต้องแจ้งผลให้ limiter มิฉะนั้นคำขอทดลองของ half-open จะค้างตลอดไป
+            limiter.on_failure()
+            raise
+        code = data.get("code")
+
+        if code in PLAYURL_THROTTLE_CODES:
+            limiter.on_throttle(parse_retry_after(response.headers.get("Retry-After")), generation)
+            if attempt >= max_retries:
+                raise PlayurlThrottled(f"API Error: {data.get('message')}", code=code)
+            sleep_or_cancel(backoff_delay(attempt), cancel_token)
+            attempt += 1
+            continue
+
+        # gateway ตอบกลับปกติ ถือว่าอัตราปัจจุบันยังรับได้แม้ aid นั้นจะใช้ไม่ได้
+        limiter.on_success()
+        if code != 0:
+            raise PlayurlError(f"API Error: {data.get('message')}", code=code)
+        break
+
+    data = data.get("data") or {}
+    # gateway ของ bilibili.tv ห่อไว้ใต้ "playurl" ส่วน API เก่าของ bilibili.com ส่ง durl มาที่ระดับ data
+    result = pick_playurl_streams(aid, data.get("playurl") or data)
+    if result.segmented:
+        return result
+    if not result.audio_url:
+        raise JobInputError("ไม่พบ URL เสียง")
+    if require_video and not result.video_url:
+        raise JobInputError("ไม่พบ URL วิดีโอหรือเสียง")
+    return result
+
+def resolve_playurl(aid, require_video=True, cancel_token=None):
+    # aid เดียวกันที่กำลัง resolve อยู่จะใช้ผลร่วมกัน
+    # ระหว่างรอ API ให้อุ่น connection ไปยัง CDN ที่คาดว่าจะใช้ไว้ก่อน
+    warm_up_cdn()
+    result, _ = job_flights.do(
+        ("playurl", aid, require_video),
+        lambda report: fetch_playurl(aid, require_video=require_video, cancel_token=cancel_token),
+        should_stop=cancel_token.is_cancelled if cancel_token else None
+    )
+    urls = [result.video_url] + [track.url for track in result.audio_tracks or []] + result.video_segments[1:]
+    remember_cdn_hosts(urls)
+    # ถ้า API ชี้ไป host ที่ไม่ได้อุ่นไว้ ก็ยังเริ่ม handshake ได้ก่อนเรียก download
+    warm_up_cdn(urls, connections=1)
+    return result
+
+def get_bilibili_urls(video_url):
+    try:
+        # ดึง aid จาก URL
+        aid = extract_aid_from_url(video_url)
+        if not aid:
+            raise JobInputError("ไม่สามารถดึง aid จาก URL ได้")
+
+        result = resolve_playurl(aid)
+        if result.segmented:
+            # ช่องดาวน์โหลดแยกรับได้แค่ไฟล์เดียวต่อช่อง
+            raise ValueError(f"วิดีโอนี้แบ่งเป็น {len(result.video_segments)} ส่วน "
+                             "กรุณาใช้โหมดดาวน์โหลดและรวมไฟล์อัตโนมัติ")
+
+        print("Final Video URL:", result.video_url)
+        print("Final Audio URL:", result.audio_url)
+
+        return result.video_url, result.audio_url
+
+    except PlayurlError as e:
+        # คง code/retry_after ไว้ให้ผู้เรียกตัดสินใจได้ว่าจะลองใหม่หรือไม่
+        print("Error:", str(e))
+        raise
+    except Exception as e:
+        print("Error:", str(e))
+        raise Exception(f"เกิดข้อผิดพลาดในการดึงข้อมูล: {str(e)}")
+
+def collect_aids(sources, session=None):
+    # sources เป็น URL เดียวหรือรายการ URL ก็ได้
+    # URL ที่ไม่มี /video/<aid> ถือเป็นหน้า season/playlist และจะโหลดหน้ามาหา aid ทั้งหมด
+    if isinstance(sources, str):
+        sources = [sources]
+    aids = []
+    seen = set()
+    for source in sources:
+        source = source.strip()
+        if not source:
+            continue
+        aid = extract_aid_from_url(source)
+        if aid:
+            found = [aid]
+        else:
+            getter = session.get if session is not None else requests.get
+            response = getter(source, headers=BILIBILI_HEADERS)
+            response.raise_for_status()
+            found = extract_aids_from_page(response.text)
+        for aid in found:
+            if aid not in seen:
+                seen.add(aid)
+                aids.append(aid)
+    return aids
+
+def resolve_bilibili_urls(sources, max_in_flight=8, session=None, limiter=None, warm_up=True):
+    # ดึง URL ของหลาย aid พร้อมกัน โดยมีคำขอค้างอยู่ไม่เกิน max_in_flight
+    # และเว้นจังหวะตามอัตราที่ limiter เรียนรู้ได้
+    # คืนค่า PlayurlResult ตามลำดับ aid เสมอ aid ที่ผิดพลาดจะมี error แทนการ raise
+    own_session = session is None
+    if own_session:
+        session = create_session(max_in_flight)
+    try:
+        aids = collect_aids(sources, session)
+        if not aids:
+            return []
+        warmed = set()
+        warmed_lock = threading.Lock()
+
+        def resolve(aid):
+            try:
+                result = fetch_playurl(aid, session, limiter)
+            except Exception as e:
+                return PlayurlResult(aid, error=str(e))
+            # งานในคิวถัด ๆ ไปจะดาวน์โหลดจาก host เหล่านี้ อุ่น connection ไว้เลย
+            if warm_up:
+                hosts = [url for url in (result.video_url, result.audio_url) if url]
+                with warmed_lock:
+                    new_hosts = [url for url in hosts if urllib.parse.urlsplit(url).netloc not in warmed]
+                    warmed.update(urllib.parse.urlsplit(url).netloc for url in new_hosts)
+                remember_cdn_hosts(hosts)
+                warm_up_cdn(new_hosts)
+            return result
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_in_flight, len(aids)))) as pool:
+            return list(pool.map(resolve, aids))
+    finally:
+        if own_session:
+            session.close()
+
+def resource_path(relative_path):
+    """ Get absolute path to resource, works for dev and for PyInstaller """
+    try:
+        # PyInstaller creates a temp folder and stores path in _MEIPASS
+        base_path = sys._MEIPASS
+    except Exception:
+        base_path = os.path.abspath(".")
+    
+    return os.path.join(base_path, relative_path)
+
+_FFMPEG_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+_FFMPEG_TIME_RE = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
+
+def _ffmpeg_seconds(match):
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+# ขนาด moov ต่อ sample โดยประมาณ (stsz + ctts + stco/stsc + stss) ที่วัดจริงราว 10-12 ไบต์
+# เผื่อไว้ราวสองเท่า ถ้ายังไม่พอ merge_files จะถอยไปใช้ +faststart
+MOOV_BYTES_PER_SAMPLE = 20
+MOOV_BASE_SIZE = 64 * 1024
+
+def iter_file_boxes(f, offset=0, end=None):
+    # เหมือน iter_mp4_boxes แต่อ่านเฉพาะ header จากไฟล์ ไม่ต้องโหลด mdat ทั้งก้อนเข้าหน่วยความจำ
+    end = os.fstat(f.fileno()).st_size if end is None else end
+    while offset + 8 <= end:
+        f.seek(offset)
+        header_data = f.read(16)
+        if len(header_data) < 8:
+            return
+        size, box_type = struct.unpack_from(">I4s", header_data)
+        header = 8
+        if size == 1:
+            if len(header_data) < 16:
+                return
+            size = struct.unpack_from(">Q", header_data, 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            raise ValueError("โครงสร้างไฟล์ MP4 ไม่ถูกต้อง")
+        yield box_type.decode("latin-1"), offset, size, header
+        offset += size
+
+def count_mp4_samples(path):
+    # นับจำนวน sample ทุก track จาก stsz (MP4 ปกติ) หรือ trun ใน moof (fragmented MP4 แบบ .m4s)
+    total = 0
+    with open(path, 'rb') as f:
+        for box_type, start, size, header in iter_file_boxes(f):
+            if box_type not in ("moov", "moof"):
+                continue
+            f.seek(start)
+            data = f.read(size)
+            if box_type == "moov":
+                for child, child_start, child_size, child_header in iter_mp4_boxes(data, header):
+                    if child != "trak":
+                        continue
+                    stsz = find_mp4_box(data, ["mdia", "minf", "stbl", "stsz"],
+                                        child_start + child_header, child_start + child_size)
+                    if stsz:
+                        total += struct.unpack_from(">I", data, stsz[0] + stsz[2] + 8)[0]
+            else:
+                for child, child_start, child_size, child_header in iter_mp4_boxes(data, header):
+                    if child != "traf":
+                        continue
+                    for grandchild, trun_start, _, trun_header in iter_mp4_boxes(
+                            data, child_start + child_header, child_start + child_size):
+                        if grandchild == "trun":
+                            total += struct.unpack_from(">I", data, trun_start + trun_header + 4)[0]
+    return total
+
+def estimate_moov_size(sample_count, margin=1.1):
+    return int((MOOV_BASE_SIZE + sample_count * MOOV_BYTES_PER_SAMPLE) * margin)
+
+def moov_at_start(path):
+    # faststart สำเร็จเมื่อ moov มาก่อน mdat
+    with open(path, 'rb') as f:
+        for box_type, _, _, _ in iter_file_boxes(f):
+            if box_type == "moov":
+                return True
+            if box_type == "mdat":
+                return False
+    return False
+
+OUTPUT_FORMAT_MP4 = "mp4"
+OUTPUT_FORMAT_HLS = "hls"
+OUTPUT_FORMAT_DASH = "dash"
+SEGMENT_SECONDS = 6
+MERGE_OUTPUT_FILTER = "MP4 files (*.mp4);;HLS playlist (*.m3u8);;DASH/CMAF manifest (*.mpd)"
+
+def output_format_for(path):
+    # เลือกรูปแบบจากนามสกุลไฟล์ผลลัพธ์: .m3u8 คือ HLS, .mpd คือ DASH (CMAF) นอกนั้นเป็น MP4 ไฟล์เดียว
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".m3u8":
+        return OUTPUT_FORMAT_HLS
+    if extension == ".mpd":
+        return OUTPUT_FORMAT_DASH
+    return OUTPUT_FORMAT_MP4
+
+def output_files(path):
+    # ไฟล์ทั้งหมดของผลลัพธ์หนึ่ง: MP4 คือไฟล์เดียว HLS/DASH คือ playlist กับไฟล์ init/segment ข้าง ๆ
+    # ตามชื่อที่ build_merge_command ตั้ง ใช้นับพื้นที่และลบให้ครบทั้งชุด
+    output_format = output_format_for(path)
+    if output_format == OUTPUT_FORMAT_MP4 or os.path.isdir(path):
+        return [path]
+    stem = re.escape(os.path.splitext(os.path.basename(path))[0])
+    if output_format == OUTPUT_FORMAT_HLS:
+        pattern = re.compile(rf"{stem}_(?:init\.mp4|\d{{5,}}\.m4s)")
+    else:
+        pattern = re.compile(rf"{stem}_(?:init_\d+|\d+_\d{{5,}})\.m4s")
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        names = []
+    return [path] + [os.path.join(directory, name) for name in names if pattern.fullmatch(name)]
+
+def write_concat_list(paths, list_path, durations=None):
+    # รายการสำหรับ concat demuxer ระบุ duration ด้วยถ้ารู้ ffmpeg จึงรู้ความยาวรวมและรายงานความคืบหน้าได้
+    durations = durations or [None] * len(paths)
+    with open(list_path, 'w', encoding='utf-8') as f:
+        f.write("ffconcat version 1.0\n")
+        for path, duration in zip(paths, durations):
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+            if duration:
+                f.write(f"duration {duration:.3f}\n")
+    return list_path
+
+def build_merge_command(video_path, audio_path, output_path, output_format=None, segment_seconds=SEGMENT_SECONDS,
+                        moov_size=None, faststart=False, audio_languages=None, concat_input=False):
+    # HLS/DASH ตัด segment แบบ fragmented MP4 ในรอบเดียวกับการรวมไฟล์ ไม่ต้องอ่าน/เขียน MP4 ซ้ำอีกรอบ
+    # ไฟล์ init และ segment ถูกเขียนไว้ข้าง playlist โดยขึ้นต้นด้วยชื่อ playlist จึงเก็บหลายตอนไว้ในโฟลเดอร์เดียวกันได้
+    # audio_path เป็น list ได้ (หลายภาษา) ทุกแทร็กถูก copy เข้าไฟล์เดียวในรอบเดียว อ่านวิดีโอครั้งเดียว
+    # audio_path เป็น None ได้เมื่อวิดีโอมีเสียงในตัว (durl) concat_input คือ video_path เป็นรายการของ concat demuxer
+    output_format = output_format or output_format_for(output_path)
+    if audio_path is None:
+        audio_paths = []
+    else:
+        audio_paths = [audio_path] if isinstance(audio_path, str) else list(audio_path)
+    if len(audio_paths) > 1 and output_format == OUTPUT_FORMAT_HLS:
+        raise JobInputError("HLS ยังไม่รองรับเสียงหลายภาษาในไฟล์เดียว ใช้ .mp4 หรือ .mpd แทน")
+    command = ['ffmpeg']
+    if concat_input:
+        command += ['-f', 'concat', '-safe', '0']
+    command += ['-i', video_path]
+    for path in audio_paths:
+        command += ['-i', path]
+    command += ['-c', 'copy']
+    if not audio_paths and output_format != OUTPUT_FORMAT_MP4:
+        command += ['-map', '0:v:0', '-map', '0:a:0?']
+    elif len(audio_paths) > 1 or audio_languages or output_format != OUTPUT_FORMAT_MP4:
+        command += ['-map', '0:v:0']
+        for index in range(len(audio_paths)):
+            command += ['-map', f'{index + 1}:a:0']
+        for index, language in enumerate(audio_languages or []):
+            command += [f'-metadata:s:a:{index}', f'language={language}',
+                        f'-disposition:a:{index}', 'default' if index == 0 else '0']
+    stem = os.path.splitext(os.path.basename(output_path))[0]
+    if output_format == OUTPUT_FORMAT_HLS:
+        command += [
+            '-f', 'hls',
+            '-hls_time', str(segment_seconds),
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_type', 'fmp4',
+            '-hls_flags', 'independent_segments',
+            '-hls_fmp4_init_filename', f"{stem}_init.mp4",
+            '-hls_segment_filename', os.path.join(os.path.dirname(output_path), f"{stem}_%05d.m4s"),
+        ]
+    elif output_format == OUTPUT_FORMAT_DASH:
+        command += [
+            '-f', 'dash',
+            '-seg_duration', str(segment_seconds),
+            '-use_template', '1',
+            '-use_timeline', '1',
+            '-init_seg_name', f"{stem}_init_$RepresentationID$.m4s",
+            '-media_seg_name', f"{stem}_$RepresentationID$_$Number%05d$.m4s",
+        ]
+    elif moov_size:
+        # จองพื้นที่ moov ไว้ต้นไฟล์ตั้งแต่แรก ไฟล์จึงเป็น faststart ในรอบเดียว
+        command += ['-moov_size', str(moov_size)]
+    elif faststart:
+        # ประเมินขนาดไม่ได้: ให้ ffmpeg ย้าย moov มาไว้ต้นไฟล์ตอนจบ (อ่าน/เขียนไฟล์ซ้ำอีกรอบ)
+        command += ['-movflags', '+faststart']
+    command += [
+        '-y',  # ให้เขียนทับไฟล์ที่มีอยู่
+        output_path
+    ]
+    return command
+
+def terminate_process(process, grace=2.0):
+    # ขอให้ ffmpeg หยุดก่อน ถ้าไม่หยุดภายในเวลาที่กำหนดจึง kill
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(grace)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def run_ffmpeg(command, progress_callback=None, process_callback=None, cancel_token=None):
+    # รัน ffmpeg และอ่าน stderr ทีละบรรทัดเพื่อคำนวณความคืบหน้าจาก Duration/time=
+    if cancel_token:
+        cancel_token.raise_if_cancelled()
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if process_callback:
+        process_callback(process)
+    unregister = None
+    if cancel_token:
+        unregister = cancel_token.on_cancel(
+            lambda: threading.Thread(target=terminate_process, args=(process,), daemon=True).start()
+        )
+
+    duration = None
+    last_lines = collections.deque(maxlen=20)
+    # universal_newlines ทำให้ \r ของบรรทัดสถานะถูกแยกเป็นบรรทัดด้วย
+    for line in process.stderr:
+        last_lines.append(line.rstrip())
+        if duration is None:
+            match = _FFMPEG_DURATION_RE.search(line)
+            if match:
+                duration = _ffmpeg_seconds(match)
+                continue
+        if progress_callback and duration:
+            match = _FFMPEG_TIME_RE.search(line)
+            if match:
+                progress_callback(min(100.0, _ffmpeg_seconds(match) / duration * 100))
+
+    process.wait()
+    if unregister:
+        unregister()
+    if cancel_token and cancel_token.is_cancelled():
+        raise Cancelled("ยกเลิกการรวมไฟล์")
+    if process.returncode != 0:
+        raise Exception("FFmpeg error: " + "\n".join(last_lines))
+
+def merge_moov_size(video_path, audio_path):
+    video_paths = [video_path] if isinstance(video_path, str) else video_path
+    audio_paths = [audio_path] if isinstance(audio_path, str) else (audio_path or [])
+    try:
+        # นับ sample ได้เฉพาะ MP4 ส่วน durl มักเป็น FLV ซึ่งนับได้ 0 จนจองที่ไม่พอและต้องรวมใหม่อีกรอบ
+        # จึงให้ใช้ +faststart ตั้งแต่แรก
+        if not all(is_mp4_container(path) for path in video_paths + audio_paths):
+            return None
+        samples = sum(count_mp4_samples(path) for path in video_paths + audio_paths)
+        return estimate_moov_size(samples) if samples else None
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Cannot estimate moov size: {str(e)}")
+        return None
+
+def merge_files(video_path, audio_path, output_path, progress_callback=None, cancel_token=None,
+                faststart=True, process_callback=None, audio_languages=None, segment_durations=None):
+    # video_path เป็น list ได้ (durl หลายส่วน): ต่อกันด้วย concat demuxer แบบ stream copy ในรอบเดียวกับการ mux
+    try:
+        print(f"Video path: {video_path}")
+        print(f"Audio path: {audio_path}")
+        print(f"Output path: {output_path}")
+        
+        if output_format_for(output_path) != OUTPUT_FORMAT_MP4:
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+        moov_size = None
+        if faststart and output_format_for(output_path) == OUTPUT_FORMAT_MP4:
+            moov_size = merge_moov_size(video_path, audio_path)
+
+        concat_input = not isinstance(video_path, str)
+        if concat_input:
+            video_path = write_concat_list(video_path, os.path.join(os.path.dirname(os.path.abspath(video_path[0])),
+                                                                    "concat.ffconcat"), segment_durations)
+
+        # ใช้ subprocess เรียก ffmpeg โดยตรง ทีละงานต่อดิสก์ปลายทาง (ดู DISK_HEAVY_WRITERS)
+        command = build_merge_command(video_path, audio_path, output_path, moov_size=moov_size, faststart=faststart,
+                                      audio_languages=audio_languages, concat_input=concat_input)
+        with disk_scheduler.heavy_writer(output_path, cancel_token):
+            try:
+                run_ffmpeg(command, progress_callback, process_callback, cancel_token)
+            except Cancelled:
+                raise
+            except Exception as e:
+                if not moov_size or "reserved_moov_size is too small" not in str(e):
+                    raise
+                # ประเมินขนาด moov ต่ำไป ใช้ +faststart แทน
+                print(f"Reserved moov of {moov_size} bytes too small, falling back to +faststart")
+                command = build_merge_command(video_path, audio_path, output_path, faststart=True,
+                                              audio_languages=audio_languages, concat_input=concat_input)
+                run_ffmpeg(command, progress_callback, process_callback, cancel_token)
+            
+    except Cancelled:
+        raise
+    except Exception as e:
+        print(f"Error in merge_files: {str(e)}")
+        raise Exception(f"เกิดข้อผิดพลาดในการรวมไฟล์: {str(e)}")
+
+class _MoviepyProgressLogger(ProgressBarLogger):
+    # ส่งความคืบหน้าของ write_videofile (แถบ 't' คือเฟรมวิดีโอ) ออกเป็นเปอร์เซ็นต์
+    def __init__(self, progress_callback):
+        super().__init__()
+        self.progress_callback = progress_callback
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if bar == 't' and attr == 'index':
+            total = self.bars[bar].get('total')
+            if total:
+                self.progress_callback(min(100.0, value / total * 100))
+
+def transcode_files(video_path, audio_path, output_path, progress_callback=None, faststart=True):
+    # เข้ารหัสใหม่ด้วย libx264 แบบเดียวกับ merge_video_audio ใน main.py
+    logger = _MoviepyProgressLogger(progress_callback) if progress_callback else None
+    video_clip = VideoFileClip(video_path)
+    audio_clip = AudioFileClip(audio_path)
+    try:
+        video_clip = video_clip.set_audio(audio_clip)
+        ffmpeg_params = None
+        if faststart:
+            # moviepy ส่งเฟรมผ่าน pipe จึงรู้จำนวน sample ล่วงหน้าจากความยาวและ fps
+            samples = int(video_clip.duration * video_clip.fps) + int(video_clip.duration * 48000 / 1024) + 2
+            ffmpeg_params = ['-moov_size', str(estimate_moov_size(samples, margin=1.5))]
+        video_clip.write_videofile(output_path, codec="libx264", audio_codec="aac", audio_bitrate="111k", audio_fps=48000,
+                                   ffmpeg_params=ffmpeg_params, logger=logger)
+    finally:
+        video_clip.close()
+        audio_clip.close()
+    if faststart and not moov_at_start(output_path):
+        # moviepy ไม่ตรวจ error ตอน ffmpeg เขียน trailer ถ้าพื้นที่ที่จองไว้ไม่พอจะได้ moov ท้ายไฟล์
+        # แก้ด้วยการ remux แบบ copy ไม่ต้องเข้ารหัสใหม่
+        temp_path = output_path + ".faststart.mp4"
+        run_ffmpeg(['ffmpeg', '-i', output_path, '-c', 'copy', '-movflags', '+faststart', '-y', temp_path])
+        os.replace(temp_path, output_path)
+
+# ชื่ออัลกอริทึมใน header ของเซิร์ฟเวอร์ -> ชื่อใน hashlib
+CHECKSUM_ALGORITHMS = {"md5": "md5", "sha-256": "sha256", "sha-512": "sha512"}
+
+def parse_digest_header(value):
+    # รองรับทั้ง "sha-256=:base64:" (Repr-Digest/Content-Digest) และ "MD5=base64" (Digest, x-goog-hash)
+    checksums = {}
+    for item in value.split(","):
+        name, sep, encoded = item.strip().partition("=")
+        algorithm = CHECKSUM_ALGORITHMS.get(name.strip().lower())
+        if not sep or algorithm is None:
+            continue
+        try:
+            checksums[algorithm] = base64.b64decode(encoded.strip().strip(":"), validate=True)
+        except (binascii.Error, ValueError):
+            continue
+    return checksums
+
+def server_checksums(response, whole_body):
+    # Repr-Digest/Digest หมายถึงทั้งไฟล์เสมอ ส่วน Content-* และ x-goog-hash หมายถึงเฉพาะ body ที่ส่งมา
+    # จึงใช้ได้เมื่อ body คือทั้งไฟล์ (ไม่ใช่การดาวน์โหลดต่อด้วย Range)
+    checksums = {}
+    for header in ("Repr-Digest", "Digest"):
+        if header in response.headers:
+            checksums.update(parse_digest_header(response.headers[header]))
+    if whole_body:
+        for header in ("Content-Digest", "X-Goog-Hash"):
+            if header in response.headers:
+                checksums.update(parse_digest_header(response.headers[header]))
+        if "Content-MD5" in response.headers:
+            checksums.update(parse_digest_header("md5=" + response.headers["Content-MD5"]))
+    return checksums
+
+def range_total(response):
+    # ขนาดไฟล์ทั้งหมดจาก Content-Range: bytes 100-199/1000
+    match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+class TransferSlot:
+    # ตัวแทนของไฟล์หนึ่งที่กำลังดาวน์โหลด ใช้ขอจำนวน connection จาก ConnectionController
+    # background คืองานที่ไม่มีใครรอ (prefetch) ได้ connection เฉพาะตอนไม่มีงานปกติ
+    def __init__(self, controller, background=False):
+        self.controller = controller
+        self.background = background
+        self.connections = 0
+        # จำนวน connection ที่ไฟล์นี้ใช้ประโยชน์ได้ (segment ที่ยังเหลือ)
+        self.demand = 1
+
+    def allowed(self):
+        return self.controller.allowed(self)
+
+    def wait_until_allowed(self, cancel_token=None, poll=0.2):
+        # งานเบื้องหลังหยุดรอจนกว่าแบนด์วิดท์จะว่าง
+        while self.allowed() == 0:
+            sleep_or_cancel(poll, cancel_token)
+
+    def acquire(self):
+        self.controller._set_connections(self, +1)
+
+    def release(self):
+        self.controller._set_connections(self, -1)
+
+    def close(self):
+        self.controller._close(self)
+
+class ConnectionController:
+    # คุมจำนวน connection รวมของทุกการดาวน์โหลดด้วย AIMD
+    # ทุกช่วง interval วัด goodput รวม, throughput ต่อ connection และอัตรา error/reset
+    # - มี throttle (429/503) หรือ error เกิน 5%: ลดงบครึ่งหนึ่ง
+    # - goodput รวมตกแรงทั้งที่ใช้ connection เท่าเดิม (CDN ลงโทษการเปิดหลาย connection): ลดงบครึ่งหนึ่ง
+    # - ลองเพิ่มงบ (probe) แล้ว goodput เพิ่ม: เพิ่มต่อ (ช่วงแรก slow start เพิ่มเป็นสองเท่าจนกว่าจะเจอเพดาน)
+    # - ลองเพิ่มแล้วไม่ได้อะไร (ท่อเต็มแล้ว): ถอยกลับแล้วค้างไว้สักพักก่อน probe ใหม่
+    # งบถูกแบ่งให้แต่ละไฟล์แบบ water-filling ตาม demand ไฟล์ที่ใช้ไม่หมดจะเหลือให้ไฟล์อื่น
+    def __init__(self, initial=4, min_connections=1, max_connections=16, interval=1.0):
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.interval = interval
+        self.budget = float(initial)
+        self.goodput = 0.0
+        self._lock = threading.Lock()
+        self._transfers = []
+        self._best_goodput = 0.0
+        self._hold = 0
+        self._slow_start = True
+        self._probing = True
+        self._last_step = 0
+        self._cooldown = False
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_requests = 0
+        self._window_errors = 0
+        self._window_throttled = False
+        self._connection_samples = 0
+        self._connection_sum = 0
+
+    def open_transfer(self, background=False):
+        slot = TransferSlot(self, background)
+        with self._lock:
+            self._transfers.append(slot)
+            # ชุดงานเปลี่ยน goodput เดิมเทียบกันไม่ได้แล้ว
+            self._best_goodput = 0.0
+        return slot
+
+    def _close(self, slot):
+        with self._lock:
+            if slot in self._transfers:
+                self._transfers.remove(slot)
+                self._best_goodput = 0.0
+
+    def _set_connections(self, slot, delta):
+        with self._lock:
+            slot.connections += delta
+
+    def allowed(self, slot):
+        with self._lock:
+            return self._shares().get(slot, 0 if slot.background else 1)
+
+    def _shares(self):
+        foreground = [slot for slot in self._transfers if not slot.background]
+        background = [slot for slot in self._transfers if slot.background]
+        if foreground:
+            # มีงานที่ผู้ใช้รออยู่: งานเบื้องหลังหยุดเปิด connection ใหม่ทั้งหมด
+            shares = self._fill(foreground)
+            shares.update((slot, 0) for slot in background)
+            return shares
+        return self._fill(background)
+
+    def _fill(self, transfers):
+        # water-filling: ไฟล์ที่ต้องการน้อยได้เท่าที่ต้องการ ที่เหลือแบ่งเท่า ๆ กัน ทุกไฟล์ได้อย่างน้อย 1
+        remaining = max(int(self.budget), len(transfers))
+        shares = {}
+        pending = sorted(transfers, key=lambda slot: slot.demand)
+        while pending:
+            slot = pending.pop(0)
+            share = max(1, min(slot.demand, remaining // (len(pending) + 1)))
+            shares[slot] = share
+            remaining -= share
+        return shares
+
+    def record_request(self, ok=True, throttled=False):
+        with self._lock:
+            self._window_requests += 1
+            if not ok:
+                self._window_errors += 1
+            if throttled:
+                self._window_throttled = True
+            self._maybe_adjust(time.monotonic())
+
+    def record(self, nbytes):
+        with self._lock:
+            self._window_bytes += nbytes
+            self._connection_samples += 1
+            self._connection_sum += sum(slot.connections for slot in self._transfers)
+            self._maybe_adjust(time.monotonic())
+
+    def _maybe_adjust(self, now):
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return
+        goodput = self._window_bytes / elapsed
+        connections = self._connection_sum / self._connection_samples if self._connection_samples else 0
+        error_rate = self._window_errors / self._window_requests if self._window_requests else 0
+        self.goodput = goodput
+
+        if self._cooldown:
+            # หน้าต่างแรกหลังลดงบยังมีคำขอค้างจากงบเดิม ไม่นับซ้ำ
+            self._cooldown = False
+        elif self._window_throttled or (self._window_errors and error_rate >= 0.05):
+            self._decrease(goodput)
+        elif connections < int(self.budget) - 0.5:
+            # ใช้งบไม่เต็ม (มีงานน้อย) วัดไม่ได้ว่างบพอดีหรือยัง
+            pass
+        elif self._best_goodput and goodput < self._best_goodput * 0.6:
+            self._decrease(goodput)
+        elif self._hold > 0:
+            self._hold -= 1
+        elif not self._probing:
+            # ค้างมาพักหนึ่งแล้ว ลองเพิ่มอีก 1 เผื่อเส้นทางว่างขึ้น
+            self._probe(goodput, 1)
+        elif goodput >= self._best_goodput * 1.05:
+            self._probe(goodput, self.budget if self._slow_start else 1)
+        else:
+            # probe ล่าสุดไม่ได้ goodput เพิ่ม ถอยกลับไปจุดก่อนหน้าแล้วค้างไว้
+            self.budget = max(self.min_connections, self.budget - max(1, self._last_step / 2))
+            self._best_goodput = goodput
+            self._hold = 5
+            self._probing = False
+            self._slow_start = False
+        self._reset_window(now)
+
+    def _probe(self, goodput, step):
+        self._best_goodput = goodput
+        self._last_step = min(step, self.max_connections - self.budget)
+        self.budget += self._last_step
+        self._probing = True
+
+    def _decrease(self, goodput):
+        self.budget = max(self.min_connections, self.budget / 2)
+        self._best_goodput = goodput
+        self._hold = 3
+        self._probing = False
+        self._slow_start = False
+        self._cooldown = True
+
+    def state(self):
+        with self._lock:
+            return {
+                "budget": int(self.budget),
+                "goodput": self.goodput,
+                "transfers": len(self._transfers),
+                "connections": sum(slot.connections for slot in self._transfers),
+            }
+
+# ทุกการดาวน์โหลดจาก CDN ใช้งบ connection ร่วมกัน
+connection_controller = ConnectionController()
+
+# เส้นทางขาออก: ล้มเหลวติดกันกี่ครั้งจึงพักไว้, ช้ากว่าเส้นทางที่เร็วที่สุดเท่าไรจึงถือว่าช้า
+EGRESS_MAX_FAILURES = 3
+EGRESS_SLOW_RATIO = 0.3
+EGRESS_MIN_SAMPLES = 3
+# วัด throughput เฉพาะคำขอที่ได้ข้อมูลมากพอ คำขอเล็ก ๆ มีแต่เวลา handshake
+EGRESS_MIN_SAMPLE_BYTES = 256 * 1024
+EGRESS_COOLDOWN = 30.0
+EGRESS_MAX_COOLDOWN = 600.0
+EGRESS_PROBE_TIMEOUT = (5, 10)
+
+class EgressRoute:
+    # เส้นทางขาออกหนึ่งเส้น: ผ่าน proxy, ผูก IP ต้นทาง หรือออกตรง
+    # แต่ละเส้นทางมี session (และ connection pool) ของตัวเอง
+    def __init__(self, name, proxy=None, source_address=None, session=None, pool_size=16):
+        self.name = name
+        self.proxy = proxy
+        self.source_address = source_address
+        self.session = session or create_session(pool_size, proxy=proxy, source_address=source_address)
+        self.throughput = None
+        self.samples = 0
+        self.in_flight = 0
+        self.failures = 0
+        self.disabled_until = 0.0
+        self.cooldown = EGRESS_COOLDOWN
+        self.probing = False
+        self.last_error = None
+
+    def state(self, now):
+        return {
+            "name": self.name,
+            "healthy": self.disabled_until <= now and not self.probing,
+            "throughput": self.throughput,
+            "in_flight": self.in_flight,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+EGRESS_PROXY_SCHEMES = {"http", "https", "socks4", "socks4a", "socks5", "socks5h"}
+
+def parse_egress_route(item):
+    if item == "direct":
+        return EgressRoute("direct", session=cdn_session)
+    if "://" in item:
+        parts = urllib.parse.urlsplit(item)
+        if parts.scheme not in EGRESS_PROXY_SCHEMES or not parts.hostname:
+            raise ValueError(f"unsupported proxy URL {item!r}")
+        parts.port  # พอร์ตที่ไม่ใช่ตัวเลขจะ raise ValueError ที่นี่ ไม่ใช่ตอนดาวน์โหลด
+        if parts.scheme.startswith("socks"):
+            try:
+                import socks  # PySocks จาก requests[socks]
+            except ImportError:
+                raise ValueError(f"{item!r} needs PySocks (pip install requests[socks])") from None
+        return EgressRoute(item, proxy=item)
+    socket.inet_pton(socket.AF_INET6 if ":" in item else socket.AF_INET, item)
+    return EgressRoute(f"bind:{item}", source_address=item)
+
+def parse_egress_routes(spec):
+    # "direct", URL ของ proxy (http://, socks5:// ...) หรือ IP ต้นทาง คั่นด้วย , หรือช่องว่าง
+    # รายการที่ใช้ไม่ได้ถูกข้ามไป ค่าผิดใน BILIBILI_EGRESS ต้องไม่ทำให้โปรแกรมเปิดไม่ขึ้น
+    routes = []
+    for item in re.split(r"[,\s]+", spec or ""):
+        if not item:
+            continue
+        try:
+            routes.append(parse_egress_route(item))
+        except (ValueError, OSError) as e:
+            print(f"Egress: skipping route {item!r}: {str(e)}")
+    return routes or [EgressRoute("direct", session=cdn_session)]
+
+class EgressPool:
+    # กระจายคำขอ (รวมถึงแต่ละ segment ของไฟล์เดียวกัน) ไปยังหลายเส้นทางขาออก
+    # CDN จำกัดแบนด์วิดท์ต่อ IP ลูกค้า หลายเส้นทางจึงได้แบนด์วิดท์รวมมากกว่า
+    # - เลือกเส้นทางที่ (คำขอค้าง + 1) / throughput ต่อ connection น้อยที่สุด เส้นทางที่ยังไม่เคยวัดได้ค่าเฉลี่ย
+    # - ล้มเหลวติดกัน EGRESS_MAX_FAILURES ครั้ง หรือช้ากว่าเส้นทางที่เร็วที่สุดมาก: พักไว้ตาม cooldown
+    # - ครบ cooldown แล้วส่งคำขอเล็ก ๆ ตรวจก่อน ผ่านจึงรับงานจริงอีกครั้ง (cooldown เพิ่มเท่าตัวทุกครั้งที่ถูกพัก)
+    # เส้นทางสุดท้ายที่เหลือจะไม่ถูกพัก งานจึงไม่หยุดเพราะเส้นทางทั้งหมดมีปัญหาพร้อมกัน
+    def __init__(self, routes=None):
+        self._lock = threading.Lock()
+        self.routes = list(routes) if routes else parse_egress_routes(None)
+
+    def set_routes(self, routes):
+        with self._lock:
+            self.routes = list(routes)
+
+    def pick(self, url=None, avoid=None):
+        with self._lock:
+            now = time.monotonic()
+            if url:
+                self._start_probes(url, now)
+            healthy = [route for route in self.routes if route.disabled_until <= now and not route.probing]
+            if not healthy:
+                healthy = [min(self.routes, key=lambda route: route.disabled_until)]
+            if avoid is not None and len(healthy) > 1 and avoid in healthy:
+                # segment ที่เพิ่งล้มเหลวบนเส้นทางนี้ลองเส้นทางอื่นก่อน
+                healthy.remove(avoid)
+            known = [route.throughput for route in healthy if route.throughput]
+            default = sum(known) / len(known) if known else 1.0
+            route = min(healthy, key=lambda r: (r.in_flight + 1) / (r.throughput or default))
+            route.in_flight += 1
+            return route
+
+    def report(self, route, nbytes=0, seconds=0.0, ok=True, error=None):
+        # ทุก pick ต้องตามด้วย report หนึ่งครั้ง ถูกยกเลิกกลางทางให้รายงาน ok=True โดยไม่มีข้อมูล
+        with self._lock:
+            route.in_flight -= 1
+            if not ok:
+                route.failures += 1
+                route.last_error = str(error) if error else None
+                if route.failures >= EGRESS_MAX_FAILURES:
+                    self._disable(route, f"ล้มเหลวติดกัน {route.failures} ครั้ง")
+                return
+            route.failures = 0
+            if seconds <= 0 or (nbytes < EGRESS_MIN_SAMPLE_BYTES and seconds < 1.0):
+                # คำขอเล็กที่เสร็จเร็วมีแต่เวลา handshake ส่วนคำขอที่ใช้เวลานานแต่ได้น้อยคือเส้นทางช้าจริง
+                return
+            rate = nbytes / seconds
+            route.throughput = rate if route.throughput is None else route.throughput * 0.7 + rate * 0.3
+            route.samples += 1
+            if route.samples < EGRESS_MIN_SAMPLES:
+                return
+            others = [other.throughput for other in self.routes
+                      if other is not route and other.samples >= EGRESS_MIN_SAMPLES
+                      and other.disabled_until <= time.monotonic()]
+            if others and route.throughput < max(others) * EGRESS_SLOW_RATIO:
+                self._disable(route, f"ช้า ({route.throughput / 1024:.0f} KB/s)")
+            else:
+                route.cooldown = EGRESS_COOLDOWN
+
+    def _disable(self, route, reason):
+        now = time.monotonic()
+        if route.disabled_until > now:
+            return
+        if not any(other.disabled_until <= now for other in self.routes if other is not route):
+            return
+        print(f"Egress route {route.name} disabled for {route.cooldown:.0f}s: {reason}")
+        route.disabled_until = now + route.cooldown
+        route.cooldown = min(route.cooldown * 2, EGRESS_MAX_COOLDOWN)
+
+    def _start_probes(self, url, now):
+        for route in self.routes:
+            if route.disabled_until and route.disabled_until <= now and not route.probing:
+                route.probing = True
+                threading.Thread(target=self._probe, args=(route, url), daemon=True).start()
+
+    def _probe(self, route, url):
+        # ตรวจสุขภาพด้วยคำขอ 1 ไบต์ผ่านเส้นทางนั้นไปยัง URL ที่กำลังใช้งานจริง
+        try:
+            response = route.session.get(url, stream=True, timeout=EGRESS_PROBE_TIMEOUT,
+                                         headers={"Accept-Encoding": "identity", "Range": "bytes=0-0"})
+            response.close()
+            ok = response.status_code < 400
+            error = None if ok else f"HTTP {response.status_code}"
+        except (RequestException, OSError) as e:
+            ok, error = False, e
+        with self._lock:
+            route.probing = False
+            if ok:
+                print(f"Egress route {route.name} is healthy again")
+                route.disabled_until = 0.0
+                route.failures = 0
+                route.throughput = None
+                route.samples = 0
+            else:
+                route.last_error = str(error)
+                route.disabled_until = time.monotonic() + route.cooldown
+                route.cooldown = min(route.cooldown * 2, EGRESS_MAX_COOLDOWN)
+
+    def state(self):
+        with self._lock:
+            now = time.monotonic()
+            return [route.state(now) for route in self.routes]
+
+# กำหนดเส้นทางขาออกได้ด้วย BILIBILI_EGRESS เช่น "direct,http://10.0.0.2:3128,192.168.1.20"
+egress_pool = EgressPool(parse_egress_routes(os.environ.get("BILIBILI_EGRESS")))
+
+# การเขียนลงดิสก์: ทุกไฟล์บน volume เดียวกันเขียนผ่าน thread เดียว รวมเป็นช่วงต่อเนื่องก้อนใหญ่
+# ไฟล์หนึ่งถูกเขียนเมื่อข้อมูลค้างถึง DISK_EXTENT_SIZE หรือค้างนานเกิน DISK_FLUSH_DELAY
+DISK_EXTENT_SIZE = 8 * 1024 * 1024
+DISK_FLUSH_DELAY = 0.5
+# ข้อมูลที่ยังไม่ถึงดิสก์ต่อ volume เกินนี้ผู้เขียนต้องรอ (ดาวน์โหลดช้าลงตามดิสก์)
+DISK_BUFFER_LIMIT = 64 * 1024 * 1024
+# งานที่เขียนไฟล์ใหญ่ทั้งไฟล์ (ffmpeg รวมไฟล์) พร้อมกันต่อ volume HDD/network share ทีละงาน
+DISK_HEAVY_WRITERS = 1
+DISK_HEAVY_WRITERS_SSD = 4
+
+def _existing_parent(path):
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+def volume_is_rotational(path):
+    # Linux: /sys/dev/block/<major>:<minor>/queue/rotational (พาร์ทิชันอยู่ใต้ดิสก์แม่)
+    # ระบบอื่นหรือ network share (ไม่มีอุปกรณ์ใน sysfs) คืน None
+    if not hasattr(os, "major"):
+        return None
+    device = os.stat(_existing_parent(os.path.abspath(path))).st_dev
+    base = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"
+    for candidate in (os.path.join(base, "queue", "rotational"), os.path.join(base, "..", "queue", "rotational")):
+        try:
+            with open(candidate) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return None
+
+class ScheduledFile:
+    # ไฟล์ที่เขียนผ่าน VolumeWriter: write/write_at แค่ฝากข้อมูลไว้แล้วคืนทันที
+    # ข้อผิดพลาดจากการเขียนจริง (เช่น ENOSPC) ถูก raise ในการเรียกครั้งถัดไปของผู้เขียน
+    # flush/close รอจนข้อมูลทั้งหมดถึงดิสก์ ไฟล์ .part จึงต่อเนื่องเมื่อถูกยกเลิก
+    def __init__(self, writer, path, mode='wb'):
+        self.writer = writer
+        self.path = path
+        if mode == 'ab':
+            # เขียนตาม offset เอง O_APPEND ใช้ไม่ได้
+            mode = 'r+b' if os.path.exists(path) else 'wb'
+        self._handle = open(path, mode, buffering=0)
+        self._position = self._handle.seek(0, os.SEEK_END)
+        # offset -> ข้อมูลที่ยังไม่ถึงดิสก์ (ยังอ่านได้ผ่าน read_pending)
+        self._pending = {}
+        self._bytes = 0
+        self._oldest = None
+        self._flushing = False
+        self._error = None
+        # offset ของก้อนที่ถูกทิ้งเพราะเขียนไม่สำเร็จ (ในไฟล์เป็นช่องว่าง ไม่ใช่ข้อมูลจริง)
+        self._lost = set()
+
+    @property
+    def error(self):
+        return self._error
+
+    def write(self, data):
+        self.write_at(self._position, data)
+        self._position += len(data)
+
+    def write_at(self, offset, data):
+        self.writer.submit(self, offset, bytes(data))
+
+    def read_pending(self, offset, start, end):
+        # ข้อมูลช่วง [start, end] จากก้อนที่เขียนไว้ที่ offset ถ้ายังไม่ถึงดิสก์ None ถ้าถึงแล้ว
+        # เขียนล้มเหลวไปแล้ว: raise แทนการปล่อยให้อ่านช่องว่างในไฟล์
+        with self.writer._cond:
+            data = self._pending.get(offset)
+            if data is None and self._error is not None:
+                raise self._error
+        return data[start - offset:end - offset + 1] if data is not None else None
+
+    def is_lost(self, offset):
+        with self.writer._cond:
+            return offset in self._lost
+
+    def flush(self):
+        self.writer.flush(self)
+
+    def truncate(self, size):
+        self.flush()
+        self._handle.truncate(size)
+
+    def close(self, truncate=None):
+        # truncate: ตัดไฟล์ที่ขนาดนี้ ทำแม้การเขียนจะล้มเหลว (เก็บไว้เฉพาะส่วนต้นที่ถึงดิสก์แล้ว)
+        try:
+            self.flush()
+        finally:
+            try:
+                if truncate is not None:
+                    self._handle.truncate(truncate)
+            finally:
+                self.writer.discard(self)
+                self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # กำลังออกเพราะข้อผิดพลาดอื่น: พยายามเขียนส่วนที่ได้มาแล้วให้ครบ แต่ไม่บังข้อผิดพลาดเดิม
+        try:
+            self.close()
+        except OSError:
+            pass
+
+class VolumeWriter:
+    # thread เขียนของ volume หนึ่ง เลือกไฟล์ที่ถึงเวลาเขียน (มีผู้รอ flush ก่อน แล้วจึงไฟล์ที่ค้างมากสุด)
+    # แล้วเขียนข้อมูลค้างทั้งหมดของไฟล์นั้นเรียงตาม offset ก้อนที่ติดกันรวมเป็น write เดียว
+    # ดิสก์จึงได้ช่วงต่อเนื่องยาวทีละไฟล์ แทน write เล็กๆ สลับไฟล์จากหลาย thread
+    def __init__(self, device, heavy_writers=DISK_HEAVY_WRITERS):
+        self.device = device
+        self.heavy_writers = heavy_writers
+        self._cond = threading.Condition()
+        self._files = set()
+        self._buffered = 0
+        self._heavy_running = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, file, offset, data):
+        with self._cond:
+            # ไฟล์ที่มีข้อมูลค้างอยู่แล้วต้องรอให้บัฟเฟอร์ลดลง ไฟล์ใหม่ได้ก้อนแรกเสมอ ไม่ให้ติดกันเอง
+            self._cond.wait_for(lambda: file._error or self._buffered < DISK_BUFFER_LIMIT or not file._pending)
+            if file._error is not None:
+                raise file._error
+            previous = file._pending.get(offset)
+            file._pending[offset] = data
+            delta = len(data) - (len(previous) if previous is not None else 0)
+            file._bytes += delta
+            self._buffered += delta
+            if file._oldest is None:
+                file._oldest = time.monotonic()
+            self._files.add(file)
+            self._cond.notify_all()
+
+    def flush(self, file):
+        with self._cond:
+            file._flushing = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: file._error or not file._pending)
+            file._flushing = False
+            if file._error is not None:
+                raise file._error
+
+    def discard(self, file):
+        with self._cond:
+            self._files.discard(file)
+            self._buffered -= file._bytes
+            file._pending.clear()
+            file._bytes = 0
+            self._cond.notify_all()
+
+    def _due(self):
+        # คืน (ไฟล์ที่ควรเขียนตอนนี้, เวลาที่ต้องรอถ้ายังไม่มี)
+        now = time.monotonic()
+        waiting = None
+        best = None
+        for file in self._files:
+            if file._flushing or file._bytes >= DISK_EXTENT_SIZE or now - file._oldest >= DISK_FLUSH_DELAY:
+                key = (file._flushing, file._bytes)
+                if best is None or key > best[0]:
+                    best = (key, file)
+            else:
+                remaining = DISK_FLUSH_DELAY - (now - file._oldest)
+                waiting = remaining if waiting is None else min(waiting, remaining)
+        if best is None and self._files and self._buffered >= DISK_BUFFER_LIMIT:
+            best = (None, max(self._files, key=lambda file: file._bytes))
+        return (best[1] if best else None), waiting
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    file, waiting = self._due()
+                    if file is not None:
+                        break
+                    self._cond.wait(waiting)
+                items = sorted(file._pending.items())
+            error = None
+            try:
+                extent_start, extent_end, extent = items[0][0], items[0][0], []
+                for offset, data in items:
+                    if offset != extent_end:
+                        self._write(file, extent_start, extent)
+                        extent_start, extent = offset, []
+                    extent.append(data)
+                    extent_end = offset + len(data)
+                self._write(file, extent_start, extent)
+            except (OSError, ValueError) as e:
+                error = e
+            with self._cond:
+                for offset, data in items:
+                    # ก้อนที่ถูกเขียนทับระหว่างนี้ยังค้างอยู่ รอบหน้าจะเขียนใหม่
+                    if file._pending.get(offset) is data:
+                        del file._pending[offset]
+                        file._bytes -= len(data)
+                        self._buffered -= len(data)
+                if error is not None:
+                    file._error = error
+                    # ทั้งชุดนี้ถือว่าไม่ถึงดิสก์ (extent ก่อนหน้าอาจเขียนได้แล้ว แต่ไม่รู้แน่)
+                    file._lost.update(offset for offset, data in items)
+                    file._lost.update(file._pending)
+                    self._buffered -= file._bytes
+                    file._pending.clear()
+                    file._bytes = 0
+                if not file._pending:
+                    self._files.discard(file)
+                    file._oldest = None
+                self._cond.notify_all()
+
+    @staticmethod
+    def _write(file, offset, parts):
+        data = parts[0] if len(parts) == 1 else b"".join(parts)
+        file._handle.seek(offset)
+        view = memoryview(data)
+        while view:
+            written = file._handle.write(view)
+            view = view[written:]
+
+    @contextlib.contextmanager
+    def heavy_slot(self, cancel_token=None):
+        with self._cond:
+            while self._heavy_running >= self.heavy_writers:
+                if cancel_token:
+                    cancel_token.raise_if_cancelled()
+                self._cond.wait(0.5)
+            self._heavy_running += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._heavy_running -= 1
+                self._cond.notify_all()
+
+class DiskScheduler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._volumes = {}
+
+    def volume(self, path):
+        anchor = _existing_parent(os.path.dirname(os.path.abspath(path)))
+        device = os.stat(anchor).st_dev
+        with self._lock:
+            writer = self._volumes.get(device)
+            if writer is None:
+                heavy = DISK_HEAVY_WRITERS_SSD if volume_is_rotational(anchor) is False else DISK_HEAVY_WRITERS
+                writer = self._volumes[device] = VolumeWriter(device, heavy)
+            return writer
+
+    def open(self, path, mode='wb'):
+        return ScheduledFile(self.volume(path), path, mode)
+
+    def heavy_writer(self, path, cancel_token=None):
+        # ให้งานเขียนไฟล์ใหญ่ (ffmpeg) ทำได้ไม่เกิน heavy_writers งานต่อ volume ที่เหลือรอคิว
+        return self.volume(path).heavy_slot(cancel_token)
+
+disk_scheduler = DiskScheduler()
+
+# ขนาด segment ที่แต่ละ connection ขอด้วย Range และจำนวน segment ที่ดาวน์โหลดล่วงหน้าได้
+# segment ที่เสร็จก่อนลำดับจะรอในหน่วยความจำ จึงใช้หน่วยความจำไม่เกินราว 2 MB x 16 ต่อไฟล์
+DOWNLOAD_SEGMENT_SIZE = 2 * 1024 * 1024
+# segment ต้นไฟล์เริ่มที่ขนาดนี้แล้วโตเป็นสองเท่าจนเต็ม DOWNLOAD_SEGMENT_SIZE
+DOWNLOAD_HEAD_SEGMENT_SIZE = 256 * 1024
+MAX_SEGMENTS_AHEAD = 16
+SEGMENT_RETRIES = 3
+# segment หัวคิวที่ใช้เวลานานกว่า segment ทั่วไป HEDGE_FACTOR เท่า (และอย่างน้อย HEDGE_MIN_DELAY วินาที) จะถูกขอซ้ำ
+HEDGE_FACTOR = 3
+HEDGE_MIN_DELAY = 1.0
+
+def segment_size(start):
+    # 256K, 256K, 512K, 1M แล้วจึง 2M: segment เล็กเสร็จก่อนตัวใหญ่ที่วิ่งพร้อมกัน
+    # ส่วนหัวของไฟล์จึงลง .part ภายในไม่กี่วินาที (ตัวอย่างจาก fragment แรกใช้ส่วนนี้)
+    return min(DOWNLOAD_SEGMENT_SIZE, max(DOWNLOAD_HEAD_SEGMENT_SIZE, start))
+
+def _open_range(url, start, end, controller, session=None):
+    headers = {"Accept-Encoding": "identity", "Range": f"bytes={start}-{end}"}
+    try:
+        response = (session or cdn_session).get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    except requests.exceptions.ProxyError:
+        # proxy ใช้ไม่ได้เป็นปัญหาของเส้นทางนั้น (EgressPool จัดการ) ไม่ใช่สัญญาณว่า CDN รับไม่ไหว
+        raise
+    except (RequestException, OSError):
+        controller.record_request(ok=False)
+        raise
+    controller.record_request(ok=response.status_code < 400,
+                              throttled=response.status_code in PLAYURL_THROTTLE_STATUS)
+    return response
+
+def _hash_prefix(path, hashers):
+    # ดาวน์โหลดต่อ: ต้อง hash ส่วนที่มีอยู่แล้วก่อน (อ่านเฉพาะส่วนนั้นครั้งเดียว)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            for hasher in hashers.values():
+                hasher.update(block)
+
+def _new_hashers(expected):
+    hashers = {"blake2b": hashlib.blake2b()}
+    for algorithm in expected:
+        hashers[algorithm] = hashlib.new(algorithm)
+    return hashers
+
+def _download_stream(response, part_path, controller, progress_callback):
+    # เซิร์ฟเวอร์ไม่รองรับ Range: อ่านทั้งไฟล์ผ่าน connection เดียวแบบเดิม
+    content_length = int(response.headers.get('content-length', 0))
+    expected = server_checksums(response, whole_body=True)
+    hashers = _new_hashers(expected)
+    downloaded = 0
+    with disk_scheduler.open(part_path, 'wb') as f:
+        for data in response.iter_content(chunk_size=65536):
+            f.write(data)
+            for hasher in hashers.values():
+                hasher.update(data)
+            downloaded += len(data)
+            controller.record(len(data))
+            if progress_callback and content_length:
+                progress_callback((downloaded / content_length) * 100)
+    return downloaded, content_length, expected, hashers
+
+def _download_segments(url, part_path, first_response, first_route, resume_from, total_size, slot, pool,
+                       progress_callback, cancel_token):
+    # แบ่งไฟล์เป็น segment ละ DOWNLOAD_SEGMENT_SIZE ดาวน์โหลดหลาย connection พร้อมกันตามงบที่ได้
+    # แต่ละ segment เลือกเส้นทางขาออกจาก pool แยกกัน segment ของไฟล์เดียวจึงกระจายไปหลายเส้นทาง
+    # แต่เขียนและ hash ตามลำดับเสมอ ไฟล์ .part จึงเป็นส่วนต้นของไฟล์ที่ต่อเนื่องกัน ดาวน์โหลดต่อได้เหมือนเดิม
+    # segment หัวคิวที่ช้ากว่าปกติมาก (เส้นทางช้าหรือ connection ค้าง) จะถูกขอซ้ำผ่านเส้นทางอื่น
+    # อันที่เสร็จก่อนถูกใช้ อีกอันถูกตัดทิ้ง segment เดียวจึงไม่ถ่วงทั้งไฟล์
+    controller = slot.controller
+    expected = server_checksums(first_response, whole_body=False)
+    hashers = _new_hashers(expected)
+    if resume_from:
+        _hash_prefix(part_path, hashers)
+
+    segments = []
+    offset = resume_from
+    while offset < total_size:
+        end = min(offset + segment_size(offset), total_size)
+        segments.append((offset, end - 1))
+        offset = end
+    token = CancelToken()
+    unregister = cancel_token.on_cancel(token.cancel) if cancel_token else (lambda: None)
+    cond = threading.Condition()
+    finished = {}
+    completed = set()
+    errors = []
+    # segment ที่ล้มเหลวกลับเข้าคิวพร้อมเวลาที่ลองใหม่ได้ worker ไม่รอเอง connection จึงลดลงตามงบทันที
+    retries = []
+    attempts = collections.Counter()
+    failed_routes = {}
+    # ความพยายามที่กำลังดาวน์โหลดแต่ละ segment (มีสองอันเมื่อถูกขอซ้ำ)
+    active = collections.defaultdict(list)
+    hedged = set()
+    # byte_time: วินาทีต่อไบต์ของ segment ที่เสร็จแล้ว (segment มีหลายขนาด จึงเทียบต่อไบต์)
+    state = {"received": resume_from, "running": 0, "byte_time": None}
+
+    def fetch(index, response=None, route=None, avoid=None):
+        start, end = segments[index]
+        attempt = {"started": time.monotonic(), "response": response, "route": route, "superseded": False}
+        with cond:
+            active[index].append(attempt)
+        data = bytearray()
+        retry_error = None
+        slot.acquire()
+        try:
+            token.raise_if_cancelled()
+            if response is None:
+                route = pool.pick(url, avoid=avoid or failed_routes.get(index))
+                attempt["route"] = route
+                response = _open_range(url, start, end, controller, route.session)
+                with cond:
+                    attempt["response"] = response
+                    if attempt["superseded"]:
+                        abort_response(response)
+            unregister_abort = token.on_cancel(lambda: abort_response(response))
+            try:
+                with response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise Exception("เซิร์ฟเวอร์ไม่ได้ส่งข้อมูลตามช่วงที่ขอ")
+                    for chunk in response.iter_content(chunk_size=65536):
+                        data += chunk
+                        controller.record(len(chunk))
+                        with cond:
+                            state["received"] += len(chunk)
+            finally:
+                unregister_abort()
+            if len(data) != end - start + 1:
+                raise Exception(f"ได้ข้อมูลไม่ครบ ({len(data)}/{end - start + 1} ไบต์)")
+            elapsed = time.monotonic() - attempt["started"]
+            with cond:
+                if index in completed:
+                    # อีกอันเสร็จก่อนเล็กน้อย ข้อมูลชุดนี้ซ้ำ
+                    state["received"] -= len(data)
+                else:
+                    completed.add(index)
+                    finished[index] = bytes(data)
+                    for other in active[index]:
+                        if other is not attempt:
+                            other["superseded"] = True
+                            if other["response"] is not None:
+                                abort_response(other["response"])
+                    typical = state["byte_time"]
+                    byte_time = elapsed / len(data)
+                    state["byte_time"] = byte_time if typical is None else typical * 0.8 + byte_time * 0.2
+            pool.report(route, len(data), elapsed)
+            route = None
+        except Exception as e:
+            with cond:
+                state["received"] -= len(data)
+            if token.is_cancelled():
+                return
+            if attempt["superseded"]:
+                # แพ้อีกอันที่ขอซ้ำ ข้อมูลที่ได้ถึงตอนนี้บอกได้ว่าเส้นทางนี้ช้าแค่ไหน
+                if route is not None:
+                    pool.report(route, len(data), time.monotonic() - attempt["started"])
+                    route = None
+                return
+            if route is not None:
+                pool.report(route, ok=False, error=e)
+                failed_routes[index] = route
+                route = None
+            if attempt["response"] is not None and not isinstance(e, requests.HTTPError):
+                # connection ถูกตัด/timeout ระหว่างรับข้อมูล นับเป็น reset ให้ตัวควบคุมเห็น
+                # (เปิด connection ไม่สำเร็จ _open_range นับไปแล้ว)
+                controller.record_request(ok=False)
+            retry_error = e
+        finally:
+            if route is not None:
+                # ถูกยกเลิกกลางทาง ไม่นับเป็นความผิดของเส้นทาง
+                pool.report(route)
+            slot.release()
+            with cond:
+                active[index].remove(attempt)
+                if not active[index]:
+                    del active[index]
+                if retry_error is not None and index not in completed and index not in active:
+                    _schedule_retry(index, retry_error)
+                state["running"] -= 1
+                cond.notify_all()
+
+    def _schedule_retry(index, e):
+        throttled = isinstance(e, requests.HTTPError) and e.response.status_code in PLAYURL_THROTTLE_STATUS
+        attempts[index] += 1
+        if attempts[index] >= (SEGMENT_RETRIES * 3 if throttled else SEGMENT_RETRIES):
+            errors.append(e)
+            return
+        delay = backoff_delay(attempts[index] - 1)
+        if throttled:
+            delay = max(delay, parse_retry_after(e.response.headers.get("Retry-After")) or 0)
+        retries.append((time.monotonic() + delay, index))
+
+    def start(index, response=None, route=None, avoid=None):
+        state["running"] += 1
+        threading.Thread(target=fetch, args=(index, response, route, avoid), daemon=True).start()
+
+    def next_ready_retry():
+        now = time.monotonic()
+        for item in sorted(retries):
+            if item[0] <= now:
+                retries.remove(item)
+                return item[1]
+        return None
+
+    def maybe_hedge(index):
+        # ขอซ้ำเฉพาะ segment ที่ถ่วงการเขียนอยู่ ครั้งเดียวต่อ segment
+        running = active.get(index)
+        typical = state["byte_time"]
+        if not running or index in completed or index in hedged or typical is None:
+            return
+        elapsed = time.monotonic() - running[0]["started"]
+        start_byte, end_byte = segments[index]
+        if elapsed > max(HEDGE_MIN_DELAY, typical * (end_byte - start_byte + 1) * HEDGE_FACTOR):
+            hedged.add(index)
+            start(index, avoid=running[0]["route"])
+
+    try:
+        with disk_scheduler.open(part_path, 'ab' if resume_from else 'wb') as f:
+            next_index = 1
+            write_index = 0
+            with cond:
+                start(0, first_response, first_route)
+            while write_index < len(segments):
+                with cond:
+                    # เปิด connection เพิ่มตามงบที่ตัวควบคุมให้ (งบอาจเพิ่ม/ลดระหว่างดาวน์โหลด)
+                    slot.demand = max(1, min(len(segments) - write_index, MAX_SEGMENTS_AHEAD))
+                    while state["running"] < slot.allowed() and not errors:
+                        retry_index = next_ready_retry()
+                        if retry_index is not None:
+                            start(retry_index)
+                        elif next_index < len(segments) and next_index - write_index < MAX_SEGMENTS_AHEAD:
+                            start(next_index)
+                            next_index += 1
+                        else:
+                            break
+                    maybe_hedge(write_index)
+                    cond.wait_for(lambda: write_index in finished or errors or token.is_cancelled(), timeout=0.2)
+                    data = finished.pop(write_index, None)
+                    received = state["received"]
+                if errors:
+                    raise errors[0]
+                token.raise_if_cancelled()
+                if data is not None:
+                    f.write(data)
+                    for hasher in hashers.values():
+                        hasher.update(data)
+                    write_index += 1
+                if progress_callback:
+                    progress_callback(min(received, total_size) / total_size * 100)
+    finally:
+        # หยุด segment ที่ค้างอยู่ทั้งหมด (กรณีผิดพลาดหรือถูกยกเลิก)
+        token.cancel()
+        unregister()
+    return total_size, expected, hashers
+
+def download_file(url, output_path, progress_callback=None, cancel_token=None, controller=None, pool=None,
+                  background=False):
+    # ดาวน์โหลดลงไฟล์ .part ข้างไฟล์ปลายทาง ถ้าถูกยกเลิกหรือหลุดกลางทางจะเก็บ .part ไว้
+    # แล้วครั้งถัดไปจะขอต่อจากไบต์ที่มีอยู่แล้วด้วย Range
+    # ถ้าเซิร์ฟเวอร์รองรับ Range จะแบ่งเป็น segment ดาวน์โหลดหลาย connection ตามงบจาก ConnectionController
+    # กระจายไปตามเส้นทางขาออกใน EgressPool background=True ใช้เฉพาะแบนด์วิดท์ที่ว่างจากงานอื่น
+    # ระหว่างเขียนจะนับไบต์และคำนวณ BLAKE2b (และ checksum ที่เซิร์ฟเวอร์ส่งมาถ้ามี) ไปพร้อมกัน
+    # คืนค่า BLAKE2b ของไฟล์ ขั้นตอนถัดไปจึงเชื่อไฟล์ได้โดยไม่ต้องอ่านซ้ำ
+    controller = controller or connection_controller
+    pool = pool or egress_pool
+    part_path = output_path + ".part"
+    slot = controller.open_transfer(background)
+    try:
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if background:
+            slot.wait_until_allowed(cancel_token)
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+        # ขอ segment แรกก่อน คำตอบบอกได้ทั้งขนาดไฟล์และว่าเซิร์ฟเวอร์รองรับ Range หรือไม่
+        route = pool.pick(url)
+        started = time.monotonic()
+        try:
+            response = _open_range(url, resume_from, resume_from + segment_size(resume_from) - 1, controller,
+                                   route.session)
+        except (RequestException, OSError) as e:
+            pool.report(route, ok=False, error=e)
+            raise
+        total_size = range_total(response) if response.status_code == 206 else None
+        if response.status_code == 416 or (resume_from and total_size is not None and resume_from > total_size):
+            response.close()
+            pool.report(route)
+            # .part ไม่ตรงกับไฟล์บนเซิร์ฟเวอร์แล้ว เริ่มใหม่ในครั้งถัดไป
+            os.remove(part_path)
+            raise Exception("ไฟล์ที่ดาวน์โหลดค้างไว้ไม่ตรงกับไฟล์บนเซิร์ฟเวอร์")
+        if response.status_code >= 400:
+            pool.report(route, ok=False, error=f"HTTP {response.status_code}")
+            with response:
+                response.raise_for_status()
+
+        if total_size is not None:
+            downloaded, expected, hashers = _download_segments(url, part_path, response, route, resume_from,
+                                                               total_size, slot, pool, progress_callback,
+                                                               cancel_token)
+        else:
+            # เซิร์ฟเวอร์ส่งมาทั้งไฟล์ (ไม่รองรับ Range) เขียนทับ .part เดิม
+            unregister = cancel_token.on_cancel(lambda: abort_response(response)) if cancel_token else None
+            slot.acquire()
+            downloaded = 0
+            try:
+                with response:
+                    downloaded, total_size, expected, hashers = _download_stream(response, part_path, controller,
+                                                                                  progress_callback)
+                pool.report(route, downloaded, time.monotonic() - started)
+            except Exception as e:
+                if cancel_token and cancel_token.is_cancelled():
+                    pool.report(route)
+                else:
+                    pool.report(route, ok=False, error=e)
+                raise
+            finally:
+                slot.release()
+                if unregister:
+                    unregister()
+
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if total_size and downloaded != total_size:
+            # เก็บ .part ไว้ ครั้งถัดไปจะขอเฉพาะส่วนที่ขาด
+            raise Exception(f"ได้ข้อมูลไม่ครบ ({downloaded}/{total_size} ไบต์)")
+        if total_size and os.path.getsize(part_path) != total_size:
+            raise Exception(f"ขนาดไฟล์ไม่ตรง ({os.path.getsize(part_path)}/{total_size} ไบต์)")
+        for algorithm, digest in expected.items():
+            if hashers[algorithm].digest() != digest:
+                os.remove(part_path)
+                raise Exception(f"checksum {algorithm} ไม่ตรงกับที่เซิร์ฟเวอร์แจ้ง ไฟล์เสียหายระหว่างดาวน์โหลด")
+
+        # ย้ายไฟล์ไปยังที่หมายปลายทาง (เขียนทับไฟล์เดิมถ้ามี)
+        os.replace(part_path, output_path)
+        return hashers["blake2b"].hexdigest()
+
+    except (Cancelled, StorageFull):
+        raise
+    except Exception as e:
+        if cancel_token and cancel_token.is_cancelled():
+            raise Cancelled("ยกเลิกการดาวน์โหลด")
+        if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+            # .part ที่เขียนได้แล้วยังเก็บไว้ ดาวน์โหลดต่อได้เมื่อมีที่ว่าง
+            raise StorageFull("พื้นที่ดิสก์เต็มระหว่างดาวน์โหลด") from e
+        raise Exception(f"เกิดข้อผิดพลาดในการดาวน์โหลด: {str(e)}")
+    finally:
+        slot.close()
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.progress = None
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    # งานที่ key เดียวกันและกำลังทำอยู่จะถูกรันเพียงครั้งเดียว
+    # ผู้เรียกคนถัดไปจะรอผลของงานที่กำลังทำแทนการเริ่มใหม่
+    # และได้รับความคืบหน้าใน thread ของตัวเอง (ปลอดภัยกับ widget ที่ผู้เรียกถืออยู่)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._flights
+
+    def do(self, key, fn, progress_callback=None, should_stop=None):
+        # fn(report) ทำงานจริงและคืนผลลัพธ์ คืนค่า (ผลลัพธ์, shared)
+        # shared เป็น True เมื่อได้ผลจากงานที่ผู้อื่นเริ่มไว้
+        while True:
+            flight, leader = self._run(key, fn, progress_callback, should_stop)
+            if not leader and isinstance(flight.error, Cancelled):
+                # เจ้าของงานถูกยกเลิก แต่เรายังต้องการผลอยู่ จึงทำต่อเอง
+                if should_stop and should_stop():
+                    raise Cancelled("ยกเลิกแล้ว")
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, not leader
+
+    def _run(self, key, fn, progress_callback, should_stop):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if leader:
+            def report(progress):
+                flight.progress = progress
+                if progress_callback:
+                    progress_callback(progress)
+
+            try:
+                flight.result = fn(report)
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            last_progress = None
+            while not flight.done.wait(0.1):
+                if should_stop and should_stop():
+                    raise Cancelled("ยกเลิกการรอผลจากงานที่กำลังทำอยู่")
+                if progress_callback and flight.progress != last_progress:
+                    last_progress = flight.progress
+                    progress_callback(last_progress)
+        return flight, leader
+
+# ใช้ร่วมกันทั้งโปรแกรม: key ขึ้นต้นด้วยชนิดงาน ("playurl", "download", "merge")
+job_flights = SingleFlight()
+
+def stream_key(url):
+    # URL จาก CDN มี token ใน query ที่เปลี่ยนทุกครั้งที่ resolve และอาจมาจาก mirror คนละตัว
+    # แต่ path ของไฟล์ (ซึ่งมี id วิดีโอและรหัสคุณภาพอยู่ในชื่อแล้ว) คงที่
+    return urllib.parse.urlsplit(url).path or url
+
+def link_or_copy(src, dst):
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        with disk_scheduler.heavy_writer(dst):
+            shutil.copyfile(src, dst)
+
+def run_shared(key, output_path, produce, progress_callback=None, should_stop=None):
+    # produce(path, report) สร้างไฟล์ที่ path ผู้ที่มาทีหลังจะได้สำเนาของไฟล์ผลลัพธ์
+    # คืนค่าที่ produce คืน (เช่น digest ของไฟล์) ซึ่งใช้กับสำเนาได้เช่นกันเพราะเนื้อหาเหมือนกัน
+    while True:
+        def work(report):
+            return output_path, produce(output_path, report)
+
+        (result_path, value), shared = job_flights.do(key, work, progress_callback, should_stop)
+        if not shared:
+            return value
+        try:
+            link_or_copy(result_path, output_path)
+        except FileNotFoundError:
+            # เจ้าของงานลบไฟล์ไปก่อนที่เราจะได้สำเนา ต้องทำเองอีกรอบ
+            continue
+        if progress_callback:
+            progress_callback(100)
+        return value
+
+def download_shared(url, output_path, progress_callback=None, cancel_token=None):
+    return run_shared(("download", stream_key(url)), output_path,
+                      lambda path, report: download_file(url, path, report, cancel_token),
+                      progress_callback, cancel_token.is_cancelled if cancel_token else None)
+
+def merge_shared(video_url, audio_url, video_path, audio_path, output_path, progress_callback=None,
+                 cancel_token=None, audio_languages=None, segment_durations=None):
+    # audio_url/audio_path เป็น list ได้เมื่อรวมเสียงหลายภาษา
+    # video_url/video_path เป็น list ได้เมื่อวิดีโอแบ่งเป็นหลายส่วน (durl) ซึ่งมีเสียงในตัว audio จึงเป็น None
+    merge = lambda path, report: merge_files(video_path, audio_path, path, report, cancel_token,
+                                             audio_languages=audio_languages, segment_durations=segment_durations)
+    if output_format_for(output_path) != OUTPUT_FORMAT_MP4:
+        # playlist อ้างถึง segment ด้วยชื่อไฟล์ คัดลอกไปชื่ออื่นไม่ได้ จึงรวมไฟล์เองโดยไม่ใช้ผลร่วมกัน
+        merge(output_path, progress_callback)
+        return None
+    video_urls = [video_url] if isinstance(video_url, str) else video_url
+    audio_urls = [audio_url] if isinstance(audio_url, str) else (audio_url or [])
+    # key จาก stream ต้นทาง เพราะแต่ละงานเก็บไฟล์ชั่วคราวคนละที่
+    key = ("merge", *(stream_key(url) for url in video_urls), *(stream_key(url) for url in audio_urls),
+           tuple(audio_languages or ()))
+    return run_shared(key, output_path, merge, progress_callback,
+                      cancel_token.is_cancelled if cancel_token else None)
+
+def file_digest(path, block_size=1024 * 1024):
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def default_data_dir():
+    base = os.environ.get('APPDATA') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(base, 'bilibili_downloader')
+
+class DownloadCatalog:
+    # บันทึกไฟล์ที่ดาวน์โหลด/รวมเสร็จแล้ว เพื่อข้ามงานที่เคยทำไปแล้ว
+    # streams: ไฟล์วิดีโอ/เสียงแยก (key คือ path ของ stream บน CDN)
+    # outputs: ไฟล์ผลลัพธ์ที่รวมแล้วต่อ aid และคุณภาพ
+    # ทุกการค้นหาเป็นการค้นผ่าน index จึงเร็วแม้มีหลายแสนรายการ
+    # ไฟล์ถือว่ายังใช้ได้เมื่อขนาดและ mtime ตรงกับที่บันทึกไว้ ไม่ต้องอ่านไฟล์ใหม่ทั้งไฟล์
+    def __init__(self, path=None):
+        self.path = path or os.path.join(default_data_dir(), 'catalog.sqlite3')
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS streams (
+                    stream_key TEXT PRIMARY KEY,
+                    aid TEXT,
+                    kind TEXT,
+                    quality INTEGER,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    blake2b TEXT,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS streams_aid ON streams (aid, kind, quality)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS outputs (
+                    path TEXT PRIMARY KEY,
+                    aid TEXT NOT NULL,
+                    video_quality INTEGER,
+                    audio_quality INTEGER,
+                    video_key TEXT,
+                    audio_key TEXT,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    blake2b TEXT,
+                    created_at REAL NOT NULL,
+                    all_audio_tracks INTEGER,
+                    audio_tracks TEXT,
+                    output_format TEXT
+                )
+            """)
+            # ฐานข้อมูลจากรุ่นก่อนยังไม่มีคอลัมน์ชุดแทร็กเสียงและรูปแบบไฟล์
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(outputs)")}
+            for column, kind in (("all_audio_tracks", "INTEGER"), ("audio_tracks", "TEXT"), ("output_format", "TEXT")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE outputs ADD COLUMN {column} {kind}")
+            if "output_format" not in columns:
+                # รูปแบบของแถวเดิมดูจากนามสกุลไฟล์ได้
+                for row in self._conn.execute("SELECT path FROM outputs").fetchall():
+                    self._conn.execute("UPDATE outputs SET output_format = ? WHERE path = ?",
+                                       (output_format_for(row["path"]), row["path"]))
+            self._conn.execute("CREATE INDEX IF NOT EXISTS outputs_aid ON outputs (aid, video_quality, audio_quality)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _verified(self, row, table, key_column):
+        if row is None:
+            return None
+        if self._stat(row["path"]) == (row["size"], row["mtime_ns"]):
+            return row
+        # ไฟล์ถูกลบหรือแก้ไขไปแล้ว รายการนี้ใช้ไม่ได้อีก
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (row[key_column],))
+        return None
+
+    def record_stream(self, url, path, aid=None, kind=None, quality=None, digest=None):
+        stat = self._stat(path)
+        if stat is None:
+            return
+        if digest is None:
+            digest = file_digest(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO streams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (stream_key(url), aid, kind, quality, os.path.abspath(path),
+                 stat[0], stat[1], digest, time.time())
+            )
+
+    def find_stream(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM streams WHERE stream_key = ?", (stream_key(url),)
+            ).fetchone()
+        return self._verified(row, "streams", "stream_key")
+
+    def record_output(self, aid, path, video_quality=None, audio_quality=None,
+                      video_url=None, audio_url=None, digest=None, all_audio_tracks=None, audio_tracks=None):
+        # audio_tracks: ภาษาของแทร็กเสียงที่รวมไว้ (หลายแทร็ก) ว่างเมื่อมีแทร็กเดียว
+        # digest ของผลลัพธ์ไม่คำนวณเอง (ต้องอ่านไฟล์ใหม่ทั้งไฟล์) เก็บ NULL ไว้ถ้าผู้เรียกไม่รู้
+        # การตรวจว่าไฟล์ยังใช้ได้อาศัยขนาดและ mtime อยู่แล้ว
+        stat = self._stat(path)
+        if stat is None:
+            return
+        if audio_tracks is not None and not isinstance(audio_tracks, str):
+            audio_tracks = ",".join(language or "" for language in audio_tracks)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outputs (path, aid, video_quality, audio_quality, video_key, audio_key, "
+                "size, mtime_ns, blake2b, created_at, all_audio_tracks, audio_tracks, output_format) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(path), aid, video_quality, audio_quality,
+                 stream_key(video_url) if video_url else None,
+                 stream_key(audio_url) if audio_url else None,
+                 stat[0], stat[1], digest, time.time(),
+                 None if all_audio_tracks is None else int(bool(all_audio_tracks)), audio_tracks,
+                 output_format_for(path))
+            )
+
+    def find_output(self, aid, min_video_quality=None, all_audio_tracks=None, audio_tracks=None,
+                    output_format=None):
+        # คืนไฟล์ผลลัพธ์คุณภาพสูงสุดของ aid ที่ยังอยู่ครบ
+        # all_audio_tracks: ต้องเป็นไฟล์ที่สั่งรวมทุกภาษา (หรือแทร็กเดียว) แบบเดียวกับที่ขอ
+        # audio_tracks: ชุดภาษาต้องตรงกันทุกตัว (ใช้หลัง resolve ซึ่งรู้แทร็กที่มีจริงแล้ว)
+        # output_format: ต้องเป็นรูปแบบเดียวกัน (playlist .m3u8 ใช้แทนไฟล์ .mp4 ไม่ได้)
+        query = "SELECT * FROM outputs WHERE aid = ?"
+        params = [aid]
+        if output_format is not None:
+            query += " AND output_format = ?"
+            params.append(output_format)
+        if min_video_quality is not None:
+            query += " AND video_quality >= ?"
+            params.append(min_video_quality)
+        if all_audio_tracks is not None:
+            query += " AND all_audio_tracks = ?"
+            params.append(int(bool(all_audio_tracks)))
+        if audio_tracks is not None:
+            if not isinstance(audio_tracks, str):
+                audio_tracks = ",".join(language or "" for language in audio_tracks)
+            query += " AND audio_tracks = ?"
+            params.append(audio_tracks)
+        query += " ORDER BY video_quality DESC, audio_quality DESC"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        for row in rows:
+            if self._verified(row, "outputs", "path") is not None:
+                return row
+        return None
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_catalog():
+    # เปิดฐานข้อมูลเมื่อใช้ครั้งแรก (โปรเซสลูกของ MergeExecutor ไม่ต้องเปิด)
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = DownloadCatalog()
+        return _catalog
+
+def fetch_stream(url, output_path, progress_callback=None, catalog=None, cancel_token=None):
+    # ใช้ไฟล์ที่เคยดาวน์โหลดไว้และยังตรงกับที่บันทึกถ้ามี ไม่เช่นนั้นจึงดาวน์โหลด
+    # คืนค่า BLAKE2b ของไฟล์
+    if catalog is not None:
+        cached = catalog.find_stream(url)
+        if cached is not None:
+            get_storage_manager().touch(cached["path"])
+            link_or_copy(cached["path"], output_path)
+            if progress_callback:
+                progress_callback(100)
+            return cached["blake2b"]
+    return download_shared(url, output_path, progress_callback, cancel_token)
+
+def job_temp_root():
+    return os.path.join(os.environ.get('TEMP') or os.environ.get('TMP') or os.getcwd(), 'bilibili_temp')
+
+def job_temp_dir(name):
+    # โฟลเดอร์ชั่วคราวตั้งชื่อตามงาน งานที่ถูกยกเลิกแล้วสั่งใหม่จะเจอไฟล์ .part เดิมและดาวน์โหลดต่อได้
+    path = os.path.join(job_temp_root(), name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+STORAGE_INTERMEDIATE = "intermediate"
+STORAGE_OUTPUT = "output"
+# พื้นที่ว่างบนดิสก์ที่ต้องเหลือไว้เสมอ ไม่ให้ระบบหรือโปรแกรมอื่นเขียนไม่ได้
+STORAGE_FREE_MARGIN = 512 * 1024 * 1024
+# stream ที่ API ไม่ได้บอกขนาด ประมาณเผื่อไว้ก่อน
+STORAGE_UNKNOWN_STREAM_SIZE = 512 * 1024 * 1024
+# โฟลเดอร์ชั่วคราวที่มีไฟล์ถูกเขียนภายในช่วงนี้อาจเป็นของโปรเซสอื่นที่กำลังทำงาน ห้ามลบ
+STORAGE_ACTIVE_GRACE = 300.0
+STORAGE_WAIT_POLL = 1.0
+
+class StorageFull(Exception):
+    # พื้นที่ไม่พอสำหรับงาน (เกินโควตาหรือดิสก์เต็ม) ไม่ใช่ความผิดของงานเอง รอให้มีที่ว่างแล้วทำใหม่ได้
+    pass
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+def parse_size(text):
+    # "500M", "20G", "1.5T" หรือจำนวนไบต์ ว่างหรือ None คือไม่จำกัด
+    if not text:
+        return None
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"ขนาดไม่ถูกต้อง: {text}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+def _disk_bytes(stat):
+    # พื้นที่ที่ใช้จริง ไฟล์ .stream ที่ยังเขียนไม่ครบเป็น sparse file จึงใช้ st_blocks ถ้ามี
+    blocks = getattr(stat, "st_blocks", None)
+    return blocks * 512 if blocks is not None else stat.st_size
+
+def path_usage(path):
+    # คืน (ไบต์ที่ใช้, เวลาเขียนล่าสุด) ของไฟล์หรือโฟลเดอร์ (0, 0) ถ้าไม่มี
+    # playlist HLS/DASH นับรวมไฟล์ segment ข้าง ๆ ด้วย (output_files)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0, 0
+    if os.path.isdir(path):
+        paths = (os.path.join(root, name) for root, dirs, files in os.walk(path) for name in files)
+    else:
+        paths = output_files(path)
+    total, newest = 0, stat.st_mtime
+    for file in paths:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            continue
+        total += _disk_bytes(stat)
+        newest = max(newest, stat.st_mtime)
+    return total, newest
+
+class StorageReservation:
+    def __init__(self, manager, parts):
+        self.manager = manager
+        # [(path, ไบต์ที่คาดว่าจะใช้เมื่องานเสร็จ), ...] path คือโฟลเดอร์ชั่วคราวของงานหรือไฟล์ผลลัพธ์
+        self.parts = parts
+
+    @property
+    def nbytes(self):
+        return sum(nbytes for path, nbytes in self.parts)
+
+    def release(self):
+        self.manager._release(self)
+
+class StorageManager:
+    # บัญชีไฟล์ทั้งหมดที่โปรแกรมสร้าง: โฟลเดอร์ชั่วคราวของงาน (intermediate) และไฟล์ผลลัพธ์ (output)
+    # เก็บขนาดและเวลาที่ใช้ล่าสุดใน SQLite งานต้องจองพื้นที่ (reserve) ก่อนเริ่มดาวน์โหลด
+    # ถ้าโควตาหรือดิสก์ไม่พอ จะลบ intermediate ที่ไม่ได้ใช้นานที่สุดก่อน แล้วจึงเป็น output (เมื่อ evict_outputs)
+    # path ที่งานซึ่งกำลังทำอยู่จองไว้จะไม่ถูกลบ
+    def __init__(self, path=None, quota=None, evict_outputs=False, temp_root=None, free_margin=STORAGE_FREE_MARGIN):
+        self.path = path or os.path.join(default_data_dir(), 'storage.sqlite3')
+        # จำนวนไบต์สูงสุดของไฟล์ทั้งหมดในบัญชี (None คือจำกัดแค่พื้นที่ว่างบนดิสก์)
+        self.quota = quota
+        self.evict_outputs = evict_outputs
+        self.temp_root = os.path.abspath(temp_root or job_temp_root())
+        self.free_margin = free_margin
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._cond = threading.Condition()
+        self._reservations = []
+        # ไบต์ต่ออุปกรณ์ของของที่เลือกลบแล้วแต่ยังลบไม่เสร็จ (ลบนอก lock) นับว่าว่างแล้วตอนคำนวณพื้นที่
+        self._freeing = collections.Counter()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._cond, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS files_lru ON files (kind, last_used)")
+        self.scan()
+
+    def close(self):
+        with self._cond:
+            self._conn.close()
+
+    def _kind(self, path):
+        try:
+            inside = os.path.commonpath([self.temp_root, path]) == self.temp_root
+        except ValueError:
+            # คนละไดรฟ์ (Windows)
+            inside = False
+        return STORAGE_INTERMEDIATE if inside else STORAGE_OUTPUT
+
+    def _put(self, path, last_used=None):
+        size, mtime = path_usage(path)
+        if not mtime:
+            self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+            return
+        self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                           (path, self._kind(path), size, last_used or time.time()))
+
+    def scan(self):
+        # โฟลเดอร์ชั่วคราวที่ค้างจากงานที่ยกเลิกหรือจากรุ่นก่อนที่ยังไม่มีบัญชีนี้ ถูกนับเป็น intermediate
+        # โดยใช้เวลาเขียนล่าสุดเป็นเวลาที่ใช้ล่าสุด
+        try:
+            names = os.listdir(self.temp_root)
+        except OSError:
+            names = []
+        with self._cond, self._conn:
+            reserved = self._reserved_paths()
+            known = {row[0]: row[1] for row in self._conn.execute(
+                "SELECT path, last_used FROM files WHERE kind = ?", (STORAGE_INTERMEDIATE,))}
+            for name in names:
+                path = os.path.join(self.temp_root, name)
+                if path not in reserved:
+                    self._put(path, known.pop(path, None) or path_usage(path)[1])
+                else:
+                    known.pop(path, None)
+            for path in known:
+                if not os.path.exists(path):
+                    self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def track(self, path):
+        # บันทึกไฟล์/โฟลเดอร์ที่เพิ่งสร้างเสร็จ (เช่นไฟล์ที่ผู้ใช้บันทึกเอง)
+        path = os.path.abspath(path)
+        with self._cond, self._conn:
+            self._put(path)
+
+    def touch(self, path):
+        # มีงานนำไฟล์นี้ไปใช้ซ้ำ (เจอใน catalog) ถ้าไฟล์อยู่ในโฟลเดอร์ชั่วคราว เลื่อนทั้งโฟลเดอร์
+        path = os.path.abspath(path)
+        candidates = [path]
+        while os.path.dirname(candidates[-1]) != candidates[-1]:
+            candidates.append(os.path.dirname(candidates[-1]))
+        with self._cond, self._conn:
+            self._conn.execute(f"UPDATE files SET last_used = ? WHERE path IN ({','.join('?' * len(candidates))})",
+                               (time.time(), *candidates))
+
+    def forget(self, path):
+        with self._cond, self._conn:
+            self._conn.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(path),))
+
+    def _reserved_paths(self):
+        return {path for reservation in self._reservations for path, nbytes in reservation.parts}
+
+    def _shortfall(self, reservations):
+        # คืน (ไบต์ที่เกินโควตา, {อุปกรณ์: (path ตัวแทน, ไบต์ที่ขาด)}) ถ้าทุกงานที่จองไว้เขียนจนเสร็จ
+        # path None คือพื้นที่ใหม่ในโฟลเดอร์ชั่วคราวที่ยังไม่มีไฟล์
+        reserved = {}
+        for reservation in reservations:
+            for path, nbytes in reservation.parts:
+                reserved[path] = reserved.get(path, 0) + nbytes
+        paths = [path for path in reserved if path is not None]
+        committed = self._conn.execute(
+            f"SELECT COALESCE(SUM(size), 0) FROM files WHERE path NOT IN ({','.join('?' * len(paths))})",
+            paths).fetchone()[0]
+        pending = {}
+        for path, nbytes in reserved.items():
+            used = path_usage(path)[0] if path is not None else 0
+            committed += max(nbytes, used)
+            anchor = _existing_parent(path or self.temp_root)
+            device = os.stat(anchor).st_dev
+            previous = pending.get(device, (anchor, 0))
+            pending[device] = (previous[0], previous[1] + max(0, nbytes - used))
+        over_quota = max(0, committed - self.quota) if self.quota is not None else 0
+        short = {}
+        for device, (anchor, nbytes) in pending.items():
+            missing = nbytes + self.free_margin - shutil.disk_usage(anchor).free - self._freeing[device]
+            if missing > 0:
+                short[device] = (anchor, missing)
+        return over_quota, short
+
+    def _make_room(self, reservation):
+        # เลือกของที่ไม่ได้ใช้นานที่สุดจนพอ คืน (ไบต์ที่ยังขาด, ของที่ต้องลบ) (0 คือพอแล้ว)
+        # ของที่เลือกถูกตัดออกจากบัญชีทันที แต่ผู้เรียกต้องลบเอง (_evict) หลังปล่อย _cond
+        # ถ้าลบทุกอย่างที่ลบได้แล้วยังไม่พอ จะไม่ลบอะไรเลย ไฟล์ .part ที่ดาวน์โหลดต่อได้ไม่ควรหายไปเปล่าๆ
+        over_quota, short = self._shortfall(self._reservations + [reservation])
+        if not over_quota and not short:
+            return 0, []
+        protected = self._reserved_paths() | {path for path, nbytes in reservation.parts}
+        kinds = (STORAGE_INTERMEDIATE, STORAGE_OUTPUT) if self.evict_outputs else (STORAGE_INTERMEDIATE,)
+        rows = self._conn.execute(
+            f"SELECT path, kind, size FROM files WHERE kind IN ({','.join('?' * len(kinds))}) "
+            "ORDER BY kind = ?, last_used", (*kinds, STORAGE_OUTPUT)).fetchall()
+        now = time.time()
+        victims = []
+        for path, kind, size in rows:
+            if not over_quota and not short:
+                break
+            if path in protected:
+                continue
+            try:
+                device = os.stat(path).st_dev
+            except OSError:
+                self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                continue
+            if kind == STORAGE_INTERMEDIATE:
+                # โฟลเดอร์ชั่วคราวมีไม่กี่ไฟล์ ดูเวลาเขียนล่าสุดจริง (โปรเซสอื่นอาจกำลังเขียนอยู่)
+                # ผลลัพธ์ใช้ขนาดที่บันทึกไว้ ไม่ต้องไล่ segment ของ HLS/DASH ทุกครั้งที่จอง
+                size, mtime = path_usage(path)
+                if now - mtime < STORAGE_ACTIVE_GRACE:
+                    continue
+            if not over_quota and device not in short:
+                continue
+            victims.append((path, kind, size, device))
+            over_quota = max(0, over_quota - size)
+            if device in short:
+                anchor, missing = short[device]
+                if missing > size:
+                    short[device] = (anchor, missing - size)
+                else:
+                    del short[device]
+        if over_quota or short:
+            return max([over_quota] + [missing for anchor, missing in short.values()]), []
+        for path, kind, size, device in victims:
+            self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+            self._freeing[device] += size
+        return 0, victims
+
+    def _evict(self, victims):
+        # ลบนอก _cond งานอื่นจองหรือถามพื้นที่ต่อได้ระหว่างลบโฟลเดอร์หรือ segment จำนวนมาก
+        for path, kind, size, device in victims:
+            print(f"Storage: evicting {kind} {path} ({size} bytes)")
+            failed = False
+            for target in output_files(path):
+                if os.path.isdir(target):
+                    shutil.rmtree(target, ignore_errors=True)
+                    continue
+                try:
+                    os.remove(target)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Storage: cannot remove {target}: {str(e)}")
+                    failed = True
+            with self._cond:
+                self._freeing[device] -= size
+                if failed:
+                    # ลบไม่ครบ ส่วนที่เหลือยังใช้พื้นที่อยู่ กลับเข้าบัญชี
+                    with self._conn:
+                        self._put(path)
+                self._cond.notify_all()
+
+    def reserve(self, parts, cancel_token=None, wait=True, status_callback=None):
+        # จองพื้นที่ให้งานก่อนเริ่ม parts = [(path, ไบต์ที่คาดว่าจะใช้), ...]
+        # ถ้ายังไม่พอแม้ลบของเก่าแล้ว และมีงานอื่นที่จองไว้อยู่ (ซึ่งจะคืนพื้นที่เมื่อเสร็จ) จะรอ
+        # ไม่เช่นนั้นหรือ wait=False จะ raise StorageFull ทันที
+        reservation = StorageReservation(self, [(os.path.abspath(path), max(0, int(nbytes)))
+                                                for path, nbytes in parts])
+        notified = False
+        with self._cond:
+            while True:
+                if cancel_token:
+                    cancel_token.raise_if_cancelled()
+                with self._conn:
+                    missing, victims = self._make_room(reservation)
+                if not missing:
+                    self._reservations.append(reservation)
+                    break
+                if not wait or not self._reservations:
+                    raise StorageFull(f"พื้นที่เก็บไฟล์ไม่พอสำหรับงานนี้ (ต้องการ {reservation.nbytes / 1024 / 1024:.0f} MB "
+                                      f"ขาดอีก {missing / 1024 / 1024:.0f} MB)")
+                if status_callback and not notified:
+                    status_callback("รอพื้นที่ว่างจากงานอื่น...")
+                    notified = True
+                self._cond.wait(STORAGE_WAIT_POLL)
+        self._evict(victims)
+        return reservation
+
+    def admit(self, nbytes):
+        # ตัวจัดคิวถามว่างานใหม่ขนาดนี้เริ่มได้หรือไม่ (ลบของเก่าให้ถ้าจำเป็น) โดยยังไม่จองจริง
+        reservation = StorageReservation(self, [(None, nbytes)])
+        with self._cond, self._conn:
+            missing, victims = self._make_room(reservation)
+        self._evict(victims)
+        return not missing
+
+    def _release(self, reservation):
+        # งานจบ (สำเร็จ ล้มเหลว หรือยกเลิก) บันทึกขนาดจริงของสิ่งที่เหลืออยู่
+        with self._cond:
+            if reservation in self._reservations:
+                self._reservations.remove(reservation)
+            with self._conn:
+                for path, nbytes in reservation.parts:
+                    self._put(path)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            rows = self._conn.execute("SELECT kind, COUNT(*), COALESCE(SUM(size), 0) FROM files GROUP BY kind").fetchall()
+            reserved = sum(reservation.nbytes for reservation in self._reservations)
+            jobs = len(self._reservations)
+        usage = {kind: {"files": count, "bytes": size} for kind, count, size in rows}
+        return {"quota": self.quota, "evict_outputs": self.evict_outputs, "reserved": reserved,
+                "reserved_jobs": jobs, "free": shutil.disk_usage(_existing_parent(self.temp_root)).free,
+                "usage": usage}
+
+_storage_manager = None
+_storage_lock = threading.Lock()
+
+def get_storage_manager():
+    # เปิดบัญชีเมื่อใช้ครั้งแรก โควตาเริ่มต้นจาก BILIBILI_STORAGE_QUOTA (เช่น 50G)
+    global _storage_manager
+    with _storage_lock:
+        if _storage_manager is None:
+            _storage_manager = StorageManager(quota=parse_size(os.environ.get("BILIBILI_STORAGE_QUOTA")))
+        return _storage_manager
+
+def estimate_stream_bytes(result, urls):
+    return sum(result.stream_sizes.get(url) or STORAGE_UNKNOWN_STREAM_SIZE for url in urls)
+
+def reserve_job_storage(result, streams, temp_dir, output_path, output_bytes=None, cancel_token=None,
+                        status_callback=None):
+    # ไฟล์ชั่วคราวทุก stream อยู่พร้อมกับไฟล์ผลลัพธ์จนรวมเสร็จ ผลลัพธ์ (-c copy) มีขนาดใกล้กับผลรวมของ stream
+    stream_bytes = estimate_stream_bytes(result, [url for url, path in streams])
+    return get_storage_manager().reserve(
+        [(temp_dir, stream_bytes), (output_path, stream_bytes if output_bytes is None else output_bytes)],
+        cancel_token, status_callback=status_callback)
+
+def fetch_streams(streams, catalog=None, cancel_token=None, progress_callback=None):
+    # ดาวน์โหลดหลาย stream พร้อมกัน [(url, path), ...] ความคืบหน้ารวมเป็นค่าเฉลี่ยของทุก stream
+    # ถ้า stream ใดล้มเหลวจะยกเลิกตัวอื่นทันที (ไฟล์ .part ยังเก็บไว้ให้ดาวน์โหลดต่อ)
+    return fetch_parallel(streams, lambda url, path, report, token: fetch_stream(url, path, report, catalog, token),
+                          cancel_token, progress_callback)
+
+def fetch_parallel(streams, fetch_one, cancel_token=None, progress_callback=None):
+    # fetch_one(url, path, report, token) ของแต่ละ stream ใน thread ของตัวเอง คืนผลตามลำดับ streams
+    token = CancelToken()
+    unregister = cancel_token.on_cancel(token.cancel) if cancel_token else (lambda: None)
+    progress = [0.0] * len(streams)
+    lock = threading.Lock()
+
+    def report(index, value):
+        with lock:
+            progress[index] = value
+            total = sum(progress) / len(progress)
+        if progress_callback:
+            progress_callback(total)
+
+    def fetch(index, url, path):
+        try:
+            return fetch_one(url, path, lambda value: report(index, value), token)
+        except Exception:
+            token.cancel()
+            raise
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(streams)) as executor:
+            futures = [executor.submit(fetch, index, url, path) for index, (url, path) in enumerate(streams)]
+            concurrent.futures.wait(futures)
+        # รายงานข้อผิดพลาดต้นเหตุ ไม่ใช่ Cancelled ของ stream ที่ถูกยกเลิกตาม
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        for error in errors:
+            if not isinstance(error, Cancelled):
+                raise error
+        if errors:
+            raise errors[0]
+        return [future.result() for future in futures]
+    finally:
+        unregister()
+
+# เล่นระหว่างดาวน์โหลด: ไฟล์ถูกแบ่งเป็นก้อนขนาดเท่ากัน ก้อนที่ player กำลังจะอ่านได้ก่อน
+# คำขอหนึ่งครอบหลายก้อนติดกัน แต่ละก้อนอ่านได้ทันทีที่มาครบ connection ที่ว่างจึงย้ายตาม seek ได้เร็ว
+STREAM_CHUNK_SIZE = 256 * 1024
+STREAM_REQUEST_CHUNKS = 4
+# ผู้อ่านที่รอก้อนข้อมูลตื่นมาตรวจว่างานยังไม่ล้มทุกเท่านี้วินาที
+STREAM_READ_POLL = 0.5
+
+class ProgressiveFile:
+    # stream หนึ่งที่ดาวน์โหลดเป็นก้อนไม่ตามลำดับ ผู้อ่าน (player ผ่าน HTTP) อ่านช่วงใดก็ได้ระหว่างดาวน์โหลด
+    # เขียนลง path + ".stream" ขนาดเต็มตั้งแต่แรก ก้อนที่ได้แล้วจดไว้ใน _have เมื่อครบจึงย้ายไปเป็น path
+    # ลำดับการดึง: ก้อนแรกที่ยังขาดนับจากตำแหน่งล่าสุดที่ผู้อ่านขอ (เริ่มที่ 0 จึงเป็นการดึงตามลำดับ)
+    # เมื่อ player seek ตำแหน่งนั้นจะย้ายตาม ถึงท้ายไฟล์แล้วจึงวนกลับไปเติมช่องที่เหลือ
+    def __init__(self, url, path, language=None):
+        self.url = url
+        self.path = path
+        self.language = language
+        self.total_size = None
+        self.error = None
+        self._cond = threading.Condition()
+        # _file ใช้อ่าน ส่วนการเขียนผ่าน disk_scheduler (_writer) ก้อนที่ยังไม่ถึงดิสก์อ่านจากบัฟเฟอร์ของมัน
+        self._file = None
+        self._writer = None
+        self._have = None
+        self._in_flight = set()
+        self._missing = 0
+        self._cursor = 0
+        self._readers = 0
+        self._released = False
+        self._ready = threading.Event()
+        # BLAKE2b (และ checksum ที่เซิร์ฟเวอร์แจ้ง) คำนวณตามส่วนต้นที่ต่อเนื่องระหว่างที่ก้อนมาถึง
+        # ตอนจบจึงไม่ต้องอ่านไฟล์ใหม่ทั้งไฟล์ digest ได้ค่าเมื่อตรวจครบแล้ว (verify) หรือรู้จากที่อื่น (adopt)
+        self.digest = None
+        self._expected = {}
+        self._hashers = None
+        self._hashed = 0
+        self._hash_lock = threading.Lock()
+
+    @property
+    def stream_path(self):
+        return self.path + ".stream"
+
+    @property
+    def complete(self):
+        return self._missing == 0 and self._have is not None
+
+    def prepare(self, total_size, expected=None):
+        # ใช้ส่วนต้นที่ต่อเนื่องจาก .part (download_file หรือการเล่นครั้งก่อนที่ถูกยกเลิก) ต่อได้ทันที
+        # expected: checksum ของทั้งไฟล์จาก server_checksums ตรวจใน verify เมื่อครบ
+        part_path = self.path + ".part"
+        prefix = 0
+        if os.path.exists(part_path) and os.path.getsize(part_path) <= total_size:
+            os.replace(part_path, self.stream_path)
+            prefix = os.path.getsize(self.stream_path)
+        elif os.path.exists(self.stream_path):
+            os.remove(self.stream_path)
+        count = (total_size + STREAM_CHUNK_SIZE - 1) // STREAM_CHUNK_SIZE
+        with self._cond:
+            self.total_size = total_size
+            self._have = bytearray(count)
+            for index in range(count):
+                if min((index + 1) * STREAM_CHUNK_SIZE, total_size) <= prefix:
+                    self._have[index] = 1
+            self._missing = count - sum(self._have)
+            self._expected = expected or {}
+            self._hashers = _new_hashers(self._expected)
+            self._hashed = count - self._missing
+            with open(self.stream_path, 'r+b' if prefix else 'w+b') as f:
+                # hash ก้อนเต็มของส่วนต้นที่มีอยู่แล้ว (อ่านเฉพาะส่วนนั้นครั้งเดียว)
+                remaining = min(self._hashed * STREAM_CHUNK_SIZE, total_size)
+                while remaining:
+                    block = f.read(min(1024 * 1024, remaining))
+                    if not block:
+                        break
+                    for hasher in self._hashers.values():
+                        hasher.update(block)
+                    remaining -= len(block)
+                f.truncate(total_size)
+            self._writer = disk_scheduler.open(self.stream_path, 'r+b')
+            # ไม่ใช้บัฟเฟอร์ของ Python ไม่ให้ read-ahead จำช่วงที่ยังไม่ได้เขียนไว้
+            self._file = open(self.stream_path, 'rb', buffering=0)
+            if self._missing == 0:
+                self._finish()
+        self._ready.set()
+
+    def adopt(self, path, digest=None):
+        # ไฟล์ครบอยู่แล้ว (เจอใน catalog หรืองานอื่นดาวน์โหลดให้) อ่านจากไฟล์ได้เลยไม่ต้องดาวน์โหลด
+        link_or_copy(path, self.path)
+        total_size = os.path.getsize(self.path)
+        self.digest = digest
+        with self._cond:
+            self.total_size = total_size
+            self._have = bytearray(b"\x01") * ((total_size + STREAM_CHUNK_SIZE - 1) // STREAM_CHUNK_SIZE)
+            self._missing = 0
+            self._file = open(self.path, 'rb')
+        self._ready.set()
+
+    def chunk_range(self, index, count=1):
+        start = index * STREAM_CHUNK_SIZE
+        return start, min((index + count) * STREAM_CHUNK_SIZE, self.total_size) - 1
+
+    def _reserve(self, first, limit):
+        # จองก้อนที่ยังขาดต่อเนื่องกันตั้งแต่ first ไม่เกิน limit ก้อน คืน (first, จำนวน)
+        last = first
+        while (last + 1 < len(self._have) and last + 1 - first < limit and not self._have[last + 1]
+               and last + 1 not in self._in_flight):
+            last += 1
+        self._in_flight.update(range(first, last + 1))
+        return first, last - first + 1
+
+    def next_run(self, limit=STREAM_REQUEST_CHUNKS):
+        # ช่วงถัดไปที่ควรดึง (จองไว้แล้ว) None ถ้าทุกก้อนได้แล้วหรือกำลังดึงอยู่
+        with self._cond:
+            if self._have is None:
+                return None
+            count = len(self._have)
+            for index in itertools.chain(range(self._cursor, count), range(0, self._cursor)):
+                if not self._have[index] and index not in self._in_flight:
+                    return self._reserve(index, limit)
+            return None
+
+    def reserve_at(self, offset):
+        # คำขอแรก: จองช่วงที่เริ่มจากก้อนของ offset (None ถ้าก้อนนั้นมีอยู่แล้ว)
+        with self._cond:
+            index = offset // STREAM_CHUNK_SIZE
+            if self._have[index] or index in self._in_flight:
+                return None
+            return self._reserve(index, STREAM_REQUEST_CHUNKS)
+
+    def buffered_ahead(self):
+        # สัดส่วนของไฟล์ที่มีต่อเนื่องจากตำแหน่งผู้อ่าน ใช้เลือกว่า stream ไหนควรได้ connection ถัดไป
+        # (วิดีโอกับเสียงยาวเท่ากัน สัดส่วนเท่ากันจึงเท่ากับเวลาที่เล่นได้พอ ๆ กัน)
+        with self._cond:
+            if self._have is None:
+                return 0.0
+            index = self._cursor
+            while index < len(self._have) and self._have[index]:
+                index += 1
+            return (index - self._cursor) / len(self._have)
+
+    def write_chunk(self, index, data):
+        with self._cond:
+            self._in_flight.discard(index)
+            if self._have[index] or self._writer is None:
+                return
+            writer = self._writer
+        try:
+            # อาจต้องรอบัฟเฟอร์ของดิสก์ จึงไม่ถือ _cond ไว้ให้ผู้อ่านติด
+            # ก้อนที่ฝากไว้อ่านได้ทันทีผ่าน read_pending ถ้าเขียนจริงไม่สำเร็จ ผู้อ่านจะได้ข้อผิดพลาดแทนช่องว่าง
+            writer.write_at(index * STREAM_CHUNK_SIZE, data)
+            with self._cond:
+                if self._have[index] or self._writer is None:
+                    return
+                if self._missing == 1:
+                    # ก้อนสุดท้าย: นับว่าครบเมื่อทุกก้อนถึงดิสก์แล้วเท่านั้น
+                    self._finish()
+                self._have[index] = 1
+                self._missing -= 1
+                self._cond.notify_all()
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise StorageFull("พื้นที่ดิสก์เต็มระหว่างดาวน์โหลด") from e
+            raise
+        self._hash_ready(index, data)
+
+    def _hash_ready(self, index=None, data=None):
+        # ต่อ hash ไปตามส่วนต้นที่ต่อเนื่อง ก้อนที่มาก่อนลำดับถูกอ่านกลับจากบัฟเฟอร์/ดิสก์ครั้งเดียวเมื่อถึงคิว
+        # ใช้ lock แยก การ hash จึงไม่กันผู้อ่านที่รอ _cond
+        with self._hash_lock:
+            while True:
+                with self._cond:
+                    position = self._hashed
+                    if (self._hashers is None or position >= len(self._have) or not self._have[position]
+                            or (position != index and self._file is None)):
+                        return
+                    block = data if position == index else self._read(position, *self.chunk_range(position))
+                for hasher in self._hashers.values():
+                    hasher.update(block)
+                self._hashed = position + 1
+
+    def verify(self):
+        # ไฟล์ครบแล้ว: hash ก้อนที่ยังค้างให้จบ เทียบกับ checksum ที่เซิร์ฟเวอร์แจ้ง แล้วคืน BLAKE2b
+        if self.digest is not None or self._hashers is None:
+            return self.digest
+        self._hash_ready()
+        if self._hashed < len(self._have):
+            raise Exception("ตรวจสอบไฟล์ไม่ครบ ไฟล์ชั่วคราวถูกปิดไปก่อน")
+        for algorithm, digest in self._expected.items():
+            if self._hashers[algorithm].digest() != digest:
+                with contextlib.suppress(OSError):
+                    os.remove(self.path)
+                raise Exception(f"checksum {algorithm} ไม่ตรงกับที่เซิร์ฟเวอร์แจ้ง ไฟล์เสียหายระหว่างดาวน์โหลด")
+        self.digest = self._hashers["blake2b"].hexdigest()
+        return self.digest
+
+    def retry_chunk(self, index):
+        with self._cond:
+            self._in_flight.discard(index)
+
+    def _finish(self):
+        # ครบแล้ว: ย้ายไปเป็นไฟล์จริง (ปิดก่อนเพราะ Windows ย้ายไฟล์ที่เปิดอยู่ไม่ได้) แล้วเปิดอ่านต่อ
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            try:
+                # ก้อนที่ฝากไว้ต้องถึงดิสก์ก่อน ถ้าเขียนไม่สำเร็จ (เช่น ENOSPC) คืน writer ที่ยังเปิดอยู่
+                # ให้ fail ตัดเก็บส่วนต้นที่ถึงดิสก์แล้วเป็น .part
+                writer.flush()
+            except BaseException:
+                self._writer = writer
+                raise
+            writer.close()
+        self._file.close()
+        os.replace(self.stream_path, self.path)
+        self._file = open(self.path, 'rb')
+
+    def fail(self, error):
+        # ดาวน์โหลดล้มเหลวหรือถูกยกเลิก: เก็บส่วนต้นที่ต่อเนื่องเป็น .part ไว้ดาวน์โหลดต่อครั้งหน้า
+        with self._cond:
+            self.error = error
+            if self._file is not None and not self.complete:
+                writer, self._writer = self._writer, None
+                # เก็บเฉพาะส่วนต้นที่ต่อเนื่องและถึงดิสก์จริง ก้อนที่เขียนไม่สำเร็จ (เช่น ENOSPC) ไม่นับ
+                # ถ้าตัดไฟล์ไม่ได้ก็ทิ้งทั้งไฟล์ ไม่ให้ .part มีช่องว่างอยู่ข้างใน
+                keep = writer is not None
+                if writer is not None:
+                    with contextlib.suppress(OSError, ValueError):
+                        writer.flush()
+                    prefix = 0
+                    while (prefix < len(self._have) and self._have[prefix]
+                           and not writer.is_lost(prefix * STREAM_CHUNK_SIZE)):
+                        prefix += 1
+                    try:
+                        writer.close(truncate=min(prefix * STREAM_CHUNK_SIZE, self.total_size))
+                    except (OSError, ValueError) as e:
+                        # ข้อผิดพลาดเดิมของการเขียนถูก raise ซ้ำตอนปิด ไฟล์ยังตัดได้ตามปกติ
+                        keep = e is writer.error
+                self._file.close()
+                self._file = None
+                try:
+                    if keep:
+                        os.replace(self.stream_path, self.path + ".part")
+                    else:
+                        os.remove(self.stream_path)
+                except OSError as e:
+                    print(f"Cannot keep partial stream {self.stream_path}: {str(e)}")
+            self._cond.notify_all()
+        self._ready.set()
+
+    def wait_ready(self, timeout=None):
+        self._ready.wait(timeout)
+        if self.total_size is None:
+            raise self.error or TimeoutError("ยังไม่ได้เริ่มดาวน์โหลด")
+
+    def read(self, start, end):
+        # คืนข้อมูลช่วง [start, end] ทีละก้อนตามที่มาถึง ตำแหน่งที่รอคือสิ่งที่ต้องดึงก่อน
+        with self._cond:
+            if self._released and self._readers == 0:
+                raise FileNotFoundError("ไฟล์ชั่วคราวของงานนี้ถูกลบแล้ว")
+            self._readers += 1
+        try:
+            position = start
+            while position <= end:
+                index = position // STREAM_CHUNK_SIZE
+                with self._cond:
+                    self._cursor = index
+                    while not self._have[index]:
+                        if self.error is not None:
+                            raise self.error
+                        self._cond.wait(STREAM_READ_POLL)
+                    if self._file is None:
+                        raise self.error or FileNotFoundError("ไฟล์ชั่วคราวของงานนี้ถูกลบแล้ว")
+                    stop = min(end, self.chunk_range(index)[1])
+                    data = self._read(index, position, stop)
+                position += len(data)
+                yield data
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._released and self._readers == 0:
+                    self._close()
+
+    def head(self, limit):
+        # ส่วนต้นที่ต่อเนื่องกันแล้ว (ไม่เกิน limit) และบอกว่าไฟล์ครบแล้วหรือยัง
+        with self._cond:
+            if self._have is None or self._file is None:
+                return b"", False
+            index = 0
+            while index < len(self._have) and self._have[index]:
+                index += 1
+            size = min(limit, index * STREAM_CHUNK_SIZE, self.total_size)
+            data = b"".join(self._read(chunk, chunk * STREAM_CHUNK_SIZE,
+                                       min(size, (chunk + 1) * STREAM_CHUNK_SIZE) - 1)
+                            for chunk in range((size + STREAM_CHUNK_SIZE - 1) // STREAM_CHUNK_SIZE))
+            return data, self.complete
+
+    def _read(self, index, start, end):
+        # ช่วง [start, end] ภายในก้อน index จากบัฟเฟอร์ของ disk_scheduler ถ้ายังไม่ถึงดิสก์
+        data = self._writer.read_pending(index * STREAM_CHUNK_SIZE, start, end) if self._writer else None
+        if data is None:
+            self._file.seek(start)
+            data = self._file.read(end - start + 1)
+        return data
+
+    def release(self):
+        # งานจบแล้ว: ปิดไฟล์เมื่อไม่มีผู้อ่านค้างอยู่ (player ที่กำลังเล่นยังอ่านจนจบได้)
+        with self._cond:
+            self._released = True
+            if self._readers == 0:
+                self._close()
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class RangeNotSupported(Exception):
+    # CDN ส่งทั้งไฟล์แทนช่วงที่ขอ ดาวน์โหลดแบบปกติได้ แต่เล่นระหว่างดาวน์โหลดไม่ได้
+    pass
+
+class ProgressiveDownload:
+    # ดาวน์โหลดหลาย ProgressiveFile (วิดีโอและเสียง) ด้วยงบ connection เดียวจาก ConnectionController
+    # connection ที่ว่างไปที่ stream ซึ่งมีข้อมูลล่วงหน้าจากตำแหน่งผู้อ่านน้อยที่สุด ผู้อ่านที่รออยู่จึงได้ก่อนเสมอ
+    def __init__(self, files, controller=None, pool=None, cancel_token=None, progress_callback=None):
+        self.files = files
+        self.controller = controller or connection_controller
+        self.pool = pool or egress_pool
+        self.token = CancelToken()
+        self._unregister = cancel_token.on_cancel(self.token.cancel) if cancel_token else (lambda: None)
+        self.progress_callback = progress_callback
+        self._cond = threading.Condition()
+        self._running = 0
+        self._attempts = collections.Counter()
+        self._errors = []
+
+    def run(self):
+        slot = self.controller.open_transfer()
+        try:
+            for file in self.files:
+                if not file.complete:
+                    self._open(file, slot)
+            while not all(file.complete for file in self.files):
+                with self._cond:
+                    if self._errors:
+                        raise self._errors[0]
+                    self.token.raise_if_cancelled()
+                    missing = sum(file._missing for file in self.files)
+                    slot.demand = max(1, min(missing, MAX_SEGMENTS_AHEAD))
+                    while self._running < slot.allowed():
+                        choice = self._pick()
+                        if choice is None:
+                            break
+                        self._start(slot, *choice)
+                    self._cond.wait(0.1)
+                self._report()
+            for file in self.files:
+                file.verify()
+            self._report()
+        except BaseException as e:
+            self.token.cancel()
+            for file in self.files:
+                file.fail(e if not isinstance(e, Cancelled) else Cancelled("ยกเลิกการดาวน์โหลด"))
+            raise
+        finally:
+            slot.close()
+            self._unregister()
+
+    def _open(self, file, slot):
+        # คำขอแรกบอกขนาดไฟล์ (Content-Range) แล้วข้อมูลที่ได้ก็ใช้เป็นก้อนแรกที่ยังขาด
+        part_path = file.path + ".part"
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        start = resume_from // STREAM_CHUNK_SIZE * STREAM_CHUNK_SIZE
+        route = self.pool.pick(file.url)
+        try:
+            response = _open_range(file.url, start, start + STREAM_REQUEST_CHUNKS * STREAM_CHUNK_SIZE - 1,
+                                   self.controller, route.session)
+        except (RequestException, OSError) as e:
+            self.pool.report(route, ok=False, error=e)
+            raise
+        total_size = range_total(response) if response.status_code == 206 else None
+        if response.status_code == 416 or total_size is None:
+            response.close()
+            self.pool.report(route)
+            if response.status_code == 416:
+                os.remove(part_path)
+                raise Exception("ไฟล์ที่ดาวน์โหลดค้างไว้ไม่ตรงกับไฟล์บนเซิร์ฟเวอร์")
+            raise RangeNotSupported("เซิร์ฟเวอร์ไม่รองรับการดาวน์โหลดบางช่วง (Range) จึงเล่นระหว่างดาวน์โหลดไม่ได้")
+        file.prepare(total_size, server_checksums(response, whole_body=False))
+        with self._cond:
+            run = file.reserve_at(start) if not file.complete else None
+            if run is None:
+                response.close()
+                self.pool.report(route)
+                return
+            self._start(slot, file, run, response, route)
+
+    def _pick(self):
+        for file in sorted((file for file in self.files if not file.complete), key=lambda f: f.buffered_ahead()):
+            run = file.next_run()
+            if run is not None:
+                return file, run
+        return None
+
+    def _start(self, slot, file, run, response=None, route=None):
+        self._running += 1
+        threading.Thread(target=self._fetch, args=(slot, file, run, response, route), daemon=True).start()
+
+    def _fetch(self, slot, file, run, response, route):
+        # ดึงหลายก้อนติดกันในคำขอเดียว แต่ละก้อนเขียนและเปิดให้ผู้อ่านทันทีที่ครบ ไม่ต้องรอทั้งคำขอ
+        first, count = run
+        start, end = file.chunk_range(first, count)
+        started = time.monotonic()
+        index = first
+        data = bytearray()
+        received = 0
+        retry = False
+        slot.acquire()
+        try:
+            self.token.raise_if_cancelled()
+            if response is None:
+                route = self.pool.pick(file.url)
+                response = _open_range(file.url, start, end, self.controller, route.session)
+            unregister_abort = self.token.on_cancel(lambda: abort_response(response))
+            try:
+                with response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise Exception("เซิร์ฟเวอร์ไม่ได้ส่งข้อมูลตามช่วงที่ขอ")
+                    for chunk in response.iter_content(chunk_size=65536):
+                        data += chunk
+                        received += len(chunk)
+                        self.controller.record(len(chunk))
+                        while index < first + count:
+                            chunk_start, chunk_end = file.chunk_range(index)
+                            if len(data) < chunk_end - chunk_start + 1:
+                                break
+                            file.write_chunk(index, bytes(data[:chunk_end - chunk_start + 1]))
+                            del data[:chunk_end - chunk_start + 1]
+                            index += 1
+            finally:
+                unregister_abort()
+            if index < first + count:
+                raise Exception(f"ได้ข้อมูลไม่ครบ ({received}/{end - start + 1} ไบต์)")
+            self.pool.report(route, received, time.monotonic() - started)
+        except Exception as e:
+            if route is not None:
+                if self.token.is_cancelled():
+                    self.pool.report(route)
+                else:
+                    self.pool.report(route, ok=False, error=e)
+            if not self.token.is_cancelled():
+                with self._cond:
+                    self._attempts[(file.path, index)] += 1
+                    # เขียนลงดิสก์ไม่ได้ (จาก write_chunk) ดึงใหม่ก็ไม่ช่วย
+                    disk_error = isinstance(e, StorageFull) or (isinstance(e, OSError)
+                                                                and not isinstance(e, RequestException))
+                    if disk_error or self._attempts[(file.path, index)] >= SEGMENT_RETRIES:
+                        self._errors.append(e)
+                    else:
+                        retry = True
+        finally:
+            slot.release()
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+        if index < first + count:
+            # ก้อนที่ยังไม่ได้คืนกลับไป (หลังพักตาม backoff ถ้าจะลองใหม่) แล้ว connection อื่นจะหยิบไปดึงต่อ
+            if retry:
+                try:
+                    sleep_or_cancel(backoff_delay(self._attempts[(file.path, index)] - 1), self.token)
+                except Cancelled:
+                    pass
+            for remaining in range(index, first + count):
+                file.retry_chunk(remaining)
+            with self._cond:
+                self._cond.notify_all()
+
+    def _report(self):
+        if self.progress_callback:
+            total = sum(file.total_size or 0 for file in self.files)
+            missing = sum(file._missing for file in self.files)
+            chunks = sum(len(file._have) for file in self.files if file._have is not None)
+            if total and chunks:
+                self.progress_callback((chunks - missing) / chunks * 100)
+
+def fetch_progressive(files, catalog=None, cancel_token=None, progress_callback=None, fallback_callback=None):
+    # เหมือน fetch_streams แต่ผู้อ่านไฟล์ระหว่างดาวน์โหลด (เล่นระหว่างดาวน์โหลด) กำหนดลำดับการดึงได้
+    # ถ้า CDN ไม่รองรับ Range จะเรียก fallback_callback แล้วดาวน์โหลดแบบปกติแทน
+    # คืน BLAKE2b ของแต่ละไฟล์ตามลำดับ files เหมือน fetch_streams
+    pending = []
+    for file in files:
+        cached = catalog.find_stream(file.url) if catalog is not None else None
+        if cached is not None:
+            get_storage_manager().touch(cached["path"])
+            file.adopt(cached["path"], cached["blake2b"])
+        else:
+            pending.append(file)
+    if not pending:
+        if progress_callback:
+            progress_callback(100)
+        return [file.digest for file in files]
+    should_stop = cancel_token.is_cancelled if cancel_token else None
+
+    def download(leaders):
+        if not leaders:
+            return
+        try:
+            ProgressiveDownload(leaders, cancel_token=cancel_token, progress_callback=progress_callback).run()
+        except RangeNotSupported as e:
+            print(f"Progressive download unavailable, downloading normally: {str(e)}")
+            if fallback_callback:
+                fallback_callback()
+            # ถือ key ของ stream เหล่านี้อยู่เอง จึงเรียก download_file ตรง ๆ ไม่ผ่าน download_shared
+            digests = fetch_parallel([(file.url, file.path) for file in leaders],
+                                     lambda url, path, report, token: download_file(url, path, report, token),
+                                     cancel_token, progress_callback)
+            for file, digest in zip(leaders, digests):
+                file.digest = digest
+
+    def claim(index, leaders):
+        # จองทีละ stream ด้วย key เดียวกับ download_shared ซ้อนกันตามลำดับไฟล์ (ทุกงานจองเรียงเหมือนกันจึงไม่ติดตาย)
+        # stream ที่งานอื่นกำลังดาวน์โหลดอยู่ (path ชั่วคราวเดียวกัน) รอผลของงานนั้นแล้วอ่านจากไฟล์ที่ได้
+        if index == len(pending):
+            return download(leaders)
+        file = pending[index]
+
+        def work(report):
+            claim(index + 1, leaders + [file])
+            return file.path, file.digest
+
+        (path, digest), shared = job_flights.do(("download", stream_key(file.url)), work, should_stop=should_stop)
+        if shared:
+            file.adopt(path, digest)
+            claim(index + 1, leaders)
+
+    claim(0, [])
+    return [file.digest for file in files]
+
+def segment_paths(result, temp_dir):
+    # ชื่อไฟล์ตามลำดับส่วน คงนามสกุลเดิม (.flv/.mp4) ให้ ffmpeg เดารูปแบบได้
+    paths = []
+    for index, url in enumerate(result.video_segments):
+        extension = os.path.splitext(urllib.parse.urlsplit(url).path)[1] or ".flv"
+        paths.append(os.path.join(temp_dir, f"temp_part_{result.video_quality}_{index:03d}{extension}"))
+    return paths
+
+def merge_tracks(result, all_audio_tracks=True):
+    # แทร็กเสียงที่จะรวม (หลายภาษา) ว่างเมื่อใช้แค่ audio_url หรือเป็น durl ที่มีเสียงในตัว
+    if result.segmented or not all_audio_tracks or len(result.audio_tracks) < 2:
+        return []
+    return result.audio_tracks
+
+def merge_streams(result, temp_dir, all_audio_tracks=True):
+    # ไฟล์ชั่วคราวของ download_and_merge [(url, path), ...] วิดีโอ (ทุกส่วน) ก่อนตามด้วยเสียง
+    # ชื่อคงที่ต่อคุณภาพ ไฟล์ .part ที่ค้างไว้หรือที่ prefetch ไว้จึงถูกใช้ต่อได้
+    if result.segmented:
+        return list(zip(result.video_segments, segment_paths(result, temp_dir)))
+    streams = [(result.video_url, os.path.join(temp_dir, f"temp_video_{result.video_quality}.mp4"))]
+    tracks = merge_tracks(result, all_audio_tracks)
+    if tracks:
+        streams += [(track.url, os.path.join(temp_dir, f"temp_audio_{track.quality}_{track.language}.m4s"))
+                    for track in tracks]
+    else:
+        streams.append((result.audio_url, os.path.join(temp_dir, f"temp_audio_{result.audio_quality}.m4s")))
+    return streams
+
+def stream_kinds(result, all_audio_tracks=True):
+    # (kind, quality) ของแต่ละ stream ใน catalog ตามลำดับเดียวกับ merge_streams
+    if result.segmented:
+        return [("video", result.video_quality)] * len(result.video_segments)
+    tracks = merge_tracks(result, all_audio_tracks)
+    return [("video", result.video_quality)] + ([("audio", track.quality) for track in tracks] if tracks
+                                                 else [("audio", result.audio_quality)])
+
+def record_merge_streams(catalog, result, streams, digests=None, all_audio_tracks=True):
+    # บันทึก stream ที่ดาวน์โหลดไว้พร้อม BLAKE2b เมื่อรวมไฟล์ล้มเหลว งานที่สั่งซ้ำจะใช้ไฟล์เหล่านี้ได้เลย
+    # stream ที่มีใน catalog อยู่แล้วไม่บันทึกทับ
+    digests = digests or [None] * len(streams)
+    for (url, path), (kind, quality), digest in zip(streams, stream_kinds(result, all_audio_tracks), digests):
+        if catalog.find_stream(url) is None:
+            catalog.record_stream(url, path, result.aid, kind, quality, digest)
+
+def download_and_merge(url, output_path, progress_callback=None, status_callback=None, catalog=None,
+                       cancel_token=None, all_audio_tracks=True, preview_callback=None, stream_callback=None):
+    # ขั้นตอนของโหมดง่ายแบบไม่ผูกกับ GUI: resolve -> ดาวน์โหลดวิดีโอ/เสียง -> รวมไฟล์
+    # ถ้ามีเสียงหลายภาษา จะดาวน์โหลดทุกภาษาพร้อมกันแล้วรวมเป็นไฟล์เดียวพร้อมแท็กภาษา
+    # preview_callback(คลิป, แถบภาพย่อ) ถูกเรียกทันทีที่ fragment แรกของวิดีโอและเสียงมาถึง
+    # stream_callback([ProgressiveFile, ...]) ถ้ากำหนด จะดาวน์โหลดแบบให้ player อ่านระหว่างดาวน์โหลดได้
+    report = progress_callback or (lambda progress: None)
+    status = status_callback or (lambda message: None)
+
+    aid = extract_aid_from_url(url)
+    if not aid:
+        raise JobInputError("ไม่สามารถดึง aid จาก URL ได้")
+    # HLS ใส่เสียงได้แทร็กเดียว ใช้เฉพาะเสียงหลักตั้งแต่ก่อนดาวน์โหลด ไม่ต้องโหลดทุกภาษาแล้วไปล้มตอนรวมไฟล์
+    hls_single_audio = all_audio_tracks and output_format_for(output_path) == OUTPUT_FORMAT_HLS
+    if hls_single_audio:
+        all_audio_tracks = False
+
+    def reuse(existing):
+        status("พบไฟล์ที่เคยดาวน์โหลดไว้แล้ว")
+        get_storage_manager().touch(existing["path"])
+        link_or_copy(existing["path"], output_path)
+        if os.path.abspath(existing["path"]) != os.path.abspath(output_path):
+            catalog.record_output(aid, output_path, existing["video_quality"], existing["audio_quality"],
+                                  digest=existing["blake2b"], all_audio_tracks=all_audio_tracks,
+                                  audio_tracks=existing["audio_tracks"])
+        report(100)
+        return output_path
+
+    # เคยรวมไฟล์ของ aid นี้ไว้แล้วที่คุณภาพสูงสุดและชุดแทร็กเสียงแบบเดียวกัน ไม่ต้องเรียก API หรือดาวน์โหลดซ้ำ
+    # ใช้ซ้ำได้เฉพาะ MP4 ไฟล์เดียว HLS/DASH มีไฟล์ segment อยู่ข้าง playlist คัดลอกไฟล์เดียวไม่ครบ
+    reusable = catalog is not None and output_format_for(output_path) == OUTPUT_FORMAT_MP4
+    if reusable:
+        existing = catalog.find_output(aid, PREFERRED_VIDEO_QUALITY, all_audio_tracks=all_audio_tracks,
+                                       output_format=OUTPUT_FORMAT_MP4)
+        if existing is not None:
+            return reuse(existing)
+
+    # ดึง URL วิดีโอและเสียง
+    status("กำลังดึงข้อมูล URL...")
+    result = resolve_playurl(aid, cancel_token=cancel_token)
+    if hls_single_audio and len(result.audio_tracks) > 1:
+        status("HLS รองรับเสียงแทร็กเดียว จะใช้เฉพาะเสียงหลัก (ใช้ .mp4 หรือ .mpd เพื่อเก็บทุกภาษา)")
+
+    tracks = merge_tracks(result, all_audio_tracks)
+    audio_tracks = [track.language for track in tracks]
+    # วิดีโอที่ไม่มีคุณภาพสูงสุดให้ ใช้ไฟล์เดิมได้ถ้าคุณภาพและแทร็กตรงกับที่ API ให้มาตอนนี้
+    if reusable:
+        existing = catalog.find_output(aid, result.video_quality, audio_tracks=audio_tracks,
+                                       output_format=OUTPUT_FORMAT_MP4)
+        if existing is not None:
+            return reuse(existing)
+
+    temp_dir = job_temp_dir(f"merge_{aid}")
+    streams = merge_streams(result, temp_dir, all_audio_tracks)
+    if result.segmented:
+        # durl: ดาวน์โหลดทุกส่วนพร้อมกัน (แบ่งงบ connection กัน) เสียงอยู่ในแต่ละส่วนแล้ว
+        video_urls = [url for url, path in streams]
+        video_paths = [path for url, path in streams]
+    else:
+        video_path = streams[0][1]
+        audio_urls = [url for url, path in streams[1:]]
+        audio_paths = [path for url, path in streams[1:]]
+        audio_languages = [track.iso_language for track in tracks] if tracks else None
+
+    # จองพื้นที่ก่อนเริ่ม ดิสก์จะไม่เต็มกลางทาง (ลบไฟล์ชั่วคราวเก่าให้ถ้าจำเป็น)
+    reservation = reserve_job_storage(result, streams, temp_dir, output_path, cancel_token=cancel_token,
+                                      status_callback=status)
+
+    files = None
+    if stream_callback and not result.segmented:
+        languages = [None] + (audio_languages or [None] * len(audio_paths))
+        files = [ProgressiveFile(url, path, language) for (url, path), language in zip(streams, languages)]
+        stream_callback(files)
+
+    preview = None
+    if preview_callback and not result.segmented:
+        sources = files or [video_path] + audio_paths
+        preview = PreviewTask(sources[0], sources[1] if len(sources) > 1 else None,
+                              os.path.join(temp_dir, "preview"), preview_callback, cancel_token)
+
+    try:
+        # ดาวน์โหลดวิดีโอและเสียงทุกแทร็กพร้อมกัน 80% รวมไฟล์ 20%
+        if result.segmented:
+            status(f"กำลังดาวน์โหลดวิดีโอ {len(video_urls)} ส่วน...")
+        else:
+            status("กำลังดาวน์โหลดวิดีโอและเสียง..." if not tracks
+                   else f"กำลังดาวน์โหลดวิดีโอและเสียง {len(tracks)} ภาษา...")
+        report(0)
+        if files:
+            # CDN ไม่รองรับ Range: ยังดาวน์โหลดและรวมไฟล์ได้ตามปกติ เพียงแต่ไม่มีลิงก์เล่นระหว่างดาวน์โหลด
+            digests = fetch_progressive(files, catalog, cancel_token, lambda progress: report(progress * 0.8),
+                                        lambda: stream_callback(None))
+        else:
+            digests = fetch_streams(streams, catalog, cancel_token, lambda progress: report(progress * 0.8))
+
+        # รวมไฟล์
+        status("กำลังรวมไฟล์...")
+        report(80)
+        try:
+            if result.segmented:
+                merge_shared(video_urls, None, video_paths, None, output_path, cancel_token=cancel_token,
+                             segment_durations=result.segment_durations)
+            elif tracks:
+                merge_shared(result.video_url, audio_urls, video_path, audio_paths, output_path,
+                             cancel_token=cancel_token, audio_languages=audio_languages)
+            else:
+                merge_shared(result.video_url, result.audio_url, video_path, audio_paths[0], output_path,
+                             cancel_token=cancel_token)
+        except Exception:
+            # รวมไฟล์ไม่สำเร็จ ไฟล์ชั่วคราวยังอยู่ บันทึกไว้ให้งานที่สั่งซ้ำใช้ได้เลย
+            # (เมื่อสำเร็จไม่บันทึก เพราะโฟลเดอร์ชั่วคราวจะถูกลบ)
+            if catalog is not None:
+                record_merge_streams(catalog, result, streams, digests, all_audio_tracks)
+            raise
+
+        if catalog is not None:
+            catalog.record_output(aid, output_path, result.video_quality, result.audio_quality,
+                                  result.video_url, result.audio_url, all_audio_tracks=all_audio_tracks,
+                                  audio_tracks=audio_tracks)
+        report(100)
+        status("ดำเนินการเสร็จสิ้น")
+    except Cancelled:
+        # เก็บไฟล์ชั่วคราวไว้ให้สั่งงานเดิมซ้ำแล้วดาวน์โหลดต่อได้
+        status("ยกเลิกแล้ว (เก็บไฟล์ที่ดาวน์โหลดไว้สำหรับทำต่อ)")
+        raise
+    finally:
+        if preview:
+            preview.stop()
+        for file in files or []:
+            file.release()
+        reservation.release()
+    # ลบไฟล์ชั่วคราว
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    get_storage_manager().forget(temp_dir)
+    return output_path
+
+# จำนวนตอนถัดไปที่ดาวน์โหลดล่วงหน้า
+PREFETCH_EPISODES = 2
+
+# ข้อมูลที่หน้าเว็บฝังไว้ให้สคริปต์ของหน้า (มีรายการตอนของ season อยู่ในนี้)
+_PAGE_STATE_RE = re.compile(r"window\.__(?:initialState|INITIAL_STATE__)\s*=\s*")
+# key ที่เก็บรายการตอน: sections -> episodes (season ที่แบ่งเป็นหลายภาค) หรือ episodes ตรง ๆ
+_SEASON_SECTION_KEYS = ("sections", "section_list")
+_SEASON_EPISODE_KEYS = ("episodes", "episode_list", "eps")
+
+def page_state(html):
+    match = _PAGE_STATE_RE.search(html)
+    if not match:
+        return None
+    try:
+        state, _ = json.JSONDecoder().raw_decode(html, match.end())
+    except ValueError:
+        return None
+    return state
+
+def _episode_aids(items):
+    # aid ของรายการตอน None ถ้าไม่ใช่รายการตอน (มีรายการที่ไม่มี aid ปน)
+    if not isinstance(items, list) or not items:
+        return None
+    aids = [str(item["aid"]) for item in items if isinstance(item, dict) and item.get("aid")]
+    return aids if len(aids) == len(items) else None
+
+def _node_episode_aids(node):
+    for key in _SEASON_EPISODE_KEYS:
+        aids = _episode_aids(node.get(key))
+        if aids:
+            return aids
+    return None
+
+def _season_candidates(node):
+    # รายการตอนทุกชุดใน state ตามลำดับที่พบ รายการที่รวมทุก section มาก่อนรายการของแต่ละ section
+    if isinstance(node, dict):
+        for key in _SEASON_SECTION_KEYS:
+            sections = node.get(key)
+            if isinstance(sections, list) and sections:
+                parts = [_node_episode_aids(section) if isinstance(section, dict) else None
+                         for section in sections]
+                if all(parts):
+                    yield [aid for part in parts for aid in part]
+        aids = _node_episode_aids(node)
+        if aids:
+            yield aids
+        for value in node.values():
+            yield from _season_candidates(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _season_candidates(value)
+
+def season_episodes(url, session=None):
+    # รายการตอนของ season ตามลำดับ จากข้อมูล season ที่หน้าของตอนฝังไว้
+    # ไม่ใช้ลิงก์ทั้งหมดในหน้า เพราะมีวิดีโอแนะนำ/ที่เกี่ยวข้องปนอยู่ ไม่เจอรายการที่มีตอนนี้อยู่ก็คืน []
+    aid = extract_aid_from_url(url)
+    if not aid or not url.startswith(("http://", "https://")):
+        return []
+    getter = session.get if session is not None else requests.get
+    response = getter(url, headers=BILIBILI_HEADERS, timeout=API_TIMEOUT)
+    response.raise_for_status()
+    state = page_state(response.text)
+    for aids in _season_candidates(state):
+        if aid in aids:
+            return list(dict.fromkeys(aids))
+    return []
+
+class SeasonPrefetcher:
+    # ดาวน์โหลดตอนถัดไปของ season ไว้ล่วงหน้าทีละตอนด้วยแบนด์วิดท์ที่ว่าง (background transfer)
+    # ไฟล์ถูกเขียนลงไฟล์ชั่วคราวเดียวกับที่ download_and_merge ใช้ (merge_streams)
+    # เมื่อผู้ใช้สั่งตอนนั้นจริง claim() จะหยุด prefetch แล้วงานจริงดาวน์โหลดต่อจาก .part
+    # หรือเจอไฟล์ที่เสร็จแล้วใน catalog ถ้าผู้ใช้ข้ามไป season อื่น ไฟล์ที่ prefetch ไว้จะถูกลบทิ้ง
+    def __init__(self, depth=PREFETCH_EPISODES, catalog=None):
+        self.depth = depth
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        # ให้ follow ทำงานทีละครั้ง (โหลดหน้า season ไม่ซ้อนกัน)
+        self._follow_lock = threading.Lock()
+        self._season = []
+        self._queue = []
+        self._claimed = set()
+        self._prefetched = set()
+        self._current = None
+        self._worker = None
+
+    def follow(self, url):
+        # ผู้ใช้เริ่มดาวน์โหลดตอนหนึ่ง: จัดคิวตอนถัดไปใน thread เบื้องหลัง
+        aid = extract_aid_from_url(url)
+        if aid:
+            threading.Thread(target=self._follow, args=(url, aid), daemon=True).start()
+
+    def _follow(self, url, aid):
+        with self._follow_lock:
+            with self._lock:
+                known = aid in self._season
+            if not known:
+                try:
+                    episodes = season_episodes(url)
+                except (RequestException, OSError) as e:
+                    print(f"Prefetch: cannot load season page for {aid}: {str(e)}")
+                    episodes = []
+                # ตอนนี้ไม่อยู่ใน season เดิม: ทิ้งของที่ prefetch ไว้ทั้งหมด
+                self.discard()
+                with self._lock:
+                    self._season = episodes if aid in episodes else [aid]
+            with self._lock:
+                position = self._season.index(aid)
+                self._queue = [episode for episode in self._season[position + 1:position + 1 + self.depth]
+                               if episode not in self._claimed]
+                if self._queue and self._worker is None:
+                    self._worker = threading.Thread(target=self._run, daemon=True)
+                    self._worker.start()
+
+    def claim(self, url):
+        # ผู้ใช้จะดาวน์โหลดตอนนี้เอง: หยุด prefetch ของตอนนี้และรอให้เลิกเขียนไฟล์ก่อน
+        aid = extract_aid_from_url(url)
+        if not aid:
+            return
+        with self._lock:
+            self._claimed.add(aid)
+            self._prefetched.discard(aid)
+            if aid in self._queue:
+                self._queue.remove(aid)
+            current = self._current if self._current and self._current[0] == aid else None
+        if current:
+            current[1].cancel()
+            current[2].wait(10)
+
+    def discard(self):
+        # หยุดทุกอย่างและลบไฟล์ชั่วคราวของตอนที่ prefetch ไว้แต่ยังไม่มีใครใช้
+        with self._lock:
+            self._queue = []
+            self._season = []
+            current = self._current
+        if current:
+            current[1].cancel()
+            current[2].wait(10)
+        with self._lock:
+            discarded = self._prefetched - self._claimed
+            self._prefetched -= discarded
+        for aid in discarded:
+            print(f"Prefetch: discarding episode {aid}")
+            temp_dir = job_temp_dir(f"merge_{aid}")
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            get_storage_manager().forget(temp_dir)
+
+    def shutdown(self):
+        self.discard()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._worker = None
+                    return
+                aid = self._queue.pop(0)
+                current = (aid, CancelToken(), threading.Event())
+                self._current = current
+            try:
+                self._prefetch(aid, current[1])
+            except Cancelled:
+                pass
+            except Exception as e:
+                print(f"Prefetch of {aid} failed: {str(e)}")
+            finally:
+                with self._lock:
+                    self._current = None
+                current[2].set()
+
+    def _prefetch(self, aid, token):
+        catalog = self.catalog or get_catalog()
+        if catalog.find_output(aid, PREFERRED_VIDEO_QUALITY, all_audio_tracks=True,
+                               output_format=OUTPUT_FORMAT_MP4) is not None:
+            return
+        result = resolve_playurl(aid, cancel_token=token)
+        if catalog.find_output(aid, result.video_quality,
+                               audio_tracks=[track.language for track in merge_tracks(result)],
+                               output_format=OUTPUT_FORMAT_MP4) is not None:
+            return
+        with self._lock:
+            if aid in self._claimed:
+                return
+            self._prefetched.add(aid)
+        temp_dir = job_temp_dir(f"merge_{aid}")
+        streams = merge_streams(result, temp_dir)
+        # ไม่รอพื้นที่จากงานอื่น ถ้าไม่พอก็ไม่ต้อง prefetch
+        try:
+            reservation = get_storage_manager().reserve(
+                [(temp_dir, estimate_stream_bytes(result, [url for url, path in streams]))], token, wait=False)
+        except StorageFull as e:
+            print(f"Prefetch: skipping episode {aid}: {str(e)}")
+            return
+        try:
+            for (url, path), (kind, quality) in zip(streams, stream_kinds(result)):
+                if catalog.find_stream(url) is not None:
+                    continue
+                digest = download_file(url, path, cancel_token=token, background=True)
+                catalog.record_stream(url, path, aid, kind, quality, digest)
+        finally:
+            reservation.release()
+        print(f"Prefetch: episode {aid} is ready")
+
+def parse_timestamp(text):
+    # รับได้ทั้ง "90", "1:30", "0:01:30.5" และตัวเลขวินาที (จาก JSON เช่น "start": 90)
+    if isinstance(text, (int, float)) and not isinstance(text, bool):
+        seconds = float(text)
+    elif isinstance(text, str):
+        seconds = 0.0
+        try:
+            for part in text.strip().split(":"):
+                seconds = seconds * 60 + float(part)
+        except ValueError:
+            raise ValueError(f"รูปแบบเวลาไม่ถูกต้อง: {text!r} (ใช้วินาทีหรือ ชม:นาที:วินาที)") from None
+    else:
+        raise ValueError(f"เวลาต้องเป็นตัวเลขวินาทีหรือข้อความ เช่น \"1:30\" ไม่ใช่ {type(text).__name__}")
+    if not 0 <= seconds < float("inf"):
+        raise ValueError(f"เวลาต้องเป็นจำนวนวินาทีตั้งแต่ 0 ขึ้นไป: {text!r}")
+    return seconds
+
+def fetch_range(session, url, start, end):
+    # ดึงไบต์ช่วง [start, end] (รวมปลาย) ทั้งก้อน
+    response = session.get(url, headers={"Range": f"bytes={start}-{end}"})
+    response.raise_for_status()
+    if response.status_code != 206:
+        raise ValueError("เซิร์ฟเวอร์ไม่รองรับการดาวน์โหลดบางช่วง (Range)")
+    return response.content
+
+def iter_mp4_boxes(data, offset=0, end=None):
+    # คืน (ชนิด, ตำแหน่งเริ่ม, ขนาด, ขนาด header) ของ box ในช่วงที่กำหนด
+    # box สุดท้ายอาจยาวเกินข้อมูลที่มีอยู่ ผู้เรียกต้องตรวจเองถ้าจะอ่านเนื้อหา
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            raise ValueError("โครงสร้างไฟล์ MP4 ไม่ถูกต้อง")
+        yield box_type.decode("latin-1"), offset, size, header
+        offset += size
+
+def find_mp4_box(data, path, offset=0, end=None):
+    # หา box ซ้อนตาม path เช่น ["moov", "trak", "mdia", "mdhd"]
+    for box_type, start, size, header in iter_mp4_boxes(data, offset, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return start, size, header
+            return find_mp4_box(data, path[1:], start + header, min(start + size, len(data)))
+    return None
+
+def _full_box_time(data, box, v0_skip, v1_skip, v1_size):
+    # อ่านค่าเวลาใน full box (version 0 เป็น 32 บิต, version 1 เป็น 64 บิต)
+    start, size, header = box
+    pos = start + header
+    version = data[pos]
+    if version == 1:
+        return struct.unpack_from(">Q" if v1_size == 8 else ">I", data, pos + 4 + v1_skip)[0]
+    return struct.unpack_from(">I", data, pos + 4 + v0_skip)[0]
+
+class FragmentIndex:
+    # ตำแหน่งของ fragment ใน m4s แบบ DASH จาก sidx
+    # fragments: รายการ (เวลาเริ่ม, เวลาจบ, ไบต์แรก, ไบต์สุดท้าย) หน่วยวินาทีและไบต์
+    def __init__(self, init_data, timescale, fragments):
+        self.init_data = init_data  # ftyp + moov
+        self.timescale = timescale
+        self.fragments = fragments
+
+    def select(self, start, end):
+        # fragment แรกที่เริ่มก่อนหรือตรงกับ start (ขึ้นต้นด้วย keyframe) ถึงตัวแรกที่ครอบ end
+        first = 0
+        for i, fragment in enumerate(self.fragments):
+            if fragment[0] <= start:
+                first = i
+            else:
+                break
+        last = len(self.fragments) - 1
+        for i in range(first, len(self.fragments)):
+            if self.fragments[i][1] >= end:
+                last = i
+                break
+        return first, last
+
+def parse_sidx(data, start, size, header):
+    pos = start + header
+    version = data[pos]
+    pos += 4
+    _, timescale = struct.unpack_from(">II", data, pos)
+    pos += 8
+    if version == 0:
+        earliest, first_offset = struct.unpack_from(">II", data, pos)
+        pos += 8
+    else:
+        earliest, first_offset = struct.unpack_from(">QQ", data, pos)
+        pos += 16
+    _, count = struct.unpack_from(">HH", data, pos)
+    pos += 4
+
+    # offset ของ fragment นับจากท้าย sidx
+    byte = start + size + first_offset
+    t = earliest
+    fragments = []
+    for _ in range(count):
+        reference, duration, _ = struct.unpack_from(">III", data, pos)
+        pos += 12
+        if reference & 0x80000000:
+            raise JobInputError("ไม่รองรับ sidx แบบอ้างอิง sidx ซ้อนกัน")
+        referenced_size = reference & 0x7FFFFFFF
+        fragments.append((t / timescale, (t + duration) / timescale, byte, byte + referenced_size - 1))
+        t += duration
+        byte += referenced_size
+    return timescale, fragments
+
+def load_fragment_index(session, url, probe_size=64 * 1024):
+    # อ่านหัวไฟล์จนได้ moov และ sidx ครบ ปกติใช้คำขอเดียว
+    want = probe_size
+    while True:
+        data = fetch_range(session, url, 0, want - 1)
+        init_end = None
+        for box_type, start, size, header in iter_mp4_boxes(data):
+            if box_type == "moov":
+                init_end = start + size
+            elif box_type == "sidx":
+                if start + size > len(data):
+                    want = start + size
+                    break
+                if init_end is None or init_end > len(data):
+                    raise ValueError("ไม่พบ moov ก่อน sidx")
+                timescale, fragments = parse_sidx(data, start, size, header)
+                return FragmentIndex(data[:init_end], timescale, fragments)
+            elif box_type in ("moof", "mdat"):
+                raise JobInputError("ไฟล์นี้ไม่มี sidx จึงตัดช่วงเวลาไม่ได้")
+        else:
+            if len(data) < want:
+                raise ValueError("ไม่พบ sidx ในไฟล์")
+            want *= 2
+
+def clip_stream(session, url, start, end, output_path, progress_callback=None, cancel_token=None):
+    # ดาวน์โหลดเฉพาะ init segment และ fragment ที่ครอบช่วงเวลา แล้วต่อกันเป็นไฟล์ fMP4
+    # คืนเวลา decode (วินาที) ของเฟรมแรกที่ได้ ใช้ตัดให้ตรง keyframe ตอน mux
+    index = load_fragment_index(session, url)
+    first, last = index.select(start, end)
+    byte_start = index.fragments[first][2]
+    byte_end = index.fragments[last][3]
+    total = byte_end - byte_start + 1
+
+    first_decode = None
+    with open(output_path, 'wb') as f:
+        f.write(index.init_data)
+        response = session.get(url, headers={"Range": f"bytes={byte_start}-{byte_end}"}, stream=True,
+                               timeout=DOWNLOAD_TIMEOUT)
+        unregister = cancel_token.on_cancel(lambda: abort_response(response)) if cancel_token else None
+        with response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise ValueError("เซิร์ฟเวอร์ไม่รองรับการดาวน์โหลดบางช่วง (Range)")
+            head = b""
+            downloaded = 0
+            for chunk in response.iter_content(chunk_size=65536):
+                f.write(chunk)
+                downloaded += len(chunk)
+                if first_decode is None and len(head) < 65536:
+                    head += chunk
+                    first_decode = _first_decode_time(index.init_data, head)
+                if progress_callback:
+                    progress_callback(downloaded / total * 100)
+        if unregister:
+            unregister()
+    if cancel_token:
+        cancel_token.raise_if_cancelled()
+    if downloaded != total:
+        raise ValueError("ดาวน์โหลดช่วงข้อมูลไม่ครบ")
+    if first_decode is None:
+        first_decode = index.fragments[first][0]
+    return first_decode
+
+def _first_decode_time(init_data, moof_data):
+    # baseMediaDecodeTime ของ moof แรก หารด้วย timescale ของ track จาก mdhd
+    tfdt = find_mp4_box(moof_data, ["moof", "traf", "tfdt"])
+    mdhd = find_mp4_box(init_data, ["moov", "trak", "mdia", "mdhd"])
+    if tfdt is None or mdhd is None or tfdt[0] + tfdt[1] > len(moof_data):
+        return None
+    timescale = _full_box_time(init_data, mdhd, 8, 16, 4)
+    return _full_box_time(moof_data, tfdt, 0, 0, 8) / timescale
+
+def build_clip_command(video_path, audio_path, output_path, start, end):
+    # -copyts คง timestamp จริงของทั้งสอง stream ให้ตรงกัน แล้วเริ่มที่ keyframe แรกของวิดีโอ
+    return [
+        'ffmpeg',
+        '-copyts',
+        '-i', video_path,
+        '-i', audio_path,
+        '-map', '0:v:0',
+        '-map', '1:a:0',
+        '-c', 'copy',
+        '-ss', f"{start:.6f}",
+        '-to', f"{end:.6f}",
+        '-y',
+        output_path
+    ]
+
+def download_clip(url, start, end, output_path, progress_callback=None, status_callback=None,
+                  cancel_token=None):
+    # ดาวน์โหลดเฉพาะช่วงเวลา start-end (วินาที) ใช้ไบต์ใกล้เคียงกับความยาวช่วงที่ต้องการ
+    report = progress_callback or (lambda progress: None)
+    status = status_callback or (lambda message: None)
+    if end <= start:
+        raise JobInputError("เวลาสิ้นสุดต้องมากกว่าเวลาเริ่มต้น")
+
+    aid = extract_aid_from_url(url)
+    if not aid:
+        raise JobInputError("ไม่สามารถดึง aid จาก URL ได้")
+
+    status("กำลังดึงข้อมูล URL...")
+    result = resolve_playurl(aid, cancel_token=cancel_token)
+    if result.segmented:
+        # การตัดช่วงอาศัย sidx ของ fragmented MP4 ซึ่งไฟล์ durl (FLV/MP4 ธรรมดา) ไม่มี
+        raise JobInputError("วิดีโอแบบแบ่งหลายส่วนยังไม่รองรับการตัดช่วงเวลา")
+
+    temp_root = job_temp_root()
+    os.makedirs(temp_root, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=temp_root)
+    video_path = os.path.join(temp_dir, "clip_video.mp4")
+    audio_path = os.path.join(temp_dir, "clip_audio.m4s")
+
+    session = cdn_session
+    try:
+        status("กำลังดาวน์โหลดวิดีโอช่วงที่เลือก...")
+        report(0)
+        video_start = clip_stream(session, result.video_url, start, end, video_path,
+                                  lambda progress: report(progress * 0.45), cancel_token)
+
+        status("กำลังดาวน์โหลดเสียงช่วงที่เลือก...")
+        report(45)
+        clip_stream(session, result.audio_url, start, end, audio_path,
+                    lambda progress: report(45 + progress * 0.45), cancel_token)
+
+        status("กำลังตัดต่อคลิป...")
+        report(90)
+        run_ffmpeg(build_clip_command(video_path, audio_path, output_path, video_start, end),
+                   cancel_token=cancel_token)
+        get_storage_manager().track(output_path)
+        report(100)
+        status("ดำเนินการเสร็จสิ้น")
+        return output_path
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+# ตัวอย่างก่อนดาวน์โหลดเสร็จ: คลิปสั้นจากช่วงต้นเรื่องและภาพย่อเรียงเป็นแถบเดียว
+PREVIEW_SECONDS = 8
+PREVIEW_THUMBNAILS = 6
+PREVIEW_THUMBNAIL_WIDTH = 160
+# อ่านส่วนหัวของไฟล์ที่กำลังดาวน์โหลดไม่เกินเท่านี้ (พอสำหรับ PREVIEW_SECONDS ที่ความละเอียดสูง)
+PREVIEW_MAX_BYTES = 16 * 1024 * 1024
+PREVIEW_POLL = 0.2
+# หลัง fragment แรกมาถึง รอให้ได้ครบ PREVIEW_SECONDS ไม่เกินเท่านี้ก่อนใช้เท่าที่มี
+PREVIEW_PATIENCE = 3.0
+
+def fragment_prefix(data, seconds=PREVIEW_SECONDS):
+    # คืน (ความยาวส่วนหัวของ fragmented MP4 ที่มี init segment และ fragment ที่ครบแล้ว, ครอบ seconds วินาทีแรกหรือยัง)
+    # ความยาวเป็น None ถ้ายังไม่มี fragment แรกครบ
+    init_end = None
+    timescale = None
+    first_time = None
+    fragments = 0
+    prefix = None
+    for box_type, start, size, header in iter_mp4_boxes(data):
+        if start + size > len(data):
+            break
+        if box_type == "moov":
+            init_end = start + size
+            mdhd = find_mp4_box(data, ["trak", "mdia", "mdhd"], start + header, init_end)
+            timescale = _full_box_time(data, mdhd, 8, 16, 4) if mdhd else None
+        elif box_type == "moof":
+            if init_end is None:
+                raise ValueError("ไม่พบ moov ก่อน fragment แรก")
+            fragments += 1
+            tfdt = find_mp4_box(data, ["traf", "tfdt"], start + header, start + size)
+            if tfdt is not None and timescale:
+                decode_time = _full_box_time(data, tfdt, 0, 0, 8) / timescale
+                if first_time is None:
+                    first_time = decode_time
+                elif decode_time - first_time >= seconds:
+                    return prefix, True
+        elif box_type == "mdat":
+            if not fragments:
+                raise ValueError("ไฟล์นี้ไม่ใช่ fragmented MP4 จึงสร้างตัวอย่างระหว่างดาวน์โหลดไม่ได้")
+            prefix = start + size
+    return prefix, False
+
+def _read_head(source):
+    # คืน (ส่วนหัวที่มีแล้ว, ไฟล์ครบแล้วหรือยัง) source เป็น path หรือ ProgressiveFile ที่กำลังดาวน์โหลด
+    if isinstance(source, ProgressiveFile):
+        return source.head(PREVIEW_MAX_BYTES)
+    for candidate in (source, source + ".part"):
+        try:
+            with open(candidate, 'rb') as f:
+                return f.read(PREVIEW_MAX_BYTES), candidate == source
+        except FileNotFoundError:
+            continue
+    return b"", False
+
+def wait_for_fragments(path, seconds=PREVIEW_SECONDS, cancel_token=None, poll=PREVIEW_POLL,
+                       patience=PREVIEW_PATIENCE):
+    # รอจนไฟล์ที่กำลังดาวน์โหลด (.part หรือไฟล์ที่เสร็จแล้ว) มี init segment และ fragment แรกครบ
+    # download_file เขียน .part ต่อท้ายตามลำดับเสมอ ส่วนหัวที่อ่านได้จึงเป็นข้อมูลจริงของไฟล์
+    first_seen = None
+    while True:
+        data, complete = _read_head(path)
+        end, covered = fragment_prefix(data, seconds)
+        if end is not None:
+            first_seen = first_seen or time.monotonic()
+            # ไฟล์เสร็จแล้วหรืออ่านเต็มขนาดแล้วก็ไม่มีอะไรเพิ่ม รอนานพอแล้วก็ใช้เท่าที่มี
+            if (covered or complete or len(data) == PREVIEW_MAX_BYTES
+                    or time.monotonic() - first_seen >= patience):
+                return data[:end]
+        sleep_or_cancel(poll, cancel_token)
+
+def build_preview_command(video_path, audio_path, output_path, seconds=PREVIEW_SECONDS):
+    command = ['ffmpeg', '-i', video_path]
+    if audio_path:
+        command += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0']
+    return command + [
+        '-c', 'copy',
+        '-t', str(seconds),
+        '-movflags', '+faststart',
+        '-y',
+        output_path
+    ]
+
+def build_thumbnail_command(video_path, output_path, seconds=PREVIEW_SECONDS, count=PREVIEW_THUMBNAILS,
+                            width=PREVIEW_THUMBNAIL_WIDTH):
+    # เลือกภาพเท่า ๆ กันตลอดช่วงตัวอย่างแล้วเรียงต่อกันเป็นภาพเดียว
+    return [
+        'ffmpeg',
+        '-i', video_path,
+        '-vf', f"fps={count}/{seconds},scale={width}:-2,tile={count}x1",
+        '-frames:v', '1',
+        '-y',
+        output_path
+    ]
+
+def generate_preview(video_path, audio_path, preview_dir, seconds=PREVIEW_SECONDS, cancel_token=None):
+    # คืน (คลิปตัวอย่าง, แถบภาพย่อ) ใช้แค่ส่วนหัวของไฟล์ที่การดาวน์โหลดหลักเขียนอยู่ ไม่ดาวน์โหลดซ้ำ
+    os.makedirs(preview_dir, exist_ok=True)
+    heads = []
+    for name, path in (("video", video_path), ("audio", audio_path)):
+        if path is None:
+            heads.append(None)
+            continue
+        head_path = os.path.join(preview_dir, f"head_{name}.mp4")
+        with open(head_path, 'wb') as f:
+            f.write(wait_for_fragments(path, seconds, cancel_token))
+        heads.append(head_path)
+
+    clip_path = os.path.join(preview_dir, "preview.mp4")
+    strip_path = os.path.join(preview_dir, "thumbnails.jpg")
+    run_ffmpeg(build_preview_command(heads[0], heads[1], clip_path, seconds), cancel_token=cancel_token)
+    run_ffmpeg(build_thumbnail_command(heads[0], strip_path, seconds), cancel_token=cancel_token)
+    return clip_path, strip_path
+
+class PreviewTask:
+    # สร้างตัวอย่างใน thread แยกคู่กับการดาวน์โหลดหลัก callback(คลิป, แถบภาพย่อ) ถูกเรียกเมื่อพร้อม
+    # ตัวอย่างเป็นส่วนเสริม ถ้าล้มเหลวจะแค่พิมพ์ข้อความ ไม่ทำให้งานหลักล้มตาม
+    def __init__(self, video_path, audio_path, preview_dir, callback, cancel_token=None):
+        self.token = CancelToken()
+        self._unregister = cancel_token.on_cancel(self.token.cancel) if cancel_token else (lambda: None)
+        self._thread = threading.Thread(target=self._run, args=(video_path, audio_path, preview_dir, callback),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, video_path, audio_path, preview_dir, callback):
+        try:
+            clip_path, strip_path = generate_preview(video_path, audio_path, preview_dir,
+                                                     cancel_token=self.token)
+            callback(clip_path, strip_path)
+        except Cancelled:
+            pass
+        except Exception as e:
+            if not self.token.is_cancelled():
+                print(f"Preview failed: {str(e)}")
+        finally:
+            self._unregister()
+
+    def stop(self, timeout=5):
+        # งานหลักจบแล้ว (สำเร็จหรือไม่ก็ตาม) หยุดและรอให้ ffmpeg ปิดก่อนลบโฟลเดอร์ชั่วคราว
+        self.token.cancel()
+        self._thread.join(timeout)
+
+def _moov_info(data, start, end, info):
+    # ชนิด track, codec, ขนาดภาพ และความยาว (ถ้า moov ระบุไว้) ของ track แรก
+    mvhd = find_mp4_box(data, ["mvhd"], start, end)
+    if mvhd is not None:
+        timescale = _full_box_time(data, mvhd, 8, 16, 4)
+        mehd = find_mp4_box(data, ["mvex", "mehd"], start, end)
+        duration = _full_box_time(data, mehd, 0, 0, 8) if mehd else _full_box_time(data, mvhd, 12, 20, 8)
+        if timescale and duration:
+            info["duration"] = duration / timescale
+    hdlr = find_mp4_box(data, ["trak", "mdia", "hdlr"], start, end)
+    if hdlr is not None:
+        pos = hdlr[0] + hdlr[2] + 8
+        info["kind"] = {"vide": "video", "soun": "audio"}.get(data[pos:pos + 4].decode("latin-1"))
+    stsd = find_mp4_box(data, ["trak", "mdia", "minf", "stbl", "stsd"], start, end)
+    if stsd is None:
+        return
+    entry = stsd[0] + stsd[2] + 8
+    entry_size, fourcc = struct.unpack_from(">I4s", data, entry)
+    fourcc = fourcc.decode("latin-1")
+    info["codecs"] = fourcc
+    if fourcc == "mp4a":
+        info["codecs"] = "mp4a.40.2"
+    elif fourcc in ("avc1", "avc3", "hev1", "hvc1", "av01"):
+        info["width"], info["height"] = struct.unpack_from(">HH", data, entry + 32)
+        # sample entry ของภาพยาว 86 ไบต์ก่อน box ลูก (avcC มี profile/level ที่ player ต้องใช้)
+        avcc = find_mp4_box(data, ["avcC"], entry + 86, entry + entry_size)
+        if avcc is not None:
+            pos = avcc[0] + avcc[2]
+            info["codecs"] = f"{fourcc}.{data[pos + 1]:02x}{data[pos + 2]:02x}{data[pos + 3]:02x}"
+
+def mp4_stream_info(data, complete=False):
+    # ข้อมูลสำหรับ DASH manifest จากส่วนหัวของ m4s (ftyp + moov + sidx)
+    # คืน None ถ้าข้อมูลยังไม่พอ complete=True คือ data เป็นทั้งไฟล์แล้ว
+    info = {"init_end": None, "index_range": None, "kind": None, "codecs": None,
+            "width": None, "height": None, "duration": None}
+    for box_type, start, size, header in iter_mp4_boxes(data):
+        if start + size > len(data):
+            return None
+        if box_type == "moov":
+            info["init_end"] = start + size
+            _moov_info(data, start + header, start + size, info)
+        elif box_type == "sidx":
+            info["index_range"] = (start, start + size - 1)
+            _, fragments = parse_sidx(data, start, size, header)
+            if fragments:
+                info["duration"] = fragments[-1][1] - fragments[0][0]
+            break
+        elif box_type in ("moof", "mdat"):
+            break
+    else:
+        if not complete:
+            return None
+    if info["init_end"] is None:
+        raise ValueError("ไม่พบ moov ที่ต้นไฟล์ จึงเล่นระหว่างดาวน์โหลดไม่ได้")
+    return info
+
+def progressive_stream_info(file, probe_size=64 * 1024):
+    # อ่านส่วนหัวของ ProgressiveFile (รอก้อนแรกถ้ายังไม่มา) จนได้ moov และ sidx ครบ
+    want = probe_size
+    while True:
+        want = min(want, file.total_size)
+        data = b"".join(file.read(0, want - 1))
+        info = mp4_stream_info(data, complete=want == file.total_size)
+        if info is not None:
+            return info
+        want *= 2
+
+def build_dash_manifest(representations):
+    # representations: [(BaseURL, ขนาดไฟล์, info จาก mp4_stream_info, ภาษา)] วิดีโอก่อนตามด้วยเสียงทุกภาษา
+    # แบบ on-demand (ไฟล์เดียวต่อ stream + sidx) เหมือนที่เว็บของ Bilibili ใช้ player ขอเป็นช่วงด้วย Range เอง
+    duration = max((info["duration"] or 0) for _, _, info, _ in representations)
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" minBufferTime="PT2S"'
+        ' profiles="urn:mpeg:dash:profile:isoff-on-demand:2011"'
+        + (f' mediaPresentationDuration="PT{duration:.3f}S"' if duration else '') + '>',
+        '  <Period>',
+    ]
+    for index, (base_url, size, info, language) in enumerate(representations):
+        kind = info["kind"] or ("video" if index == 0 else "audio")
+        bandwidth = int(size * 8 / duration) if duration else 1
+        attributes = f'id="{index}" bandwidth="{bandwidth}"'
+        if info["codecs"]:
+            attributes += f' codecs="{info["codecs"]}"'
+        if info["width"]:
+            attributes += f' width="{info["width"]}" height="{info["height"]}"'
+        segment_base = f'indexRange="{info["index_range"][0]}-{info["index_range"][1]}"' \
+            if info["index_range"] else ''
+        lines += [
+            f'    <AdaptationSet contentType="{kind}" mimeType="{kind}/mp4"'
+            + (f' lang="{language}"' if language else '') + '>',
+            f'      <Representation {attributes}>',
+            f'        <BaseURL>{base_url}</BaseURL>',
+            f'        <SegmentBase {segment_base}>',
+            f'          <Initialization range="0-{info["init_end"] - 1}"/>',
+            '        </SegmentBase>',
+            '      </Representation>',
+            '    </AdaptationSet>',
+        ]
+    lines += ['  </Period>', '</MPD>', '']
+    return "\n".join(lines)
+
+def is_mp4_container(path):
+    # ไฟล์ที่ขึ้นต้นด้วย ftyp และมี moov คือ MP4/M4A ที่ใช้งานได้อยู่แล้ว (รวมถึง m4s แบบ DASH)
+    with open(path, 'rb') as f:
+        head = f.read(64 * 1024)
     try:
-        if "/video/" in url:
-            aid = url.split("/video/")[1].split("?")[0]
-            return aid
-    except:
-        return None
-    return None
+        box_types = [box[0] for box in iter_mp4_boxes(head)]
+    except ValueError:
+        return False
+    return bool(box_types) and box_types[0] == "ftyp" and "moov" in box_types
 
-def get_bilibili_urls(video_url):
+def download_audio(url, output_path, progress_callback=None, status_callback=None, catalog=None,
+                   cancel_token=None):
+    # ดาวน์โหลดเฉพาะเสียง ไม่แตะ stream วิดีโอเลย
+    report = progress_callback or (lambda progress: None)
+    status = status_callback or (lambda message: None)
+
+    aid = extract_aid_from_url(url)
+    if not aid:
+        raise JobInputError("ไม่สามารถดึง aid จาก URL ได้")
+
+    status("กำลังดึงข้อมูล URL...")
+    result = resolve_playurl(aid, require_video=False, cancel_token=cancel_token)
+
+    temp_dir = job_temp_dir(f"audio_{aid}")
+    urls = result.video_segments if result.segmented else [result.audio_url]
+    # durl: เสียงที่ดึงออกมามีขนาดเล็กกว่าไฟล์ที่ดาวน์โหลดมาก แต่ไม่รู้สัดส่วนล่วงหน้า จึงจองเท่ากัน
+    reservation = reserve_job_storage(result, [(url, None) for url in urls], temp_dir, output_path,
+                                      cancel_token=cancel_token, status_callback=status)
     try:
-        # ดึง aid จาก URL
-        aid = extract_aid_from_url(video_url)
-        if not aid:
-            raise ValueError("ไม่สามารถดึง aid จาก URL ได้")
+        if result.segmented:
+            return _download_segmented_audio(result, output_path, temp_dir, report, status, catalog, cancel_token)
+        return _download_audio_stream(result, output_path, temp_dir, report, status, catalog, cancel_token)
+    finally:
+        reservation.release()
 
-        # สร้าง URL สำหรับเรียก API
-        api_url = f"https://api.bilibili.tv/intl/gateway/web/playurl?s_locale=th_TH&platform=web&aid={aid}&qn=80&type=0&device=wap&tf=0"
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Referer': 'https://www.bilibili.tv/'
-        }
+def _download_audio_stream(result, output_path, temp_dir, report, status, catalog, cancel_token):
+    audio_path = os.path.join(temp_dir, f"temp_audio_{result.audio_quality}.m4s")
+    try:
+        status("กำลังดาวน์โหลดเสียง...")
+        report(0)
+        digest = fetch_stream(result.audio_url, audio_path, lambda progress: report(progress * 0.95), catalog,
+                              cancel_token)
 
-        response = requests.get(api_url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
+        if is_mp4_container(audio_path):
+            # เป็น container ที่ใช้ได้แล้ว ย้ายไปปลายทางเลยโดยไม่ต้องผ่าน ffmpeg
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            shutil.move(audio_path, output_path)
+            # ไฟล์ผลลัพธ์คือ stream ต้นฉบับทุกไบต์ งาน merge ใช้แทนการดาวน์โหลดซ้ำได้
+            if catalog is not None:
+                catalog.record_stream(result.audio_url, output_path, result.aid, "audio", result.audio_quality,
+                                      digest)
+        else:
+            # ไฟล์จาก ffmpeg ไม่ใช่ stream ต้นฉบับ (เนื้อหาและ digest ต่างกัน) จึงไม่บันทึกไว้ใต้ key ของ stream
+            status("กำลังแปลงไฟล์เสียงเป็น m4a...")
+            run_ffmpeg(['ffmpeg', '-i', audio_path, '-vn', '-c:a', 'copy', '-y', output_path],
+                       cancel_token=cancel_token)
 
-        if data.get("code") != 0:
-            raise ValueError(f"API Error: {data.get('message')}")
+        report(100)
+        status("ดำเนินการเสร็จสิ้น")
+    except Cancelled:
+        status("ยกเลิกแล้ว (เก็บไฟล์ที่ดาวน์โหลดไว้สำหรับทำต่อ)")
+        raise
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return output_path
 
-        playurl_data = data.get("data", {}).get("playurl", {})
-        # print("Full API Response:", data)
-        # print("Playurl Data:", playurl_data)
-        
-        # ดึง URL วิดีโอและเสียง
-        video_url = None
-        audio_url = None
-
-        # ดึง URL วิดีโอคุณภาพสูงสุด (1080P หรือ 720P)
-        videos = playurl_data.get("video", [])
-        if videos:
-            # ลองหาวิดีโอคุณภาพ 1080P (quality=80) ก่อน
-            for video in videos:
-                video_resource = video.get("video_resource", {})
-                if video_resource.get("quality") == 80:
-                    temp_url = video_resource.get("url")
-                    if temp_url and temp_url.strip():  # ตรวจสอบว่า URL ไม่ว่างเปล่า
-                        video_url = temp_url
-                        print("Found 1080P video URL:", video_url)
-                        break
-            
-            # ถ้าไม่มี 1080P หรือ URL ว่างเปล่า ให้ใช้ 720P (quality=64)
-            if not video_url:
-                for video in videos:
-                    video_resource = video.get("video_resource", {})
-                    if video_resource.get("quality") == 64:
-                        temp_url = video_resource.get("url")
-                        if temp_url and temp_url.strip():  # ตรวจสอบว่า URL ไม่ว่างเปล่า
-                            video_url = temp_url
-                            print("Found 720P video URL:", video_url)
-                            break
+def _download_segmented_audio(result, output_path, temp_dir, report, status, catalog, cancel_token):
+    # durl ไม่มี stream เสียงแยก ต้องดาวน์โหลดทุกส่วนแล้วดึงเฉพาะเสียงออกมาต่อกันในรอบเดียว
+    paths = segment_paths(result, temp_dir)
+    try:
+        status(f"กำลังดาวน์โหลด {len(paths)} ส่วน (เสียงอยู่รวมกับวิดีโอ)...")
+        report(0)
+        fetch_streams(list(zip(result.video_segments, paths)), catalog, cancel_token,
+                      lambda progress: report(progress * 0.9))
+        status("กำลังดึงเสียงออกมาเป็น m4a...")
+        list_path = write_concat_list(paths, os.path.join(temp_dir, "concat.ffconcat"), result.segment_durations)
+        run_ffmpeg(['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_path, '-vn', '-c:a', 'copy', '-y',
+                    output_path], lambda progress: report(90 + progress * 0.1), cancel_token=cancel_token)
+        report(100)
+        status("ดำเนินการเสร็จสิ้น")
+    except Cancelled:
+        status("ยกเลิกแล้ว (เก็บไฟล์ที่ดาวน์โหลดไว้สำหรับทำต่อ)")
+        raise
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return output_path
 
-        # ดึง URL เสียงคุณภาพสูงสุด
-        audio_resources = playurl_data.get("audio_resource", [])
-        if audio_resources:
-            # เลือกเสียงคุณภาพสูงสุด (quality=30280)
-            for audio in audio_resources:
-                if audio.get("quality") == 30280:
-                    audio_url = audio.get("url")
-                    print("Found audio URL:", audio_url)
-                    break
+MERGE_MODE_COPY = "copy"            # ffmpeg -c copy ใช้ CPU น้อย ส่วนใหญ่เป็นงาน I/O
+MERGE_MODE_TRANSCODE = "transcode"  # libx264 ผ่าน moviepy กิน CPU หนัก
 
-        if not video_url or not audio_url:
-            raise ValueError("ไม่พบ URL วิดีโอหรือเสียง")
+# จำนวนหน่วย CPU ที่งานแต่ละแบบจองไว้ระหว่างทำงาน
+MERGE_COSTS = {
+    MERGE_MODE_COPY: 1,
+    MERGE_MODE_TRANSCODE: 2,
+}
 
-        print("Final Video URL:", video_url)
-        print("Final Audio URL:", audio_url)
+def _transcode_worker(video_path, audio_path, output_path, conn):
+    # ทำงานในโปรเซสลูก ส่งความคืบหน้าและผลลัพธ์กลับผ่าน pipe
+    try:
+        last = [-1]
 
-        return video_url, audio_url
+        def report(progress):
+            if int(progress) != last[0]:
+                last[0] = int(progress)
+                conn.send(("progress", progress))
 
+        transcode_files(video_path, audio_path, output_path, report)
+        conn.send(("done", None))
     except Exception as e:
-        print("Error:", str(e))
-        raise Exception(f"เกิดข้อผิดพลาดในการดึงข้อมูล: {str(e)}")
+        conn.send(("error", str(e)))
+    finally:
+        conn.close()
 
-def resource_path(relative_path):
-    """ Get absolute path to resource, works for dev and for PyInstaller """
-    try:
-        # PyInstaller creates a temp folder and stores path in _MEIPASS
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
-    
-    return os.path.join(base_path, relative_path)
+class MergeJob:
+    def __init__(self, job_id, mode, video_path, audio_path, output_path,
+                 progress_callback=None, done_callback=None):
+        self.id = job_id
+        self.mode = mode
+        self.video_path = video_path
+        self.audio_path = audio_path
+        self.output_path = output_path
+        self.progress_callback = progress_callback
+        self.done_callback = done_callback
+        self.status = "pending"  # pending, running, done, error, cancelled
+        self.error = None
+        self.progress = 0.0
+        self.process = None
+        self.cancelled = False
+        self._done = threading.Event()
 
-def merge_files(video_path, audio_path, output_path):
-    try:
-        # สร้าง temp directory สำหรับเก็บไฟล์ชั่วคราว
-        temp_dir = os.path.join(os.environ.get('TEMP') or os.environ.get('TMP') or os.getcwd(), 'bilibili_temp')
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        print(f"Video path: {video_path}")
-        print(f"Audio path: {audio_path}")
-        print(f"Output path: {output_path}")
-        
-        # ใช้ subprocess เรียก ffmpeg โดยตรง
-        command = [
-            'ffmpeg',
-            '-i', video_path,
-            '-i', audio_path,
-            '-c', 'copy',
-            '-y',  # ให้เขียนทับไฟล์ที่มีอยู่
-            output_path
-        ]
-        
-        # รันคำสั่ง ffmpeg
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+class MergeExecutor:
+    # รันงานรวมไฟล์หลายงานพร้อมกันตามจำนวนคอร์
+    # งาน copy รัน ffmpeg เป็นโปรเซสแยกอยู่แล้ว ส่วนงาน transcode รันใน
+    # โปรเซสลูกของ Python เพื่อไม่ให้ลูปเฟรมของ moviepy แย่ง GIL กับ GUI
+    def __init__(self, cpu_units=None):
+        self.cpu_units = cpu_units or max(2, os.cpu_count() or 1)
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._jobs = {}
+        self._used_units = 0
+        self._ids = itertools.count(1)
+
+    def _cost(self, job):
+        # งานที่ใหญ่กว่าเครื่องก็ยังต้องรันได้ แค่รันทีละงาน
+        return min(MERGE_COSTS[job.mode], self.cpu_units)
+
+    def submit(self, video_path, audio_path, output_path, mode=MERGE_MODE_COPY,
+               progress_callback=None, done_callback=None):
+        if mode not in MERGE_COSTS:
+            raise ValueError(f"ไม่รู้จักโหมดการรวมไฟล์: {mode}")
+        with self._lock:
+            job = MergeJob(next(self._ids), mode, video_path, audio_path, output_path,
+                           progress_callback, done_callback)
+            self._jobs[job.id] = job
+            self._pending.append(job)
+        self._dispatch()
+        return job
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job.status not in ("pending", "running"):
+                return False
+            job.cancelled = True
+            if job.status == "pending":
+                self._pending.remove(job)
+                pending = True
+            else:
+                pending = False
+                process = job.process
+        if pending:
+            self._finish(job, "cancelled")
+        elif process is not None:
+            process.terminate()
+        return True
+
+    def wait_all(self, timeout=None):
+        for job in list(self._jobs.values()):
+            if not job.wait(timeout):
+                return False
+        return True
+
+    def shutdown(self, cancel_running=False):
+        with self._lock:
+            job_ids = [job.id for job in self._pending]
+            if cancel_running:
+                job_ids += [job.id for job in self._jobs.values() if job.status == "running"]
+        for job_id in job_ids:
+            self.cancel(job_id)
+
+    def _dispatch(self):
+        # first-fit: เริ่มทุกงานในคิวที่ยังมีหน่วย CPU ว่างพอ
+        # งาน copy ที่ถูกจึงแทรกเข้าไปได้ระหว่างที่ transcode หนักรอคิวอยู่
+        to_start = []
+        with self._lock:
+            for job in list(self._pending):
+                cost = self._cost(job)
+                if self._used_units + cost <= self.cpu_units:
+                    self._pending.remove(job)
+                    self._used_units += cost
+                    job.status = "running"
+                    to_start.append(job)
+        for job in to_start:
+            target = self._run_copy if job.mode == MERGE_MODE_COPY else self._run_transcode
+            threading.Thread(target=target, args=(job,), daemon=True).start()
+
+    def _report(self, job, progress):
+        job.progress = progress
+        if job.progress_callback:
+            job.progress_callback(job.id, progress)
+
+    def _run_copy(self, job):
+        def keep_process(process):
+            with self._lock:
+                job.process = process
+                cancelled = job.cancelled
+            if cancelled:
+                process.terminate()
+
+        try:
+            merge_files(job.video_path, job.audio_path, job.output_path,
+                        lambda progress: self._report(job, progress), process_callback=keep_process)
+            self._finish(job, "done")
+        except Exception as e:
+            self._finish(job, "cancelled" if job.cancelled else "error", str(e))
+
+    def _run_transcode(self, job):
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_transcode_worker,
+            args=(job.video_path, job.audio_path, job.output_path, sender),
+            daemon=True
         )
-        
-        # รอให้ process เสร็จสิ้น
-        stdout, stderr = process.communicate()
-        
-        # ตรวจสอบผลลัพธ์
-        if process.returncode != 0:
-            raise Exception(f"FFmpeg error: {stderr}")
-            
-        # ลบ temp directory
+        with self._lock:
+            cancelled = job.cancelled
+            if not cancelled:
+                process.start()
+                job.process = process
+        sender.close()
+        if cancelled:
+            receiver.close()
+            self._finish(job, "cancelled")
+            return
+
+        status, message = "error", "โปรเซสรวมไฟล์หยุดทำงานโดยไม่ทราบสาเหตุ"
         try:
-            shutil.rmtree(temp_dir)
-        except:
+            while True:
+                kind, value = receiver.recv()
+                if kind == "progress":
+                    self._report(job, value)
+                elif kind == "done":
+                    status, message = "done", None
+                else:
+                    status, message = "error", value
+        except EOFError:
+            # โปรเซสลูกปิด pipe แล้ว (จบงานหรือถูก terminate)
             pass
-            
-    except Exception as e:
-        print(f"Error in merge_files: {str(e)}")
-        # ลบไฟล์ชั่วคราวถ้ามีข้อผิดพลาด
+        finally:
+            receiver.close()
+        process.join()
+        if job.cancelled:
+            status, message = "cancelled", None
+        self._finish(job, status, message)
+
+    def _finish(self, job, status, message=None):
+        with self._lock:
+            if job.status == "running":
+                self._used_units -= self._cost(job)
+            job.status = status
+            job.error = message
+            job.process = None
+        if status == "done":
+            self._report(job, 100.0)
+        if job.done_callback:
+            job.done_callback(job)
+        job._done.set()
+        self._dispatch()
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+JOB_KINDS = ("merge", "audio", "clip")
+
+class JobQueue:
+    # คิวงานที่หลายเครื่องใช้ร่วมกันผ่านไฟล์ SQLite บน network mount
+    # worker จองงานด้วย lease ที่ต้องต่ออายุ (heartbeat) เป็นระยะ
+    # ถ้า worker ตายไป lease จะหมดอายุและงานนั้นถูกเครื่องอื่นรับไปทำต่อ
+    # ค่าเริ่มต้นใช้ rollback journal เพราะ WAL ต้องใช้ shared memory บนเครื่องเดียวกัน
+    # ใช้บน network mount ข้ามเครื่องไม่ได้ (wal=True ใช้ได้เมื่อทุก worker อยู่บนเครื่องเดียว)
+    def __init__(self, path, wal=False, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # isolation_level=None เพื่อควบคุม BEGIN IMMEDIATE เอง
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+            self._conn.execute("PRAGMA busy_timeout=30000")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    output_path TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, fn):
+        # ทุกการเขียนอยู่ใน BEGIN IMMEDIATE เพื่อให้การจองงานเป็น atomic ข้ามโปรเซสและข้ามเครื่อง
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def enqueue(self, url, output_path, kind="merge"):
+        now = time.time()
+        return self._write(lambda conn: conn.execute(
+            "INSERT INTO jobs (url, output_path, kind, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (url, output_path, kind, JOB_QUEUED, now, now)
+        ).lastrowid)
+
+    def claim(self, worker_id, lease_seconds=60):
+        # รับงานที่รออยู่ หรืองานที่ worker เดิม lease หมดอายุแล้ว (ถือว่าตายไป)
+        # งานที่ลองครบ max_attempts แล้วถูกปิดเป็น failed แล้วหางานถัดไป (วนในรอบเดียว ไม่ recurse)
+        def claim_job(conn):
+            now = time.time()
+            while True:
+                row = conn.execute(
+                    """SELECT * FROM jobs
+                       WHERE status = ? OR (status = ? AND lease_expires < ?)
+                       ORDER BY id LIMIT 1""",
+                    (JOB_QUEUED, JOB_RUNNING, now)
+                ).fetchone()
+                if row is None:
+                    return None
+                if row["attempts"] < self.max_attempts:
+                    break
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL, error = ?, updated_at = ? WHERE id = ?",
+                    (JOB_FAILED, row["error"] or "worker หยุดทำงานระหว่างทำงานนี้หลายครั้ง", now, row["id"])
+                )
+            conn.execute(
+                """UPDATE jobs SET status = ?, worker = ?, lease_expires = ?,
+                   attempts = attempts + 1, updated_at = ? WHERE id = ?""",
+                (JOB_RUNNING, worker_id, now + lease_seconds, now, row["id"])
+            )
+            return conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        return self._write(claim_job)
+
+    def _update_owned(self, job_id, worker_id, sql, params):
+        # แก้ไขได้เฉพาะงานที่ worker นี้ยังถือ lease อยู่ คืน False ถ้า lease ถูกเครื่องอื่นรับไปแล้ว
+        return self._write(lambda conn: conn.execute(
+            sql + " WHERE id = ? AND worker = ? AND status = ?",
+            (*params, job_id, worker_id, JOB_RUNNING)
+        ).rowcount == 1)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds=60):
+        now = time.time()
+        return self._update_owned(job_id, worker_id, "UPDATE jobs SET lease_expires = ?, updated_at = ?",
+                                  (now + lease_seconds, now))
+
+    def complete(self, job_id, worker_id):
+        return self._update_owned(job_id, worker_id,
+                                  "UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, error = NULL, updated_at = ?",
+                                  (JOB_DONE, time.time()))
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        # ข้อผิดพลาดชั่วคราวจะถูกส่งกลับเข้าคิวจนกว่าจะครบ max_attempts
+        with self._lock:
+            row = self._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        status = JOB_QUEUED if retry and row and row["attempts"] < self.max_attempts else JOB_FAILED
+        return self._update_owned(job_id, worker_id,
+                                  "UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, error = ?, updated_at = ?",
+                                  (status, error, time.time()))
+
+    def release(self, job_id, worker_id):
+        # worker ถูกสั่งหยุด คืนงานเข้าคิวทันทีโดยไม่นับเป็นความพยายามที่ล้มเหลว
+        return self._update_owned(job_id, worker_id,
+                                  "UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, attempts = attempts - 1, updated_at = ?",
+                                  (JOB_QUEUED, time.time()))
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def run_job(job, cancel_token=None, progress_callback=None, status_callback=None, preview_callback=None,
+            stream_callback=None):
+    if job["kind"] == "audio":
+        return download_audio(job["url"], job["output_path"], progress_callback, status_callback,
+                              get_catalog(), cancel_token)
+    if job["kind"] == "clip":
+        return download_clip(job["url"], job["start"], job["end"], job["output_path"], progress_callback,
+                             status_callback, cancel_token)
+    return download_and_merge(job["url"], job["output_path"], progress_callback, status_callback,
+                              get_catalog(), cancel_token, preview_callback=preview_callback,
+                              stream_callback=stream_callback)
+
+def run_worker(queue, worker_id=None, lease_seconds=60, poll_interval=2.0, stop_token=None, exit_when_idle=False):
+    # วนรับงานจากคิวจนกว่าจะถูกสั่งหยุด แต่ละงานมี thread ต่ออายุ lease ทุก 1/3 ของ lease
+    # ถ้าต่ออายุไม่สำเร็จ (เครื่องอื่นรับงานไปแล้ว) จะยกเลิกงานที่ทำอยู่ทันที
+    # ไม่รับงานเมื่อพื้นที่ไม่พอแม้สำหรับ stream ขนาดประมาณหนึ่งไฟล์ ให้เครื่องอื่นที่มีที่ว่างรับไปแทน
+    worker_id = worker_id or default_worker_id()
+    stop_token = stop_token or CancelToken()
+    storage = get_storage_manager()
+    processed = 0
+    while not stop_token.is_cancelled():
+        if not storage.admit(STORAGE_UNKNOWN_STREAM_SIZE):
+            print(f"[{worker_id}] not enough storage, waiting before claiming jobs")
+            stop_token.wait(poll_interval)
+            continue
+        job = queue.claim(worker_id, lease_seconds)
+        if job is None:
+            if exit_when_idle:
+                break
+            stop_token.wait(poll_interval)
+            continue
+
+        print(f"[{worker_id}] job {job['id']}: {job['url']} -> {job['output_path']}")
+        job_token = CancelToken()
+        unregister = stop_token.on_cancel(job_token.cancel)
+        lease_lost = threading.Event()
+        job_finished = threading.Event()
+
+        def keep_lease(job_id=job["id"]):
+            while not job_finished.wait(lease_seconds / 3):
+                try:
+                    alive = queue.heartbeat(job_id, worker_id, lease_seconds)
+                except sqlite3.Error as e:
+                    # mount สะดุดชั่วคราว ลองใหม่รอบถัดไปก่อน lease หมดอายุ
+                    print(f"Heartbeat failed: {str(e)}")
+                    continue
+                if not alive:
+                    lease_lost.set()
+                    job_token.cancel()
+                    return
+
+        heartbeat = threading.Thread(target=keep_lease, daemon=True)
+        heartbeat.start()
         try:
-            shutil.rmtree(temp_dir)
-        except:
+            run_job(job, job_token)
+            if queue.complete(job["id"], worker_id):
+                processed += 1
+            else:
+                print(f"[{worker_id}] job {job['id']} finished after its lease was taken over")
+        except Cancelled:
+            if not lease_lost.is_set():
+                queue.release(job["id"], worker_id)
+        except StorageFull as e:
+            # ไม่ใช่ความผิดของงาน คืนเข้าคิวโดยไม่นับครั้ง (.part ที่ได้แล้วยังเก็บไว้ถ้าเครื่องนี้รับไปทำต่อ)
+            print(f"[{worker_id}] job {job['id']} returned to the queue: {str(e)}")
+            queue.release(job["id"], worker_id)
+            stop_token.wait(poll_interval)
+        except JobInputError as e:
+            # URL ผิดหรือไม่มี stream ให้ดาวน์โหลด ทำซ้ำก็ไม่สำเร็จ
+            queue.fail(job["id"], worker_id, str(e), retry=False)
+        except Exception as e:
+            print(f"[{worker_id}] job {job['id']} failed: {str(e)}")
+            queue.fail(job["id"], worker_id, str(e))
+        finally:
+            job_finished.set()
+            unregister()
+            heartbeat.join()
+    return processed
+
+# ความถี่ที่ worker ตรวจว่ามี SIGINT/SIGTERM มาหรือยัง
+SIGNAL_POLL_INTERVAL = 0.2
+
+def worker_main(argv):
+    # โหมด worker ไม่เปิดหน้าต่าง: รับงานจากคิวที่แชร์กันบน network mount
+    #   python main-v2.py --worker /mnt/share/jobs.sqlite3
+    #   python main-v2.py --enqueue /mnt/share/jobs.sqlite3 URL OUTPUT [--audio]
+    #   python main-v2.py --serve [PORT]
+    import argparse
+    import signal
+    parser = argparse.ArgumentParser(description="Bilibili downloader worker")
+    parser.add_argument("--worker", metavar="QUEUE", help="รับงานจากไฟล์คิว")
+    parser.add_argument("--enqueue", nargs=3, metavar=("QUEUE", "URL", "OUTPUT"), help="เพิ่มงานเข้าคิว")
+    parser.add_argument("--serve", nargs="?", type=int, const=API_DEFAULT_PORT, metavar="PORT",
+                        help="เปิด HTTP API บน localhost โดยไม่เปิดหน้าต่าง")
+    parser.add_argument("--audio", action="store_true", help="งานดาวน์โหลดเฉพาะเสียง")
+    parser.add_argument("--lease", type=float, default=60, help="อายุ lease เป็นวินาที")
+    parser.add_argument("--id", dest="worker_id", help="ชื่อ worker (ค่าเริ่มต้น host:pid)")
+    parser.add_argument("--exit-when-idle", action="store_true", help="ออกเมื่อคิวว่าง")
+    parser.add_argument("--wal", action="store_true", help="ใช้ WAL (เฉพาะเมื่อทุก worker อยู่บนเครื่องเดียวกัน)")
+    parser.add_argument("--egress", metavar="ROUTES",
+                        help="เส้นทางขาออก คั่นด้วย , เช่น direct,http://10.0.0.2:3128,192.168.1.20")
+    parser.add_argument("--storage-quota", metavar="SIZE", type=parse_size,
+                        help="พื้นที่สูงสุดของไฟล์ชั่วคราวและผลลัพธ์ เช่น 50G (ค่าเริ่มต้นจาก BILIBILI_STORAGE_QUOTA)")
+    parser.add_argument("--evict-outputs", action="store_true",
+                        help="ลบไฟล์ผลลัพธ์ที่ไม่ได้ใช้นานที่สุดได้เมื่อพื้นที่ไม่พอ (ปกติลบเฉพาะไฟล์ชั่วคราว)")
+    args = parser.parse_args(argv)
+
+    if args.egress:
+        egress_pool.set_routes(parse_egress_routes(args.egress))
+    if args.storage_quota is not None or args.evict_outputs:
+        storage = get_storage_manager()
+        if args.storage_quota is not None:
+            storage.quota = args.storage_quota
+        storage.evict_outputs = args.evict_outputs
+
+    if args.serve:
+        engine = JobEngine(prefetcher=SeasonPrefetcher())
+        server = JobApiServer(engine, port=args.serve)
+        print(f"Job API listening on http://127.0.0.1:{args.serve}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
             pass
-        raise Exception(f"เกิดข้อผิดพลาดในการรวมไฟล์: {str(e)}")
+        engine.shutdown()
+        return 0
 
-def download_file(url, output_path, progress_callback=None):
-    try:
-        # ใช้ temporary directory สำหรับดาวน์โหลด
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_file = os.path.join(temp_dir, "temp_download")
-            
-            response = requests.get(url, stream=True)
-            response.raise_for_status()
-            
-            # ขนาดไฟล์ทั้งหมด
-            total_size = int(response.headers.get('content-length', 0))
-            
-            # ดาวน์โหลดไฟล์
-            with open(temp_file, 'wb') as f:
-                if total_size == 0:  # ไม่ทราบขนาดไฟล์
-                    f.write(response.content)
-                else:
-                    downloaded = 0
-                    for data in response.iter_content(chunk_size=4096):
-                        downloaded += len(data)
-                        f.write(data)
-                        if progress_callback:
-                            progress = (downloaded / total_size) * 100
-                            progress_callback(progress)
-            
-            # ย้ายไฟล์จาก temp ไปยังที่หมายปลายทาง
-            if os.path.exists(temp_file):
-                # ถ้ามีไฟล์เดิมอยู่ ให้ลบก่อน
-                if os.path.exists(output_path):
-                    os.remove(output_path)
-                # ย้ายไฟล์
-                os.rename(temp_file, output_path)
+    if args.enqueue:
+        queue_path, url, output_path = args.enqueue
+        queue = JobQueue(queue_path, wal=args.wal)
+        print(queue.enqueue(url, output_path, "audio" if args.audio else "merge"))
+        return 0
+
+    queue = JobQueue(args.worker, wal=args.wal)
+    stop_token = CancelToken()
+    # SIGTERM/SIGINT: ยกเลิกงานปัจจุบันและคืนงานเข้าคิวให้เครื่องอื่นทำต่อ
+    # handler แค่ตั้ง flag เพราะ signal อาจมาถึงขณะ main thread ถือ lock ของ CancelToken อยู่
+    # (lock ไม่ reentrant เรียก cancel จาก handler ตรง ๆ จะติดตาย) thread แยกเป็นผู้ยกเลิกแทน
+    stop_requested = []
+
+    def watch_stop():
+        while not stop_requested:
+            time.sleep(SIGNAL_POLL_INTERVAL)
+        stop_token.cancel()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop_requested.append(signum))
+    threading.Thread(target=watch_stop, daemon=True).start()
+    processed = run_worker(queue, args.worker_id, args.lease, stop_token=stop_token,
+                           exit_when_idle=args.exit_when_idle)
+    print(f"Worker stopped after {processed} jobs: {queue.counts()}")
+    return 0
+
+class EngineJob:
+    def __init__(self, job_id, url, output_path, kind, start=None, end=None, stream=False):
+        self.id = job_id
+        self.url = url
+        self.output_path = output_path
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.status = JOB_QUEUED
+        self.progress = 0
+        self.message = ""
+        self.error = None
+        # {"clip": ..., "thumbnails": ...} เมื่อสร้างตัวอย่างจาก fragment แรกเสร็จ (เฉพาะงาน merge)
+        self.preview = None
+        # เล่นระหว่างดาวน์โหลด: ProgressiveFile ของวิดีโอและเสียง ให้ API ส่งต่อให้ player
+        self.stream = stream
+        self.streams = None
+        self.created_at = time.time()
+        self.version = 0
+        self.token = CancelToken()
+
+    def __getitem__(self, key):
+        # ให้ run_job อ่านได้เหมือนแถวจาก JobQueue
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "url": self.url,
+            "output_path": self.output_path,
+            "kind": self.kind,
+            "start": self.start,
+            "end": self.end,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "error": self.error,
+            "preview": self.preview,
+            "play": f"/jobs/{self.id}/play.mpd" if self.streams else None,
+            "created_at": self.created_at,
+        }
+
+# จำนวนงานที่จบแล้วที่ JobEngine จำไว้ให้ GET /jobs และตารางงาน เก่ากว่านี้ถูกลบออกจากหน่วยความจำ
+JOB_HISTORY_LIMIT = 500
+
+class JobEngine:
+    # ตัวจัดการงานดาวน์โหลดในโปรเซสเดียว ใช้ร่วมกันระหว่างหน้าต่าง GUI และ HTTP API
+    # ทุกการเปลี่ยนแปลงเพิ่ม version รวม ผู้ติดตาม (SSE) รอบน Condition เดียวกัน
+    # แล้วอ่านเฉพาะงานที่ version ใหม่กว่าที่เคยเห็น จึงไม่ต้อง poll และรวมหลายอัปเดตเป็นครั้งเดียวได้
+    def __init__(self, max_workers=2, prefetcher=None):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # SeasonPrefetcher (ถ้ามี) ดาวน์โหลดตอนถัดไปของงานที่ขอ prefetch ไว้ล่วงหน้า
+        self.prefetcher = prefetcher
+        self._cond = threading.Condition()
+        self._jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        self._version = 0
+        self._listeners = []
+
+    def submit(self, url, output_path, kind="merge", start=None, end=None, prefetch=False, stream=False):
+        if kind not in JOB_KINDS:
+            raise ValueError(f"ไม่รู้จักประเภทงาน: {kind}")
+        if not url or not output_path:
+            raise ValueError("ต้องระบุ url และ output_path")
+        if kind == "clip":
+            if start is None or end is None:
+                raise ValueError("งานตัดช่วงเวลาต้องระบุ start และ end")
+            start, end = parse_timestamp(start), parse_timestamp(end)
+        with self._cond:
+            job = EngineJob(next(self._ids), url, output_path, kind, start, end, stream and kind == "merge")
+            self._jobs[job.id] = job
+        self._changed(job)
+        self._executor.submit(self._run, job)
+        if prefetch and kind == "merge" and self.prefetcher:
+            self.prefetcher.follow(url)
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._cond:
+            return [job.to_dict() for job in self._jobs.values()]
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.token.cancel()
+        with self._cond:
+            queued = job.status == JOB_QUEUED
+            if queued:
+                job.status = JOB_CANCELLED
+        if queued:
+            self._changed(job)
+        return True
+
+    def subscribe(self, callback):
+        # callback(job_dict) ถูกเรียกจาก thread ของงาน ผู้ใช้ฝั่ง GUI ต้องส่งต่อผ่าน signal เอง
+        with self._cond:
+            self._listeners.append(callback)
+        return lambda: self._unsubscribe(callback)
+
+    def _unsubscribe(self, callback):
+        with self._cond:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def wait_for_changes(self, since, timeout=None, job_id=None):
+        # คืน (version ล่าสุด, งานที่เปลี่ยนหลัง since) รอจนมีการเปลี่ยนแปลงหรือหมดเวลา
+        with self._cond:
+            if job_id is None:
+                self._cond.wait_for(lambda: self._version > since, timeout)
             else:
-                raise Exception("ไม่พบไฟล์ที่ดาวน์โหลด")
-                
-    except Exception as e:
-        if os.path.exists(output_path):
+                job = self._jobs.get(job_id)
+                self._cond.wait_for(lambda: job is None or job.version > since, timeout)
+            changed = [job.to_dict() for job in self._jobs.values()
+                       if job.version > since and (job_id is None or job.id == job_id)]
+            return self._version, changed
+
+    def _changed(self, job, **fields):
+        with self._cond:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            self._version += 1
+            job.version = self._version
+            snapshot = job.to_dict()
+            if job.status in JOB_FINAL_STATUSES and job.id in self._jobs:
+                # เรียงตามเวลาที่จบ งานที่เพิ่งจบจะไม่ถูกตัดทิ้งก่อนผู้ติดตามได้เห็นสถานะสุดท้าย
+                self._jobs.move_to_end(job.id)
+                self._prune()
+            listeners = list(self._listeners)
+            self._cond.notify_all()
+        for listener in listeners:
             try:
-                os.remove(output_path)
-            except:
-                pass
-        raise Exception(f"เกิดข้อผิดพลาดในการดาวน์โหลด: {str(e)}")
+                listener(snapshot)
+            except Exception as e:
+                print(f"Job listener failed: {str(e)}")
+
+    def _prune(self):
+        # เก็บงานที่จบแล้วไว้แค่ JOB_HISTORY_LIMIT งานล่าสุด (งานที่ยังไม่จบอยู่ครบเสมอ)
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in JOB_FINAL_STATUSES]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY_LIMIT)]:
+            del self._jobs[job_id]
+
+    def _report(self, job, progress):
+        # แจ้งเฉพาะเมื่อเปอร์เซ็นต์เต็มเปลี่ยน ไม่ให้ผู้ติดตามหลายร้อยรายถูกปลุกทุก chunk
+        progress = int(progress)
+        if progress != job.progress:
+            self._changed(job, progress=progress)
+
+    def _run(self, job):
+        with self._cond:
+            if job.status != JOB_QUEUED:
+                return
+        self._changed(job, status=JOB_RUNNING)
+        try:
+            if job.kind == "merge" and self.prefetcher:
+                # ตอนนี้อาจถูก prefetch อยู่ หยุดก่อนแล้วดาวน์โหลดต่อจากไฟล์เดิมด้วยความสำคัญปกติ
+                self.prefetcher.claim(job.url)
+            run_job(job, job.token, lambda progress: self._report(job, progress),
+                    lambda message: self._changed(job, message=message),
+                    lambda clip, thumbnails: self._changed(job, preview={"clip": clip, "thumbnails": thumbnails}),
+                    (lambda files: self._changed(job, streams=files)) if job.stream else None)
+            self._changed(job, status=JOB_DONE, progress=100)
+        except Cancelled:
+            self._changed(job, status=JOB_CANCELLED)
+        except Exception as e:
+            if job.token.is_cancelled():
+                self._changed(job, status=JOB_CANCELLED)
+            else:
+                self._changed(job, status=JOB_FAILED, error=str(e))
+
+    def shutdown(self):
+        with self._cond:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            if job.status in (JOB_QUEUED, JOB_RUNNING):
+                self.cancel(job.id)
+        if self.prefetcher:
+            self.prefetcher.shutdown()
+        self._executor.shutdown(wait=False)
+
+JOB_FINAL_STATUSES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+API_DEFAULT_PORT = 8765
+# SSE หนึ่ง connection ถือ thread หนึ่งตัวไว้ตลอด จำกัดจำนวนไม่ให้ thread งอกไม่สิ้นสุด
+API_MAX_EVENT_STREAMS = 32
+# ชื่อ host ที่ยอมรับใน Host/Origin ของคำขอ
+API_LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+class JobApiHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/JSON API สำหรับเครื่องมืออื่น
+    #   POST   /jobs              {"url", "output_path", "kind": merge|audio|clip, "start", "end", "prefetch",
+    #                              "stream"}
+    #   GET    /jobs              รายการงานทั้งหมด
+    #   GET    /jobs/<id>         สถานะงาน
+    #   DELETE /jobs/<id>         ยกเลิกงาน
+    #   GET    /jobs/<id>/events  ติดตามความคืบหน้าแบบ Server-Sent Events
+    #   GET    /events            ติดตามทุกงานแบบ Server-Sent Events
+    #   GET    /jobs/<id>/play.mpd      DASH manifest สำหรับเล่นระหว่างดาวน์โหลด (งานที่สั่งด้วย "stream": true)
+    #   GET    /jobs/<id>/streams/<n>   วิดีโอ (0) และเสียง (1..) รองรับ Range ช่วงที่ player ขอถูกดึงก่อน
+    #   GET    /jobs/<id>/output        ไฟล์ผลลัพธ์เมื่องานเสร็จแล้ว รองรับ Range (play.mpd ส่งต่อมาที่นี่)
+    #   GET    /storage           พื้นที่ที่ใช้ โควตา และพื้นที่ที่งานจองไว้
+    # POST/DELETE ต้องเปิด allow_control, POST ต้องส่ง Content-Type: application/json
+    # และ Origin (ถ้ามี) ต้องเป็น localhost
+    # งาน merge มี "preview" (path ของคลิปตัวอย่างและแถบภาพย่อ) ตั้งแต่ระหว่างดาวน์โหลด
+    protocol_version = "HTTP/1.1"
+    keepalive_interval = 15
+
+    @property
+    def engine(self):
+        return self.server.engine
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job_id(self, part):
+        try:
+            return int(part)
+        except ValueError:
+            return None
+
+    def _route(self):
+        return [part for part in urllib.parse.urlsplit(self.path).path.split("/") if part]
+
+    def _allowed(self, control=False):
+        # กันเว็บเพจอื่นในเบราว์เซอร์ของผู้ใช้สั่งงานแทน (CSRF) และ DNS rebinding
+        # Host ต้องเป็น localhost เสมอ ส่วนคำสั่งที่เปลี่ยนสถานะต้องไม่มาจาก Origin อื่น
+        host = self.headers.get("Host")
+        if host is not None and urllib.parse.urlsplit(f"//{host}").hostname not in API_LOCAL_HOSTS:
+            self._send_json(403, {"error": "Host ไม่ใช่ localhost"})
+            return False
+        if not control:
+            return True
+        if not self.server.allow_control:
+            self._send_json(403, {"error": "ปิดการสั่งงานผ่าน API อยู่ (เปิดด้วย BILIBILI_JOB_API=1)"})
+            return False
+        origin = self.headers.get("Origin")
+        if origin is not None and urllib.parse.urlsplit(origin).hostname not in API_LOCAL_HOSTS:
+            self._send_json(403, {"error": "ไม่รับคำสั่งจาก Origin อื่น"})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._allowed():
+            return
+        parts = self._route()
+        if parts == ["jobs"]:
+            return self._send_json(200, {"jobs": self.engine.jobs()})
+        if parts == ["events"]:
+            return self._stream_events(None)
+        if parts == ["storage"]:
+            return self._send_json(200, get_storage_manager().stats())
+        if len(parts) in (2, 3, 4) and parts[0] == "jobs":
+            job = self.engine.get(self._job_id(parts[1]))
+            if job is None:
+                return self._send_json(404, {"error": "ไม่พบงาน"})
+            if len(parts) == 2:
+                return self._send_json(200, job.to_dict())
+            if parts[2:] == ["events"]:
+                return self._stream_events(job.id)
+            if parts[2:] == ["play.mpd"]:
+                return self._send_manifest(job)
+            if parts[2:] == ["output"]:
+                return self._send_output(job)
+            if len(parts) == 4 and parts[2] == "streams":
+                return self._send_stream(job, self._job_id(parts[3]))
+        self._send_json(404, {"error": "ไม่พบ endpoint"})
+
+    def do_POST(self):
+        if not self._allowed(control=True):
+            return
+        parts = self._route()
+        if parts != ["jobs"]:
+            return self._send_json(404, {"error": "ไม่พบ endpoint"})
+        # ฟอร์มหรือ fetch แบบ text/plain ส่งข้ามเว็บได้โดยไม่มี preflight จึงรับเฉพาะ JSON
+        content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if content_type != "application/json":
+            return self._send_json(415, {"error": "Content-Type ต้องเป็น application/json"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            job = self.engine.submit(payload.get("url"), payload.get("output_path"),
+                                     payload.get("kind", "merge"), payload.get("start"), payload.get("end"),
+                                     bool(payload.get("prefetch")), bool(payload.get("stream")))
+        except (ValueError, AttributeError) as e:
+            return self._send_json(400, {"error": str(e)})
+        self._send_json(201, job.to_dict())
+
+    def do_DELETE(self):
+        if not self._allowed(control=True):
+            return
+        parts = self._route()
+        if len(parts) == 2 and parts[0] == "jobs" and self.engine.cancel(self._job_id(parts[1])):
+            return self._send_json(200, self.engine.get(self._job_id(parts[1])).to_dict())
+        self._send_json(404, {"error": "ไม่พบงาน"})
+
+    def _send_manifest(self, job):
+        if job.status == JOB_DONE:
+            # รวมไฟล์เสร็จแล้ว เล่นจากไฟล์ผลลัพธ์แทน stream ชั่วคราว
+            self.send_response(302)
+            self.send_header("Location", f"/jobs/{job.id}/output")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if not job.streams:
+            return self._send_json(404, {"error": "งานนี้ไม่ได้เปิดการเล่นระหว่างดาวน์โหลด หรือยังไม่เริ่มดาวน์โหลด"})
+        try:
+            representations = []
+            for index, file in enumerate(job.streams):
+                file.wait_ready(DOWNLOAD_TIMEOUT[1])
+                representations.append((f"streams/{index}", file.total_size, progressive_stream_info(file),
+                                        file.language))
+        except Exception as e:
+            return self._send_json(502, {"error": str(e)})
+        body = build_dash_manifest(representations).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/dash+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, job, index):
+        if not job.streams or index is None or not 0 <= index < len(job.streams):
+            return self._send_json(404, {"error": "ไม่พบ stream"})
+        file = job.streams[index]
+        try:
+            file.wait_ready(DOWNLOAD_TIMEOUT[1])
+        except Exception as e:
+            return self._send_json(502, {"error": str(e)})
+        self._send_ranged(file.total_size, "video/mp4" if index == 0 else "audio/mp4", file.read)
+
+    def _send_output(self, job):
+        if job.status != JOB_DONE or not os.path.exists(job.output_path):
+            return self._send_json(404, {"error": "ไฟล์ผลลัพธ์ยังไม่พร้อม"})
+
+        def read(start, end):
+            with open(job.output_path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    block = f.read(min(remaining, 1024 * 1024))
+                    if not block:
+                        return
+                    remaining -= len(block)
+                    yield block
+
+        self._send_ranged(os.path.getsize(job.output_path), "video/mp4", read)
+
+    def _send_ranged(self, total_size, content_type, read):
+        # ตอบ Range แบบช่วงเดียว (bytes=a-b, bytes=a-, bytes=-n) ซึ่ง player ทั่วไปใช้
+        value = self.headers.get("Range")
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", value.strip()) if value else None
+        start, end = 0, total_size - 1
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), total_size - 1) if match.group(2) else total_size - 1
+        elif match and match.group(2):
+            start = max(0, total_size - int(match.group(2)))
+        if start > end:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{total_size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{total_size}")
+        self.end_headers()
+        blocks = read(start, end)
+        try:
+            for block in blocks:
+                self.wfile.write(block)
+        except (BrokenPipeError, ConnectionResetError):
+            # player ปิด connection (เช่น seek ไปที่อื่น) เป็นเรื่องปกติ
+            pass
+        except Exception as e:
+            # ดาวน์โหลดล้มเหลวกลางทาง ส่ง header ไปแล้ว ทำได้แค่ตัด connection
+            print(f"Stream aborted: {str(e)}")
+            self.close_connection = True
+        finally:
+            blocks.close()
+
+    def _stream_events(self, job_id):
+        if not self.server.open_event_stream():
+            return self._send_json(503, {"error": "มีผู้ติดตามแบบ SSE มากเกินไป"})
+        try:
+            self._stream_events_open(job_id)
+        finally:
+            self.server.close_event_stream()
+
+    def _stream_events_open(self, job_id):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            # ส่งสถานะปัจจุบันก่อน แล้วส่งเฉพาะสิ่งที่เปลี่ยน
+            version, changed = self.engine.wait_for_changes(-1, 0, job_id)
+            while True:
+                for job in changed:
+                    self.wfile.write(f"event: job\ndata: {json.dumps(job, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    if job_id is not None and job["status"] in JOB_FINAL_STATUSES:
+                        self.wfile.flush()
+                        return
+                if not changed and job_id is not None and self.engine.get(job_id) is None:
+                    # งานถูกตัดออกจากประวัติแล้ว ไม่มีอะไรให้ติดตามอีก
+                    return
+                if not changed:
+                    self.wfile.write(b": keep-alive\n\n")
+                self.wfile.flush()
+                version, changed = self.engine.wait_for_changes(version, self.keepalive_interval, job_id)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+class JobApiServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, engine, host="127.0.0.1", port=API_DEFAULT_PORT, allow_control=True):
+        # ฟังเฉพาะ localhost เพราะผู้เรียกกำหนด path ที่จะเขียนไฟล์ได้
+        # allow_control=False เปิดให้แค่อ่านสถานะและเล่นระหว่างดาวน์โหลด สั่งหรือยกเลิกงานไม่ได้
+        super().__init__((host, port), JobApiHandler)
+        self.engine = engine
+        self.allow_control = allow_control
+        self._event_streams = 0
+        self._event_streams_lock = threading.Lock()
+
+    def open_event_stream(self):
+        with self._event_streams_lock:
+            if self._event_streams >= API_MAX_EVENT_STREAMS:
+                return False
+            self._event_streams += 1
+            return True
+
+    def close_event_stream(self):
+        with self._event_streams_lock:
+            self._event_streams -= 1
+
+def start_api_server(engine, host="127.0.0.1", port=API_DEFAULT_PORT, allow_control=True):
+    server = JobApiServer(engine, host, port, allow_control)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 class DownloadThread(QThread):
     progress = pyqtSignal(int)
@@ -214,48 +5218,43 @@ class DownloadThread(QThread):
         super().__init__()
         self.url = url
         self.save_path = save_path
-        self._stop = False
+        self.token = CancelToken()
 
     def run(self):
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-                'Accept': '*/*',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Referer': 'https://www.bilibili.tv/'
-            }
-            
-            with requests.get(self.url, stream=True, headers=headers) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get('content-length', 0))
-                block_size = 8192
-                downloaded = 0
-
-                with open(self.save_path, 'wb') as file:
-                    for chunk in response.iter_content(chunk_size=block_size):
-                        if self._stop:
-                            self.status.emit("ยกเลิกการดาวน์โหลด")
-                            return
-                            
-                        if chunk:
-                            file.write(chunk)
-                            downloaded += len(chunk)
-                            if total_size:
-                                progress = int((downloaded / total_size) * 100)
-                                self.progress.emit(progress)
-                                self.status.emit(f"กำลังดาวน์โหลด: {progress}%")
-
-            if not self._stop:
+            catalog = get_catalog()
+            cached = catalog.find_stream(self.url)
+            if cached is not None:
+                # เคยดาวน์โหลด stream นี้ไว้แล้วและไฟล์ยังไม่ถูกแก้ไข
+                get_storage_manager().touch(cached["path"])
+                link_or_copy(cached["path"], self.save_path)
+                self._report(100)
+            else:
+                digest = run_shared(("download", stream_key(self.url)), self.save_path, self._fetch,
+                                    self._report, self.token.is_cancelled)
+                catalog.record_stream(self.url, self.save_path, digest=digest)
+            get_storage_manager().track(self.save_path)
+            if not self.token.is_cancelled():
                 self.status.emit("ดาวน์โหลดเสร็จสิ้น")
                 self.finished.emit()
 
-        except RequestException as e:
-            if not self._stop:
+        except Cancelled:
+            self.status.emit("ยกเลิกการดาวน์โหลด")
+        except Exception as e:
+            if not self.token.is_cancelled():
                 self.error.emit(str(e))
 
+    def _report(self, progress):
+        progress = int(progress)
+        self.progress.emit(progress)
+        self.status.emit(f"กำลังดาวน์โหลด: {progress}%")
+
+    def _fetch(self, save_path, report):
+        return download_file(self.url, save_path, report, self.token)
+
     def stop(self):
-        self._stop = True
+        # ตัด socket ที่กำลังอ่านอยู่ทันที ไม่ต้องรอ chunk ถัดไป
+        self.token.cancel()
 
 class MergeThread(QThread):
     status = pyqtSignal(str)
@@ -263,30 +5262,187 @@ class MergeThread(QThread):
     finished = pyqtSignal()
     progress = pyqtSignal(int)
 
-    def __init__(self, video_path, audio_path, output_path):
+    def __init__(self, video_path, audio_path, output_path, executor, mode=MERGE_MODE_COPY):
         super().__init__()
         self.video_path = video_path
         self.audio_path = audio_path
         self.output_path = output_path
+        self.executor = executor
+        self.mode = mode
+        self.job = None
         self._stop = False
 
     def run(self):
-        try:
-            self.status.emit("กำลังรวมไฟล์...")
-            merge_files(self.video_path, self.audio_path, self.output_path)
-            if not self._stop:
-                self.progress.emit(100)
-                self.status.emit("รวมไฟล์เสร็จสิ้น")
-                self.finished.emit()
-        except Exception as e:
-            if not self._stop:
-                self.error.emit(str(e))
+        self.status.emit("กำลังรวมไฟล์...")
+        self.job = self.executor.submit(
+            self.video_path, self.audio_path, self.output_path, self.mode,
+            progress_callback=lambda job_id, progress: self.progress.emit(int(progress))
+        )
+        if self._stop:
+            self.executor.cancel(self.job.id)
+        self.job.wait()
+        if self.job.status == "done":
+            self.status.emit("รวมไฟล์เสร็จสิ้น")
+            self.finished.emit()
+        elif self.job.status == "cancelled":
+            self.status.emit("ยกเลิกการรวมไฟล์")
+        elif not self._stop:
+            self.error.emit(self.job.error or "")
 
     def stop(self):
         self._stop = True
+        if self.job:
+            self.executor.cancel(self.job.id)
+
+JOB_STATUS_LABELS = {
+    JOB_QUEUED: "รอคิว",
+    JOB_RUNNING: "กำลังทำงาน",
+    JOB_DONE: "เสร็จสิ้น",
+    JOB_FAILED: "ผิดพลาด",
+    JOB_CANCELLED: "ยกเลิกแล้ว",
+}
+JOB_KIND_LABELS = {"merge": "วิดีโอ+เสียง", "audio": "เสียง", "clip": "ตัดช่วงเวลา"}
+# ความถี่ที่ตารางงานรับการเปลี่ยนแปลง (มิลลิวินาที) ไม่ว่างานจะรายงานถี่แค่ไหน
+JOB_VIEW_REFRESH_MS = 100
+
+class JobRow:
+    # ข้อมูลของงานหนึ่งแถวในตาราง เก็บเฉพาะที่แสดงผล (__slots__ ไม่มี dict ต่อแถว)
+    __slots__ = ("id", "kind", "status", "progress", "message", "error", "url", "output_path", "preview", "play")
+
+    def __init__(self, job):
+        self.id = job["id"]
+        self.update(job)
+
+    def update(self, job):
+        self.kind = job["kind"]
+        self.status = job["status"]
+        self.progress = job["progress"]
+        self.message = job["message"]
+        self.error = job["error"]
+        self.url = job["url"]
+        self.output_path = job["output_path"]
+        self.preview = job["preview"]
+        self.play = job["play"]
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+class JobListModel(QAbstractTableModel):
+    # ตารางงานทั้งหมดของ JobEngine สำหรับ QTableView ซึ่งวาดเฉพาะแถวที่มองเห็น
+    # stage() ถูกเรียกจาก thread ของงานได้โดยตรง: เก็บแค่สถานะล่าสุดของแต่ละงานไว้ใน dict
+    # แล้ว timer ใน GUI thread นำไปใช้เป็นชุดทุก JOB_VIEW_REFRESH_MS: แถวใหม่เพิ่มด้วย beginInsertRows ครั้งเดียว
+    # แถวที่เปลี่ยนแจ้งด้วย dataChanged ครั้งเดียวครอบทุกแถว งานหมื่นงานจึงไม่ทำให้ GUI ถูก signal ท่วม
+    COLUMNS = ("#", "ประเภท", "สถานะ", "ความคืบหน้า", "ข้อความ", "ไฟล์ผลลัพธ์")
+    PROGRESS_COLUMN = 3
+
+    # ชุด id ของงานที่เปลี่ยนในรอบนั้น ส่งหลังตารางอัปเดตแล้ว
+    updated = pyqtSignal(object)
+
+    def __init__(self, parent=None, refresh_ms=JOB_VIEW_REFRESH_MS):
+        super().__init__(parent)
+        self._rows = []
+        self._index = {}
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.flush)
+        self._timer.start(refresh_ms)
+
+    def stage(self, job):
+        # เรียกจาก thread ใดก็ได้ รายงานถี่ ๆ ของงานเดียวกันรวมเหลือครั้งเดียวต่อรอบ
+        with self._pending_lock:
+            self._pending[job["id"]] = job
+
+    def stage_existing(self, jobs):
+        # งานที่มีอยู่ก่อนเปิดหน้าต่าง ไม่ทับสถานะที่ใหม่กว่าซึ่งมาถึงแล้ว
+        with self._pending_lock:
+            for job in jobs:
+                self._pending.setdefault(job["id"], job)
+
+    def flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        new_jobs = sorted((job for job_id, job in pending.items() if job_id not in self._index),
+                          key=lambda job: job["id"])
+        first_changed = last_changed = None
+        for job_id, job in pending.items():
+            row = self._index.get(job_id)
+            if row is None:
+                continue
+            self._rows[row].update(job)
+            first_changed = row if first_changed is None else min(first_changed, row)
+            last_changed = row if last_changed is None else max(last_changed, row)
+        if new_jobs:
+            start = len(self._rows)
+            self.beginInsertRows(QModelIndex(), start, start + len(new_jobs) - 1)
+            for offset, job in enumerate(new_jobs):
+                self._index[job["id"]] = start + offset
+                self._rows.append(JobRow(job))
+            self.endInsertRows()
+        if first_changed is not None:
+            self.dataChanged.emit(self.index(first_changed, 0),
+                                  self.index(last_changed, len(self.COLUMNS) - 1))
+        self.updated.emit(set(pending))
+
+    def job(self, job_id):
+        row = self._index.get(job_id)
+        return self._rows[row] if row is not None else None
+
+    def job_at(self, row):
+        return self._rows[row]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        job = self._rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.UserRole:
+            return job.progress
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return job.error or job.url
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        if column == 0:
+            return job.id
+        if column == 1:
+            return JOB_KIND_LABELS.get(job.kind, job.kind)
+        if column == 2:
+            return JOB_STATUS_LABELS.get(job.status, job.status)
+        if column == 3:
+            return f"{job.progress}%"
+        if column == 4:
+            return job.error if job.status == JOB_FAILED else job.message
+        return job.output_path
+
+class ProgressDelegate(QStyledItemDelegate):
+    # วาดแถบความคืบหน้าลงในช่องตารางโดยตรง ไม่ต้องมี QProgressBar ต่อแถว
+    def paint(self, painter, option, index):
+        progress = index.data(Qt.ItemDataRole.UserRole) or 0
+        bar = QStyleOptionProgressBar()
+        bar.rect = option.rect.adjusted(2, 2, -2, -2)
+        bar.minimum = 0
+        bar.maximum = 100
+        bar.progress = progress
+        bar.text = f"{progress}%"
+        bar.textVisible = True
+        bar.state = option.state
+        QApplication.style().drawControl(QStyle.ControlElement.CE_ProgressBar, bar, painter)
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, job_engine=None, api_port=None, api_control=None):
         super().__init__()
         self.setWindowTitle("โปรแกรมดาวน์โหลดและรวมไฟล์ Bilibili")
         self.setGeometry(100, 100, 800, 600)
@@ -316,15 +5472,56 @@ class MainWindow(QMainWindow):
         self.easy_download_btn.clicked.connect(self.easy_download)
         url_input_layout.addWidget(QLabel("Bilibili URL:"))
         url_input_layout.addWidget(self.easy_url)
+        self.easy_cancel_btn = QPushButton("ยกเลิก")
+        self.easy_cancel_btn.clicked.connect(self.cancel_easy_download)
+        self.easy_cancel_btn.setEnabled(False)
         url_input_layout.addWidget(self.easy_download_btn)
+        url_input_layout.addWidget(self.easy_cancel_btn)
         url_layout.addLayout(url_input_layout)
 
+        # โหมดตัดช่วงเวลา: ดาวน์โหลดเฉพาะช่วงที่ต้องการ
+        clip_layout = QHBoxLayout()
+        self.easy_clip = QCheckBox("ดาวน์โหลดเฉพาะช่วงเวลา")
+        self.easy_clip_start = QLineEdit()
+        self.easy_clip_start.setPlaceholderText("เริ่ม เช่น 10:00")
+        self.easy_clip_end = QLineEdit()
+        self.easy_clip_end.setPlaceholderText("สิ้นสุด เช่น 13:00")
+        clip_layout.addWidget(self.easy_clip)
+        clip_layout.addWidget(self.easy_clip_start)
+        clip_layout.addWidget(self.easy_clip_end)
+        url_layout.addLayout(clip_layout)
+
+        self.easy_audio_only = QCheckBox("ดาวน์โหลดเฉพาะเสียง (m4a)")
+        url_layout.addWidget(self.easy_audio_only)
+
+        self.easy_prefetch = QCheckBox(f"ดาวน์โหลดตอนถัดไป {PREFETCH_EPISODES} ตอนล่วงหน้า (ใช้แบนด์วิดท์ที่ว่าง)")
+        url_layout.addWidget(self.easy_prefetch)
+        # player ดึงไฟล์ผ่าน API ในเครื่อง ช่วงที่กำลังเล่นหรือ seek ไปถูกดาวน์โหลดก่อน
+        self.easy_stream = QCheckBox("เล่นระหว่างดาวน์โหลด (เปิดลิงก์ด้านล่างด้วย VLC หรือ mpv)")
+        url_layout.addWidget(self.easy_stream)
+        self.easy_play_url = QLineEdit()
+        self.easy_play_url.setReadOnly(True)
+        self.easy_play_url.setPlaceholderText("ลิงก์สำหรับเล่นจะแสดงที่นี่เมื่อเริ่มดาวน์โหลด")
+        url_layout.addWidget(self.easy_play_url)
+
         # Progress bar และ status
         self.easy_progress = QProgressBar()
         url_layout.addWidget(self.easy_progress)
         self.easy_status = QLabel()
         url_layout.addWidget(self.easy_status)
 
+        # ตัวอย่างจากช่วงต้นเรื่อง ขึ้นภายในไม่กี่วินาทีหลังเริ่มดาวน์โหลด ใช้ตรวจว่าเป็นวิดีโอที่ต้องการ
+        preview_layout = QHBoxLayout()
+        self.easy_preview_image = QLabel()
+        self.easy_preview_btn = QPushButton("เปิดคลิปตัวอย่าง")
+        self.easy_preview_btn.clicked.connect(self.open_easy_preview)
+        self.easy_preview_btn.setEnabled(False)
+        preview_layout.addWidget(self.easy_preview_image)
+        preview_layout.addWidget(self.easy_preview_btn)
+        preview_layout.addStretch()
+        url_layout.addLayout(preview_layout)
+        self.easy_preview_clip = None
+
         easy_layout.addWidget(url_group)
         tab_widget.addTab(easy_tab, "โหมดง่าย")
 
@@ -428,13 +5625,19 @@ class MainWindow(QMainWindow):
         audio_layout.addWidget(audio_select_btn)
         merge_layout.addLayout(audio_layout)
 
+        self.merge_transcode = QCheckBox("เข้ารหัสวิดีโอใหม่ (libx264)")
+        merge_layout.addWidget(self.merge_transcode)
+
+        self.merge_progress = QProgressBar()
+        merge_layout.addWidget(self.merge_progress)
+
         self.merge_status = QLabel()
         merge_layout.addWidget(self.merge_status)
 
         button_layout = QHBoxLayout()
         self.merge_btn = QPushButton("รวมไฟล์")
         self.merge_btn.clicked.connect(self.merge_files)
-        self.merge_cancel_btn = QPushButton("ยกเลิกและปิดโปรแกรม")
+        self.merge_cancel_btn = QPushButton("ยกเลิก")
         self.merge_cancel_btn.clicked.connect(self.cancel_merge)
         self.merge_cancel_btn.setEnabled(False)
         button_layout.addWidget(self.merge_btn)
@@ -444,12 +5647,67 @@ class MainWindow(QMainWindow):
         advanced_layout.addWidget(merge_group)
         tab_widget.addTab(advanced_tab, "โหมดขั้นสูง")
 
+        # แท็บรายการงานทั้งหมดของ JobEngine (โหมดง่ายและ HTTP API)
+        jobs_tab = QWidget()
+        jobs_layout = QVBoxLayout(jobs_tab)
+        self.job_model = JobListModel(self)
+        self.job_view = QTableView()
+        self.job_view.setModel(self.job_model)
+        self.job_view.setItemDelegateForColumn(JobListModel.PROGRESS_COLUMN, ProgressDelegate(self.job_view))
+        self.job_view.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.job_view.setWordWrap(False)
+        self.job_view.verticalHeader().hide()
+        # ความสูงแถวคงที่: view ไม่ต้องวัดขนาดทุกแถวเมื่อมีงานหลายพันงาน
+        self.job_view.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.job_view.verticalHeader().setDefaultSectionSize(22)
+        header = self.job_view.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
+        header.setStretchLastSection(True)
+        for column, width in enumerate((60, 100, 100, 140, 260)):
+            self.job_view.setColumnWidth(column, width)
+        jobs_layout.addWidget(self.job_view)
+        self.job_cancel_btn = QPushButton("ยกเลิกงานที่เลือก")
+        self.job_cancel_btn.clicked.connect(self.cancel_selected_jobs)
+        jobs_layout.addWidget(self.job_cancel_btn)
+        tab_widget.addTab(jobs_tab, "รายการงาน")
+
         # ตัวแปรสำหรับเก็บ thread
         self.video_thread = None
         self.audio_thread = None
         self.merge_thread = None
-        self.easy_video_path = None
-        self.easy_audio_path = None
+        self.merge_executor = MergeExecutor()
+
+        # โหมดง่ายและ HTTP API ใช้ JobEngine ตัวเดียวกัน
+        self.job_engine = job_engine or JobEngine(prefetcher=SeasonPrefetcher())
+        self.easy_job_id = None
+        # งานรายงานเข้าตารางโดยตรง ตารางส่ง updated เป็นชุดในจังหวะคงที่
+        self._unsubscribe_jobs = self.job_engine.subscribe(self.job_model.stage)
+        self.job_model.stage_existing(self.job_engine.jobs())
+        self.job_model.updated.connect(self.on_jobs_updated)
+        self.api_server = None
+        if api_control is None:
+            # การสั่งงานผ่าน HTTP เปิดเมื่อผู้ใช้ขอเท่านั้น
+            api_control = os.environ.get("BILIBILI_JOB_API") == "1"
+        if api_port is None:
+            # HTTP server เปิดเมื่อผู้ใช้ขอเท่านั้น: BILIBILI_API_PORT (เล่นระหว่างดาวน์โหลด/อ่านสถานะ)
+            # หรือ BILIBILI_JOB_API=1 (สั่งงานได้ด้วย ใช้พอร์ต API_DEFAULT_PORT ถ้าไม่ระบุ)
+            try:
+                api_port = int(os.environ.get("BILIBILI_API_PORT") or 0)
+            except ValueError:
+                print(f"Ignoring invalid BILIBILI_API_PORT: {os.environ.get('BILIBILI_API_PORT')!r}")
+                api_port = 0
+            if not api_port and api_control:
+                api_port = API_DEFAULT_PORT
+        if api_port:
+            try:
+                self.api_server = start_api_server(self.job_engine, port=api_port, allow_control=api_control)
+            except OSError as e:
+                # พอร์ตถูกใช้อยู่ (เช่นเปิดโปรแกรมซ้ำ) หน้าต่างยังใช้งานได้ตามปกติ
+                print(f"Job API not started: {str(e)}")
+        # การเล่นระหว่างดาวน์โหลดส่งข้อมูลผ่าน API
+        self.easy_stream.setEnabled(self.api_server is not None)
+        if self.api_server is None:
+            self.easy_stream.setToolTip("ต้องเปิด HTTP API ก่อน (ตั้งค่า BILIBILI_API_PORT เช่น 8765)")
 
     def easy_download(self):
         url = self.easy_url.text()
@@ -457,77 +5715,112 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "คำเตือน", "กรุณาใส่ URL Bilibili")
             return
 
+        clip = None
+        if self.easy_clip.isChecked():
+            try:
+                clip = (parse_timestamp(self.easy_clip_start.text()),
+                        parse_timestamp(self.easy_clip_end.text()))
+            except ValueError:
+                QMessageBox.warning(self, "คำเตือน", "รูปแบบเวลาไม่ถูกต้อง")
+                return
+
+        audio_only = self.easy_audio_only.isChecked()
+
         # ให้ผู้ใช้เลือกที่บันทึกไฟล์
         output_path, _ = QFileDialog.getSaveFileName(
             self,
-            "บันทึกไฟล์วิดีโอ",
+            "บันทึกไฟล์เสียง" if audio_only else "บันทึกไฟล์วิดีโอ",
             "",
-            "MP4 files (*.mp4)"
+            "M4A files (*.m4a)" if audio_only else ("MP4 files (*.mp4)" if clip else MERGE_OUTPUT_FILTER)
         )
         if not output_path:
             return
 
-        try:
-            # ดึง URL วิดีโอและเสียง
-            self.easy_status.setText("กำลังดึงข้อมูล URL...")
-            video_url, audio_url = get_bilibili_urls(url)
+        self.easy_progress.setValue(0)
+        self.easy_download_btn.setEnabled(False)
+        self.easy_cancel_btn.setEnabled(True)
+        self.show_easy_preview(None)
+        self.easy_play_url.clear()
 
-            # สร้าง temp directory
-            temp_dir = os.path.join(os.environ.get('TEMP') or os.environ.get('TMP') or os.getcwd(), 'bilibili_temp')
-            os.makedirs(temp_dir, exist_ok=True)
+        # งานทำใน JobEngine เพื่อให้หน้าต่างยังตอบสนองและกดยกเลิกได้
+        if audio_only:
+            job = self.job_engine.submit(url, output_path, "audio")
+        elif clip:
+            job = self.job_engine.submit(url, output_path, "clip", clip[0], clip[1])
+        else:
+            job = self.job_engine.submit(url, output_path, prefetch=self.easy_prefetch.isChecked(),
+                                         stream=self.easy_stream.isChecked())
+        self.easy_job_id = job.id
 
-            # กำหนดพาธสำหรับไฟล์ชั่วคราว
-            self.easy_video_path = os.path.join(temp_dir, "temp_video.mp4")
-            self.easy_audio_path = os.path.join(temp_dir, "temp_audio.m4s")
+    def on_jobs_updated(self, job_ids):
+        if self.easy_job_id in job_ids:
+            self.on_job_event(self.job_model.job(self.easy_job_id))
 
-            # ดาวน์โหลดวิดีโอ
-            self.easy_status.setText("กำลังดาวน์โหลดวิดีโอ...")
-            self.easy_progress.setValue(0)
-            
-            def video_progress(progress):
-                self.easy_progress.setValue(int(progress * 0.4))  # 40% สำหรับวิดีโอ
-            
-            download_file(video_url, self.easy_video_path, video_progress)
+    def cancel_selected_jobs(self):
+        for index in self.job_view.selectionModel().selectedRows():
+            job = self.job_model.job_at(index.row())
+            if job.status not in JOB_FINAL_STATUSES:
+                self.job_engine.cancel(job.id)
 
-            # ดาวน์โหลดเสียง
-            self.easy_status.setText("กำลังดาวน์โหลดเสียง...")
-            self.easy_progress.setValue(40)
-            
-            def audio_progress(progress):
-                self.easy_progress.setValue(40 + int(progress * 0.4))  # 40% สำหรับเสียง
-            
-            download_file(audio_url, self.easy_audio_path, audio_progress)
+    def on_job_event(self, job):
+        if job["id"] != self.easy_job_id:
+            return
+        self.easy_progress.setValue(job["progress"])
+        if job["message"]:
+            self.easy_status.setText(job["message"])
+        if job["preview"] and job["preview"]["clip"] != self.easy_preview_clip:
+            self.show_easy_preview(job["preview"])
+        if job["play"] and self.api_server and not self.easy_play_url.text():
+            host, port = self.api_server.server_address[:2]
+            self.easy_play_url.setText(f"http://{host}:{port}{job['play']}")
+        elif not job["play"] and job["status"] == JOB_RUNNING and self.easy_play_url.text():
+            # CDN ไม่รองรับ Range งานจึงดาวน์โหลดแบบปกติแทน ลิงก์เล่นระหว่างดาวน์โหลดใช้ไม่ได้แล้ว
+            self.easy_play_url.clear()
+        if job["status"] in JOB_FINAL_STATUSES:
+            self.easy_job_id = None
+            # ไฟล์ตัวอย่างอยู่ในโฟลเดอร์ชั่วคราวซึ่งถูกลบเมื่องานจบ เหลือไว้แค่ภาพย่อที่โหลดแล้ว
+            self.easy_preview_btn.setEnabled(False)
+        if job["status"] == JOB_DONE:
+            self.easy_download_finished()
+        elif job["status"] == JOB_FAILED:
+            self.easy_download_error(job["error"] or "")
+        elif job["status"] == JOB_CANCELLED:
+            self.easy_download_cancelled()
 
-            # รวมไฟล์
-            self.easy_status.setText("กำลังรวมไฟล์...")
-            self.easy_progress.setValue(80)
-            merge_files(self.easy_video_path, self.easy_audio_path, output_path)
+    def show_easy_preview(self, preview):
+        self.easy_preview_clip = preview["clip"] if preview else None
+        self.easy_preview_btn.setEnabled(preview is not None)
+        if preview is None:
+            self.easy_preview_image.clear()
+            return
+        pixmap = QPixmap(preview["thumbnails"])
+        if not pixmap.isNull():
+            self.easy_preview_image.setPixmap(pixmap)
 
-            # เสร็จสิ้น
-            self.easy_progress.setValue(100)
-            self.easy_status.setText("ดำเนินการเสร็จสิ้น")
-            QMessageBox.information(self, "สำเร็จ", "ดาวน์โหลดและรวมไฟล์เสร็จสิ้น")
+    def open_easy_preview(self):
+        if self.easy_preview_clip and os.path.exists(self.easy_preview_clip):
+            QDesktopServices.openUrl(QUrl.fromLocalFile(self.easy_preview_clip))
 
-            # ลบไฟล์ชั่วคราว
-            try:
-                os.remove(self.easy_video_path)
-                os.remove(self.easy_audio_path)
-                os.rmdir(temp_dir)
-            except:
-                pass
+    def easy_download_finished(self):
+        self.easy_download_btn.setEnabled(True)
+        self.easy_cancel_btn.setEnabled(False)
+        QMessageBox.information(self, "สำเร็จ", "ดาวน์โหลดและรวมไฟล์เสร็จสิ้น")
 
-        except Exception as e:
-            QMessageBox.critical(self, "ข้อผิดพลาด", str(e))
-            self.easy_status.setText("เกิดข้อผิดพลาด")
-            # ลบไฟล์ชั่วคราวถ้ามีข้อผิดพลาด
-            try:
-                if self.easy_video_path and os.path.exists(self.easy_video_path):
-                    os.remove(self.easy_video_path)
-                if self.easy_audio_path and os.path.exists(self.easy_audio_path):
-                    os.remove(self.easy_audio_path)
-                os.rmdir(temp_dir)
-            except:
-                pass
+    def easy_download_error(self, message):
+        self.easy_download_btn.setEnabled(True)
+        self.easy_cancel_btn.setEnabled(False)
+        QMessageBox.critical(self, "ข้อผิดพลาด", message)
+        self.easy_status.setText("เกิดข้อผิดพลาด")
+
+    def easy_download_cancelled(self):
+        self.easy_download_btn.setEnabled(True)
+        self.easy_cancel_btn.setEnabled(False)
+        self.easy_status.setText("ยกเลิกแล้ว กดดาวน์โหลดอีกครั้งเพื่อทำต่อจากเดิม")
+
+    def cancel_easy_download(self):
+        if self.easy_job_id is not None:
+            self.job_engine.cancel(self.easy_job_id)
+        self.easy_cancel_btn.setEnabled(False)
 
     def fetch_bilibili(self):
         url = self.bilibili_url.text()
@@ -621,17 +5914,24 @@ class MainWindow(QMainWindow):
             self,
             "บันทึกไฟล์ผลลัพธ์",
             "",
-            "MP4 files (*.mp4)"
+            MERGE_OUTPUT_FILTER
         )
         if not output_path:
             return
 
+        if self.merge_transcode.isChecked() and output_format_for(output_path) != OUTPUT_FORMAT_MP4:
+            QMessageBox.warning(self, "คำเตือน", "การแปลงไฟล์ใหม่รองรับเฉพาะผลลัพธ์แบบ MP4")
+            return
+
         self.merge_status.setText("กำลังรวมไฟล์...")
         self.merge_btn.setEnabled(False)
         self.merge_cancel_btn.setEnabled(True)
 
-        self.merge_thread = MergeThread(video_path, audio_path, output_path)
+        mode = MERGE_MODE_TRANSCODE if self.merge_transcode.isChecked() else MERGE_MODE_COPY
+        self.merge_progress.setValue(0)
+        self.merge_thread = MergeThread(video_path, audio_path, output_path, self.merge_executor, mode)
         self.merge_thread.status.connect(self.merge_status.setText)
+        self.merge_thread.progress.connect(self.merge_progress.setValue)
         self.merge_thread.error.connect(lambda e: QMessageBox.critical(self, "ข้อผิดพลาด", f"เกิดข้อผิดพลาดในการรวมไฟล์: {e}"))
         self.merge_thread.finished.connect(self.merge_finished)
         self.merge_thread.start()
@@ -642,11 +5942,29 @@ class MainWindow(QMainWindow):
         QMessageBox.information(self, "สำเร็จ", "รวมไฟล์เสร็จสิ้น")
 
     def cancel_merge(self):
+        # หยุดเฉพาะงานรวมไฟล์ (ffmpeg ถูก terminate) โปรแกรมยังเปิดอยู่
         if self.merge_thread:
             self.merge_thread.stop()
-        QApplication.quit()
+        self.merge_btn.setEnabled(True)
+        self.merge_cancel_btn.setEnabled(False)
+
+    def closeEvent(self, event):
+        # ยกเลิกงานที่ค้างอยู่ก่อนปิดหน้าต่าง ไม่ให้ ffmpeg หรือ thread ดาวน์โหลดค้างอยู่เบื้องหลัง
+        for thread in (self.video_thread, self.audio_thread, self.merge_thread):
+            if thread:
+                thread.stop()
+        self._unsubscribe_jobs()
+        if self.api_server:
+            self.api_server.shutdown()
+        self.job_engine.shutdown()
+        self.merge_executor.shutdown(cancel_running=True)
+        super().closeEvent(event)
 
 if __name__ == "__main__":
+    # จำเป็นสำหรับโปรเซสลูกของ MergeExecutor เมื่อแพ็กด้วย PyInstaller
+    multiprocessing.freeze_support()
+    if {"--worker", "--enqueue", "--serve"} & set(sys.argv):
+        sys.exit(worker_main(sys.argv[1:]))
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
@@ -1,7 +1,9 @@
 import sys
+import socket
 import requests
 from requests.exceptions import RequestException
 from moviepy.editor import VideoFileClip, AudioFileClip
+from proglog import ProgressBarLogger
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QLineEdit, QPushButton, QLabel, 
                             QFileDialog, QProgressBar, QMessageBox, QGroupBox)
@@ -17,6 +19,32 @@ def merge_video_audio(video_path, audio_path, output_path):
     video_clip.close()
     audio_clip.close()
 
+# (connect, read) วินาที ไม่ให้ thread ค้างอยู่กับ socket ที่ไม่มีข้อมูลเข้ามา
+DOWNLOAD_TIMEOUT = (5, 15)
+
+class MergeCancelled(Exception):
+    pass
+
+class CancellableLogger(ProgressBarLogger):
+    # moviepy เรียก logger ทุก chunk/frame จึงใช้เป็นจุดตรวจการยกเลิกระหว่าง write_videofile
+    def __init__(self, is_cancelled):
+        super().__init__()
+        self.is_cancelled = is_cancelled
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if self.is_cancelled():
+            raise MergeCancelled()
+
+def abort_response(response):
+    # ปิด socket ทันทีเพื่อปลุก thread ที่ค้างอยู่ใน recv()
+    connection = getattr(response.raw, "connection", None) or getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
 class DownloadThread(QThread):
     progress = pyqtSignal(str)
     finished = pyqtSignal()
@@ -28,6 +56,7 @@ class DownloadThread(QThread):
         self.save_path = save_path
         self.file_type = file_type
         self._is_cancelled = False
+        self._response = None
 
     def run(self):
         try:
@@ -39,7 +68,10 @@ class DownloadThread(QThread):
                 'Referer': 'https://www.bilibili.com/'
             }
             
-            with requests.get(self.url, stream=True, headers=headers) as response:
+            with requests.get(self.url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+                self._response = response
+                if self._is_cancelled:
+                    abort_response(response)
                 response.raise_for_status()
                 total_size = int(response.headers.get('content-length', 0))
                 block_size = 8192
@@ -62,12 +94,19 @@ class DownloadThread(QThread):
                 self.progress.emit(f"ดาวน์โหลด{self.file_type}เสร็จสิ้น")
                 self.finished.emit()
 
-        except RequestException as e:
-            if not self._is_cancelled:
+        except (RequestException, OSError) as e:
+            if self._is_cancelled:
+                self.progress.emit(f"ยกเลิกการดาวน์โหลด{self.file_type}")
+            else:
                 self.error.emit(f"เกิดข้อผิดพลาดในการดาวน์โหลด{self.file_type}: {str(e)}")
+        finally:
+            self._response = None
 
     def cancel(self):
         self._is_cancelled = True
+        response = self._response
+        if response is not None:
+            abort_response(response)
 
 class MergeThread(QThread):
     progress = pyqtSignal(str)
@@ -82,6 +121,8 @@ class MergeThread(QThread):
         self._is_cancelled = False
 
     def run(self):
+        video_clip = None
+        audio_clip = None
         try:
             video_clip = VideoFileClip(self.video_path)
             audio_clip = AudioFileClip(self.audio_path)
@@ -96,18 +137,25 @@ class MergeThread(QThread):
                 self.progress.emit("ยกเลิกการรวมไฟล์")
                 return
                 
-            video_clip.write_videofile(self.output_path, codec="libx264", audio_codec="aac", audio_bitrate="111k", audio_fps=48000)
-            
-            video_clip.close()
-            audio_clip.close()
+            video_clip.write_videofile(self.output_path, codec="libx264", audio_codec="aac", audio_bitrate="111k", audio_fps=48000,
+                                       logger=CancellableLogger(lambda: self._is_cancelled))
             
             if not self._is_cancelled:
                 self.progress.emit("รวมไฟล์เสร็จสิ้น")
                 self.finished.emit()
 
+        except MergeCancelled:
+            self.progress.emit("ยกเลิกการรวมไฟล์")
         except Exception as e:
-            if not self._is_cancelled:
+            if self._is_cancelled:
+                self.progress.emit("ยกเลิกการรวมไฟล์")
+            else:
                 self.error.emit(f"เกิดข้อผิดพลาดในการรวมไฟล์: {str(e)}")
+        finally:
+            if video_clip:
+                video_clip.close()
+            if audio_clip:
+                audio_clip.close()
 
     def cancel(self):
         self._is_cancelled = True
@@ -319,8 +367,6 @@ class MainWindow(QMainWindow):
             self.merge_thread.cancel()
             self.merge_btn.setEnabled(True)
             self.merge_cancel_btn.setEnabled(False)
-            # ปิดโปรแกรมทันที
-            QApplication.quit()
 
     def merge_finished(self):
         self.merge_btn.setEnabled(True)
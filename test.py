@@ -1,18 +1,89 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 import threading
+import collections
+import socket
 import requests
 from requests.exceptions import RequestException
 from moviepy.editor import VideoFileClip, AudioFileClip
+from proglog import ProgressBarLogger
+
+# (connect, read) วินาที ไม่ให้ thread ค้างอยู่กับ socket ที่ไม่มีข้อมูลเข้ามา
+DOWNLOAD_TIMEOUT = (5, 15)
+# รอบที่ mainloop นำเหตุการณ์จาก worker thread มาอัปเดตหน้าจอ
+UI_PUMP_INTERVAL_MS = 50
+
+class UiPump:
+    # Tk ไม่ thread-safe: worker thread ห้ามแตะ Variable/widget/messagebox เอง ให้ส่งเหตุการณ์มาที่นี่
+    # deque.append/popleft เป็น atomic จึงไม่ต้องล็อก mainloop ดึงออกมาทำทีละชุดผ่าน after()
+    # ค่าที่ตั้งให้ Variable เดียวกันหลายครั้งในชุดเดียวกันใช้แค่ค่าล่าสุด
+    def __init__(self, root, interval_ms=UI_PUMP_INTERVAL_MS):
+        self.root = root
+        self.interval_ms = interval_ms
+        self._events = collections.deque()
+        self._pending = collections.deque()
+        self.root.after(self.interval_ms, self._drain)
+
+    def set(self, variable, value):
+        self._events.append((str(variable), variable.set, (value,)))
+
+    def call(self, callback, *args):
+        self._events.append((None, callback, args))
+
+    def _drain(self):
+        # ตั้งรอบถัดไปก่อนทำงาน callback ที่เปิด messagebox (modal) จึงไม่หยุดการอัปเดตอื่นระหว่างรอผู้ใช้
+        # งานที่ค้างอยู่ใน _pending ถูกทำต่อโดยรอบที่ซ้อนเข้ามาก่อนเหตุการณ์ใหม่ ลำดับจึงไม่สลับกัน
+        self.root.after(self.interval_ms, self._drain)
+        batch = []
+        while True:
+            try:
+                batch.append(self._events.popleft())
+            except IndexError:
+                break
+        latest = {key: index for index, (key, callback, args) in enumerate(batch) if key is not None}
+        for index, (key, callback, args) in enumerate(batch):
+            if key is None or latest[key] == index:
+                self._pending.append((callback, args))
+        while self._pending:
+            callback, args = self._pending.popleft()
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"UI update failed: {str(e)}")
+
+class MergeCancelled(Exception):
+    pass
+
+class CancellableLogger(ProgressBarLogger):
+    # moviepy เรียก logger ทุก chunk/frame จึงใช้เป็นจุดตรวจการยกเลิกระหว่าง write_videofile
+    def __init__(self, stop_event):
+        super().__init__()
+        self.stop_event = stop_event
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if self.stop_event.is_set():
+            raise MergeCancelled()
+
+def abort_response(response):
+    # ปิด socket ทันทีเพื่อปลุก thread ที่ค้างอยู่ใน recv()
+    connection = getattr(response.raw, "connection", None) or getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 class DownloadThread(threading.Thread):
-    def __init__(self, url, save_path, progress_var, status_var):
-        super().__init__()
+    def __init__(self, url, save_path, progress_var, status_var, ui):
+        super().__init__(daemon=True)
         self.url = url
         self.save_path = save_path
         self.progress_var = progress_var
         self.status_var = status_var
+        self.ui = ui
         self._stop_event = threading.Event()
+        self._response = None
 
     def run(self):
         try:
@@ -24,75 +95,99 @@ class DownloadThread(threading.Thread):
                 'Referer': 'https://www.bilibili.com/'
             }
             
-            with requests.get(self.url, stream=True, headers=headers) as response:
-            response.raise_for_status()
+            with requests.get(self.url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+                self._response = response
+                if self._stop_event.is_set():
+                    abort_response(response)
+                response.raise_for_status()
                 total_size = int(response.headers.get('content-length', 0))
-                block_size = 8192
+                block_size = 65536
                 downloaded = 0
+                last_progress = None
 
                 with open(self.save_path, 'wb') as file:
                     for chunk in response.iter_content(chunk_size=block_size):
                         if self._stop_event.is_set():
-                            self.status_var.set("ยกเลิกการดาวน์โหลด")
+                            self.ui.set(self.status_var, "ยกเลิกการดาวน์โหลด")
                             return
                             
-                    if chunk:
-                        file.write(chunk)
+                        if chunk:
+                            file.write(chunk)
                             downloaded += len(chunk)
                             if total_size:
                                 progress = int((downloaded / total_size) * 100)
-                                self.progress_var.set(progress)
-                                self.status_var.set(f"กำลังดาวน์โหลด: {progress}%")
+                                # ส่งเฉพาะเมื่อเปอร์เซ็นต์เปลี่ยน ไม่ใช่ทุก chunk
+                                if progress != last_progress:
+                                    last_progress = progress
+                                    self.ui.set(self.progress_var, progress)
+                                    self.ui.set(self.status_var, f"กำลังดาวน์โหลด: {progress}%")
 
             if not self._stop_event.is_set():
-                self.status_var.set("ดาวน์โหลดเสร็จสิ้น")
-                messagebox.showinfo("สำเร็จ", "ดาวน์โหลดเสร็จสิ้น")
+                self.ui.set(self.status_var, "ดาวน์โหลดเสร็จสิ้น")
+                self.ui.call(messagebox.showinfo, "สำเร็จ", "ดาวน์โหลดเสร็จสิ้น")
 
-    except RequestException as e:
-            if not self._stop_event.is_set():
-                self.status_var.set("เกิดข้อผิดพลาด")
-                messagebox.showerror("ข้อผิดพลาด", f"เกิดข้อผิดพลาดในการดาวน์โหลด: {str(e)}")
+        except (RequestException, OSError) as e:
+            if self._stop_event.is_set():
+                self.ui.set(self.status_var, "ยกเลิกการดาวน์โหลด")
+            else:
+                self.ui.set(self.status_var, "เกิดข้อผิดพลาด")
+                self.ui.call(messagebox.showerror, "ข้อผิดพลาด", f"เกิดข้อผิดพลาดในการดาวน์โหลด: {str(e)}")
+        finally:
+            self._response = None
 
     def stop(self):
         self._stop_event.set()
+        response = self._response
+        if response is not None:
+            abort_response(response)
 
 class MergeThread(threading.Thread):
-    def __init__(self, video_path, audio_path, output_path, status_var):
-        super().__init__()
+    def __init__(self, video_path, audio_path, output_path, status_var, ui):
+        super().__init__(daemon=True)
         self.video_path = video_path
         self.audio_path = audio_path
         self.output_path = output_path
         self.status_var = status_var
+        self.ui = ui
         self._stop_event = threading.Event()
 
     def run(self):
+        video_clip = None
+        audio_clip = None
         try:
             video_clip = VideoFileClip(self.video_path)
             audio_clip = AudioFileClip(self.audio_path)
             
             if self._stop_event.is_set():
-                self.status_var.set("ยกเลิกการรวมไฟล์")
+                self.ui.set(self.status_var, "ยกเลิกการรวมไฟล์")
                 return
 
-    video_clip = video_clip.set_audio(audio_clip)
+            video_clip = video_clip.set_audio(audio_clip)
 
             if self._stop_event.is_set():
-                self.status_var.set("ยกเลิกการรวมไฟล์")
+                self.ui.set(self.status_var, "ยกเลิกการรวมไฟล์")
                 return
                 
-            video_clip.write_videofile(self.output_path, codec="libx264", audio_codec="aac", audio_bitrate="111k", audio_fps=48000)
-            
-            video_clip.close()
-            audio_clip.close()
+            video_clip.write_videofile(self.output_path, codec="libx264", audio_codec="aac", audio_bitrate="111k", audio_fps=48000,
+                                       logger=CancellableLogger(self._stop_event))
             
             if not self._stop_event.is_set():
-                self.status_var.set("รวมไฟล์เสร็จสิ้น")
-                messagebox.showinfo("สำเร็จ", "รวมไฟล์เสร็จสิ้น")
+                self.ui.set(self.status_var, "รวมไฟล์เสร็จสิ้น")
+                self.ui.call(messagebox.showinfo, "สำเร็จ", "รวมไฟล์เสร็จสิ้น")
 
+        except MergeCancelled:
+            self.ui.set(self.status_var, "ยกเลิกการรวมไฟล์")
         except Exception as e:
-            if not self._stop_event.is_set():
-                self.status_var.set("เกิดข้อผิดพลาด")
-                messagebox.showerror("ข้อผิดพลาด", f"เกิดข้อผิดพลาดในการรวมไฟล์: {str(e)}")
+            if self._stop_event.is_set():
+                self.ui.set(self.status_var, "ยกเลิกการรวมไฟล์")
+            else:
+                self.ui.set(self.status_var, "เกิดข้อผิดพลาด")
+                self.ui.call(messagebox.showerror, "ข้อผิดพลาด", f"เกิดข้อผิดพลาดในการรวมไฟล์: {str(e)}")
+        finally:
+            if video_clip:
+                video_clip.close()
+            if audio_clip:
+                audio_clip.close()
 
     def stop(self):
         self._stop_event.set()
@@ -102,6 +197,8 @@ class App:
         self.root = root
         self.root.title("โปรแกรมรวมไฟล์วิดีโอและเสียง")
         self.root.geometry("800x600")
+        # ช่องทางเดียวที่ worker thread ใช้อัปเดตหน้าจอ
+        self.ui = UiPump(root)
 
         # สร้างเฟรมหลัก
         main_frame = ttk.Frame(root, padding="10")
@@ -172,7 +269,7 @@ class App:
         button_frame.grid(row=3, column=1, sticky=(tk.W, tk.E))
         self.merge_btn = ttk.Button(button_frame, text="รวมไฟล์", command=self.merge_files)
         self.merge_btn.pack(side=tk.LEFT, padx=5)
-        self.merge_cancel_btn = ttk.Button(button_frame, text="ยกเลิกและปิดโปรแกรม", command=self.cancel_merge, state=tk.DISABLED)
+        self.merge_cancel_btn = ttk.Button(button_frame, text="ยกเลิก", command=self.cancel_merge, state=tk.DISABLED)
         self.merge_cancel_btn.pack(side=tk.LEFT)
 
         # ตัวแปรสำหรับเก็บ thread
@@ -205,7 +302,7 @@ class App:
         download_btn.config(state=tk.DISABLED)
         cancel_btn.config(state=tk.NORMAL)
 
-        thread = DownloadThread(url, save_path, progress_var, status_var)
+        thread = DownloadThread(url, save_path, progress_var, status_var, self.ui)
         if file_type == "video":
             self.video_thread = thread
         else:
@@ -255,13 +352,14 @@ class App:
         self.merge_btn.config(state=tk.DISABLED)
         self.merge_cancel_btn.config(state=tk.NORMAL)
 
-        self.merge_thread = MergeThread(video_path, audio_path, output_path, self.merge_status_var)
+        self.merge_thread = MergeThread(video_path, audio_path, output_path, self.merge_status_var, self.ui)
         self.merge_thread.start()
 
     def cancel_merge(self):
         if self.merge_thread:
             self.merge_thread.stop()
-        self.root.quit()
+        self.merge_btn.config(state=tk.NORMAL)
+        self.merge_cancel_btn.config(state=tk.DISABLED)
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,97 @@
+import base64
+import hashlib
+import http.server
+import importlib.util
+import os
+import re
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def app():
+    # main-v2.py มีขีดในชื่อ import ตรง ๆ ไม่ได้ จึงโหลดจาก path
+    spec = importlib.util.spec_from_file_location("main_v2", os.path.join(ROOT, "main-v2.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class RangeServer:
+    # เซิร์ฟเวอร์ไฟล์ในเครื่องที่ตอบ Range แบบ CDN (ปิดได้ด้วย supports_range) และบันทึกทุก Range ที่ถูกขอ
+    # send_digest ส่ง Repr-Digest ของไฟล์ path ใน corrupt ส่งไบต์สุดท้ายผิดแต่ digest ยังเป็นของไฟล์จริง
+    def __init__(self):
+        self.files = {}
+        self.supports_range = True
+        self.send_digest = False
+        self.corrupt = set()
+        self.requests = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                original = server.files[path]
+                data = original[:-1] + bytes([original[-1] ^ 1]) if path in server.corrupt else original
+                header = self.headers.get("Range")
+                with server._lock:
+                    server.requests.append((self.path, header))
+                match = re.match(r"bytes=(\d+)-(\d*)", header or "")
+                if match and server.supports_range:
+                    start = int(match.group(1))
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(data)}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+                    body = data[start:end + 1]
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+                else:
+                    body = data
+                    self.send_response(200)
+                if server.send_digest:
+                    digest = base64.b64encode(hashlib.sha256(original).digest()).decode()
+                    self.send_header("Repr-Digest", f"sha-256=:{digest}:")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except OSError:
+                    # ผู้ดาวน์โหลดตัด connection เอง (ยกเลิกหรือดิสก์เต็ม)
+                    pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def add(self, path, size):
+        self.files[path] = os.urandom(size)
+        return f"http://127.0.0.1:{self._server.server_address[1]}{path}", self.files[path]
+
+    def ranges(self, path):
+        with self._lock:
+            return [header for request_path, header in self.requests if request_path.split("?")[0] == path]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def range_server():
+    server = RangeServer()
+    yield server
+    server.close()
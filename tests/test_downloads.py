@@ -0,0 +1,226 @@
+import errno
+import hashlib
+import os
+import threading
+
+import pytest
+
+MB = 1024 * 1024
+
+
+def blake2b(data):
+    return hashlib.blake2b(data).hexdigest()
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def disk_full(app, monkeypatch):
+    # ให้การเขียนไฟล์ที่ลงท้ายด้วย suffix ได้แค่ budget ไบต์ แล้วจึง ENOSPC เหมือนดิสก์เต็มกลางทาง
+    # (ส่วนที่ยังพอเขียนได้ถูกเขียนลงไปก่อน เหมือน write() จริงที่เขียนได้บางส่วน)
+    original = app.VolumeWriter._write
+
+    def install(suffix, budget):
+        remaining = [budget]
+
+        def write(file, offset, parts):
+            data = b"".join(parts)
+            if file.path.endswith(suffix) and remaining[0] < len(data):
+                original(file, offset, [data[:remaining[0]]])
+                remaining[0] = 0
+                raise OSError(errno.ENOSPC, "No space left on device")
+            if file.path.endswith(suffix):
+                remaining[0] -= len(data)
+            original(file, offset, [data])
+
+        monkeypatch.setattr(app.VolumeWriter, "_write", staticmethod(write))
+
+    yield install
+    monkeypatch.setattr(app.VolumeWriter, "_write", staticmethod(original))
+
+
+def test_segmented_download(app, range_server, tmp_path):
+    url, data = range_server.add("/video.mp4", 6 * MB + 123)
+    output = str(tmp_path / "video.mp4")
+
+    digest = app.download_file(url, output)
+
+    assert read_file(output) == data
+    assert digest == blake2b(data)
+    assert not os.path.exists(output + ".part")
+    # ขอเป็นหลายช่วง ไม่ใช่คำขอเดียวทั้งไฟล์
+    starts = sorted(int(header[len("bytes="):].split("-")[0]) for header in range_server.ranges("/video.mp4"))
+    assert len(starts) > 1 and starts[0] == 0
+
+
+def test_resume_from_part_file(app, range_server, tmp_path):
+    url, data = range_server.add("/video.mp4", 3 * MB + 7)
+    output = str(tmp_path / "video.mp4")
+    prefix = MB + 11
+    with open(output + ".part", "wb") as f:
+        f.write(data[:prefix])
+
+    digest = app.download_file(url, output)
+
+    assert read_file(output) == data
+    assert digest == blake2b(data)
+    # ไม่ขอส่วนที่มีอยู่แล้วซ้ำ
+    assert range_server.ranges("/video.mp4")[0] == f"bytes={prefix}-{prefix + app.segment_size(prefix) - 1}"
+    assert all(int(header[len("bytes="):].split("-")[0]) >= prefix for header in range_server.ranges("/video.mp4"))
+
+
+def test_download_without_range_support(app, range_server, tmp_path):
+    range_server.supports_range = False
+    url, data = range_server.add("/video.mp4", 2 * MB + 5)
+    output = str(tmp_path / "video.mp4")
+
+    digest = app.download_file(url, output)
+
+    assert read_file(output) == data
+    assert digest == blake2b(data)
+    assert len(range_server.ranges("/video.mp4")) == 1
+
+
+def test_server_checksum_mismatch_discards_part(app, range_server, tmp_path):
+    range_server.send_digest = True
+    url, data = range_server.add("/video.mp4", 3 * MB)
+    output = str(tmp_path / "video.mp4")
+    range_server.corrupt.add("/video.mp4")
+
+    with pytest.raises(Exception, match="checksum"):
+        app.download_file(url, output)
+    assert not os.path.exists(output)
+    assert not os.path.exists(output + ".part")
+
+    range_server.corrupt.clear()
+    assert app.download_file(url, output) == blake2b(data)
+
+
+def test_progressive_read_during_download(app, range_server, tmp_path):
+    url, data = range_server.add("/video.mp4", 4 * MB + 99)
+    file = app.ProgressiveFile(url, str(tmp_path / "video.mp4"))
+    received = []
+    errors = []
+
+    def reader():
+        try:
+            file.wait_ready(30)
+            # player seek ไปกลางไฟล์ก่อนแล้วจึงอ่านจากต้นไฟล์
+            middle = file.total_size // 2
+            received.append(b"".join(file.read(middle, file.total_size - 1)))
+            received.append(b"".join(file.read(0, middle - 1)))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        digests = app.fetch_progressive([file])
+    finally:
+        thread.join(30)
+        file.release()
+
+    assert not errors
+    assert received[1] + received[0] == data
+    assert digests == [blake2b(data)]
+    assert read_file(str(tmp_path / "video.mp4")) == data
+
+
+def test_progressive_verifies_server_checksum(app, range_server, tmp_path):
+    range_server.send_digest = True
+    url, data = range_server.add("/video.mp4", MB + 3)
+    output = str(tmp_path / "video.mp4")
+    range_server.corrupt.add("/video.mp4")
+    file = app.ProgressiveFile(url, output)
+    try:
+        with pytest.raises(Exception, match="checksum"):
+            app.fetch_progressive([file])
+    finally:
+        file.release()
+    assert not os.path.exists(output)
+
+    range_server.corrupt.clear()
+    file = app.ProgressiveFile(url, output)
+    try:
+        assert app.fetch_progressive([file]) == [blake2b(data)]
+    finally:
+        file.release()
+
+
+def test_progressive_falls_back_without_range(app, range_server, tmp_path):
+    range_server.supports_range = False
+    video_url, video = range_server.add("/video.mp4", 2 * MB + 1)
+    audio_url, audio = range_server.add("/audio.m4s", MB + 2)
+    files = [app.ProgressiveFile(video_url, str(tmp_path / "video.mp4")),
+             app.ProgressiveFile(audio_url, str(tmp_path / "audio.m4s"))]
+    fallbacks = []
+    try:
+        digests = app.fetch_progressive(files, fallback_callback=lambda: fallbacks.append(True))
+    finally:
+        for file in files:
+            file.release()
+
+    assert fallbacks == [True]
+    assert read_file(str(tmp_path / "video.mp4")) == video
+    assert read_file(str(tmp_path / "audio.m4s")) == audio
+    assert digests == [blake2b(video), blake2b(audio)]
+
+
+def test_download_disk_full_keeps_resumable_part(app, range_server, tmp_path, disk_full):
+    url, data = range_server.add("/video.mp4", 8 * MB)
+    output = str(tmp_path / "video.mp4")
+    disk_full(".part", 3 * MB)
+
+    with pytest.raises(app.StorageFull):
+        app.download_file(url, output)
+
+    part = read_file(output + ".part")
+    assert 0 < len(part) <= 3 * MB
+    assert part == data[:len(part)]
+
+    disk_full(".part", 1 << 40)
+    assert app.download_file(url, output) == blake2b(data)
+    assert read_file(output) == data
+
+
+def test_progressive_disk_full_fails_readers_and_resumes(app, range_server, tmp_path, disk_full):
+    url, data = range_server.add("/video.mp4", 8 * MB)
+    output = str(tmp_path / "video.mp4")
+    disk_full(".stream", 3 * MB)
+    file = app.ProgressiveFile(url, output)
+    received = []
+
+    def reader():
+        file.wait_ready(30)
+        try:
+            for block in file.read(0, file.total_size - 1):
+                received.append(block)
+        except Exception as e:
+            received.append(e)
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        with pytest.raises(app.StorageFull):
+            app.fetch_progressive([file])
+    finally:
+        thread.join(30)
+        file.release()
+
+    # ผู้อ่านได้ข้อผิดพลาด ไม่ใช่ช่องว่างที่ไม่เคยถูกเขียน
+    good = b"".join(block for block in received if isinstance(block, bytes))
+    assert good == data[:len(good)]
+    assert isinstance(received[-1], Exception)
+    part = read_file(output + ".part")
+    assert part == data[:len(part)]
+
+    disk_full(".stream", 1 << 40)
+    resumed = app.ProgressiveFile(url, output)
+    try:
+        assert app.fetch_progressive([resumed]) == [blake2b(data)]
+    finally:
+        resumed.release()
+    assert read_file(output) == data